@@ -8,256 +8,767 @@
 import asyncio
 import aiosqlite
 import logging
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Optional, List, Dict, Tuple
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, List, Dict, Tuple
+
+from db_cache import CodeMap, KnownUsers, LRUCache, QueryCache, cached_query
+from db_metrics import CURRENT_CALL
+from db_profiler import StatementProfiler
+from db_migrations import MigrationRunner
+from db_storage import (CODED_COLUMNS, EXPORT_TABLES, SUBSCRIPTION_DISPLAY_NAMES, USER_FILTERS,
+                        normalize_username, subscription_commission)
 
 logger = logging.getLogger(__name__)
 
+# Профиль PRAGMA для режима WAL (применяется к писателю и к пулу читателей)
+WAL_PRAGMAS = {
+    "synchronous": "NORMAL",   # fsync только на чекпоинтах WAL, без потери целостности
+    "cache_size": -16000,      # ~16 МБ кэша страниц на соединение
+    "mmap_size": 134217728,    # 128 МБ отображаемой в память БД
+    "temp_store": "MEMORY",    # временные таблицы и сортировки в памяти
+}
+
+# Текущее время в секундах Unix (UTC) для колонок created_ts.
+# В одном запросе 'now' совпадает с CURRENT_TIMESTAMP текстовых колонок
+EPOCH_NOW_SQL = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+class Transaction:
+    """Единица работы: несколько запросов на одном соединении с одним коммитом.
+    
+    Создается только через AsyncDatabaseManager.transaction(). Внутри блока
+    нельзя вызывать другие методы менеджера (они ждут ту же блокировку) -
+    все запросы выполняются через методы самой транзакции.
+    """
+    
+    def __init__(self, db: aiosqlite.Connection):
+        self._db = db
+    
+    async def execute(self, sql: str, params: Tuple = ()) -> int:
+        """Выполнение запроса, возвращает количество затронутых строк"""
+        cursor = await self._db.execute(sql, params)
+        rowcount = cursor.rowcount
+        await cursor.close()
+        return rowcount
+    
+    async def executemany(self, sql: str, params_seq) -> int:
+        """Выполнение запроса для набора параметров"""
+        cursor = await self._db.executemany(sql, params_seq)
+        rowcount = cursor.rowcount
+        await cursor.close()
+        return rowcount
+    
+    async def fetchone(self, sql: str, params: Tuple = ()) -> Optional[Tuple]:
+        """Первая строка результата (или None)"""
+        cursor = await self._db.execute(sql, params)
+        row = await cursor.fetchone()
+        await cursor.close()
+        return row
+    
+    async def fetchall(self, sql: str, params: Tuple = ()) -> List[Tuple]:
+        """Все строки результата"""
+        cursor = await self._db.execute(sql, params)
+        rows = await cursor.fetchall()
+        await cursor.close()
+        return list(rows)
+
+
 class AsyncDatabaseManager:
     """Асинхронный менеджер базы данных с полной поддержкой async/await"""
     
-    def __init__(self, db_path: str = "passive_nft_bot.db"):
+    def __init__(self, db_path: str = "passive_nft_bot.db", busy_timeout_ms: int = 5000,
+                 wal_mode: bool = False, read_pool_size: int = 4,
+                 group_commit: bool = False, commit_batch_size: int = 64, commit_interval_ms: float = 5.0,
+                 username_cache_size: int = 10000, username_cache_ttl: float = 300.0,
+                 known_users_max: Optional[int] = 2000000, profiler: Optional[StatementProfiler] = None,
+                 query_cache: Optional[QueryCache] = None):
         self.db_path = db_path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.wal_mode = wal_mode
+        self.read_pool_size = max(1, read_pool_size)
+        self.group_commit = group_commit
+        self.commit_batch_size = max(1, commit_batch_size)
+        self.commit_interval = max(0.0, commit_interval_ms) / 1000.0
         self._lock = asyncio.Lock()
+        # Долгоживущее соединение: открывается один раз и переиспользуется всеми методами
+        self._db: Optional[aiosqlite.Connection] = None
+        # Пул read-only соединений для режима WAL (заполняется в initialize)
+        self._read_pool: Optional[asyncio.Queue] = None
+        self._readers: List[aiosqlite.Connection] = []
+        # Очередь операций записи для группового коммита (заполняется в initialize)
+        self._write_queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        # Версионированные миграции схемы и фоновые backfill
+        self.migrations = MigrationRunner(self)
+        # username (нормализованный) -> user_id; сбрасывается при смене username
+        self._username_cache = LRUCache(maxsize=username_cache_size, ttl=username_cache_ttl)
+        self._username_generation = 0
+        # Известные пользователи: повторный /start не идет в базу (загружается в фоне)
+        self._known_users = KnownUsers(max_size=known_users_max)
+        self._known_users_task: Optional[asyncio.Task] = None
+        # Справочники кодов подписок и способов оплаты (загружаются в initialize)
+        self.subscription_types = CodeMap("subscription_types")
+        self.payment_methods = CodeMap("payment_methods")
+        # Статистика SQL-запросов через trace/progress-колбэки (None - выключена)
+        self.profiler = profiler
+        # Кэш ответов методов чтения, сбрасывается по версиям таблиц (None - выключен)
+        self.query_cache = query_cache
     
-    async def initialize(self):
-        """Инициализация базы данных с созданием всех необходимых таблиц"""
+    async def _apply_pragmas(self, db: aiosqlite.Connection):
+        """Настройка PRAGMA (и профилировщика) для только что открытого соединения"""
+        await db.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        if self.wal_mode:
+            for name, value in WAL_PRAGMAS.items():
+                await db.execute(f"PRAGMA {name} = {value}")
+        if self.profiler is not None:
+            await self.profiler.attach(db)
+    
+    async def _open_connection(self) -> aiosqlite.Connection:
+        """Открытие нового соединения с базой данных"""
+        db = await aiosqlite.connect(self.db_path)
+        # Действует только для новой (пустой) базы: свободные страницы потом
+        # возвращаются порциями через PRAGMA incremental_vacuum (db_maintenance)
+        await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        if self.wal_mode:
+            cursor = await db.execute("PRAGMA journal_mode = WAL")
+            journal_mode = (await cursor.fetchone())[0]
+            await cursor.close()
+            if journal_mode.lower() != "wal":
+                logger.warning(f"⚠️ Не удалось включить WAL, режим журнала: {journal_mode}")
+        await self._apply_pragmas(db)
+        logger.info(f"🔌 Открыто соединение с базой данных {self.db_path}")
+        return db
+    
+    async def _open_read_connection(self) -> aiosqlite.Connection:
+        """Открытие read-only соединения для пула читателей"""
+        uri = f"{Path(self.db_path).resolve().as_uri()}?mode=ro"
+        db = await aiosqlite.connect(uri, uri=True)
+        await self._apply_pragmas(db)
+        await db.execute("PRAGMA query_only = 1")
+        return db
+    
+    @staticmethod
+    def _is_connection_alive(db: Optional[aiosqlite.Connection]) -> bool:
+        """Проверка, что соединение открыто и его рабочий поток жив"""
+        return (
+            db is not None
+            and db._running
+            and db._connection is not None
+            and db.is_alive()
+        )
+    
+    @staticmethod
+    async def _close_quietly(db: Optional[aiosqlite.Connection]):
+        """Закрытие соединения без выброса исключений"""
+        if db is None:
+            return
+        try:
+            await db.close()
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка при закрытии соединения с базой данных: {e}")
+    
+    async def _discard_connection(self):
+        """Закрытие сломанного соединения писателя"""
+        db, self._db = self._db, None
+        await self._close_quietly(db)
+    
+    async def _get_connection(self) -> aiosqlite.Connection:
+        """Получение живого соединения (вызывается под self._lock), переподключение при необходимости"""
+        if not self._is_connection_alive(self._db):
+            if self._db is not None:
+                logger.warning("♻️ Соединение с базой данных потеряно, переподключаемся...")
+                await self._discard_connection()
+            self._db = await self._open_connection()
+        return self._db
+    
+    async def _start_read_pool(self):
+        """Открытие пула читателей (только в режиме WAL, после создания схемы)"""
+        if not self.wal_mode or self._read_pool is not None:
+            return
+        pool = asyncio.Queue()
+        for _ in range(self.read_pool_size):
+            db = await self._open_read_connection()
+            self._readers.append(db)
+            pool.put_nowait(db)
+        self._read_pool = pool
+        logger.info(f"📚 Пул читателей WAL открыт: {self.read_pool_size} соединений")
+    
+    @asynccontextmanager
+    async def _connection(self):
+        """Эксклюзивный доступ к долгоживущему соединению.
+        
+        Всё, что не было закоммичено внутри блока, откатывается при выходе,
+        чтобы незавершенная транзакция одного вызова не утекла в следующий.
+        Если откат не удался, соединение считается сломанным и будет
+        переоткрыто при следующем обращении.
+        """
+        # Ожидание блокировки записывается в метрики замеряемого вызова (db_metrics)
+        timings = CURRENT_CALL.get()
+        started = time.perf_counter() if timings is not None else 0.0
         async with self._lock:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute("""
-                    CREATE TABLE IF NOT EXISTS users (
-                        id INTEGER PRIMARY KEY,
-                        username TEXT,
-                        first_name TEXT,
-                        last_name TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        referral_code TEXT UNIQUE
-                    )
-                """)
-                
-                await db.execute("""
-                    CREATE TABLE IF NOT EXISTS referrals (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        referrer_id INTEGER NOT NULL,
-                        referred_id INTEGER NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (referrer_id) REFERENCES users (id),
-                        FOREIGN KEY (referred_id) REFERENCES users (id),
-                        UNIQUE(referrer_id, referred_id)
-                    )
-                """)
-                
-                await db.execute("""
-                    CREATE TABLE IF NOT EXISTS pending_referrals (
-                        user_id INTEGER PRIMARY KEY,
-                        referrer_id INTEGER NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users (id),
-                        FOREIGN KEY (referrer_id) REFERENCES users (id)
-                    )
-                """)
-                
-                await db.execute("""
-                    CREATE TABLE IF NOT EXISTS subscriptions (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER NOT NULL,
-                        subscription_type TEXT NOT NULL,
-                        payment_method TEXT NOT NULL,
-                        amount REAL,
-                        currency TEXT DEFAULT 'TON',
-                        status TEXT DEFAULT 'pending',
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (user_id) REFERENCES users (id)
-                    )
-                """)
-                
-                await db.execute("""
-                    CREATE TABLE IF NOT EXISTS referral_earnings (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        referrer_id INTEGER NOT NULL,
-                        referred_id INTEGER NOT NULL,
-                        commission_amount REAL NOT NULL,
-                        subscription_type TEXT NOT NULL,
-                        payment_method TEXT NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (referrer_id) REFERENCES users (id),
-                        FOREIGN KEY (referred_id) REFERENCES users (id)
-                    )
-                """)
-                
-                # НОВАЯ ТАБЛИЦА ДЛЯ СИСТЕМЫ ПОДТВЕРЖДЕНИЯ ОПЛАТЫ
-                await db.execute("""
-                    CREATE TABLE IF NOT EXISTS confirmation_logs (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        admin_id INTEGER NOT NULL,
-                        subscription_type TEXT NOT NULL,
-                        username TEXT NOT NULL,
-                        link_id TEXT NOT NULL UNIQUE,
-                        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                
+            if timings is not None:
+                timings.lock_wait += time.perf_counter() - started
+            db = await self._get_connection()
+            try:
+                yield db
+            finally:
+                if self.profiler is not None:
+                    self.profiler.release(db)
+                try:
+                    if db.in_transaction:
+                        await db.rollback()
+                except Exception as e:
+                    logger.warning(f"⚠️ Не удалось откатить транзакцию, соединение будет переоткрыто: {e}")
+                    await self._discard_connection()
+    
+    @asynccontextmanager
+    async def _read_connection(self):
+        """Соединение для чтения.
+        
+        В режиме WAL берется свободное соединение из пула читателей, и чтение
+        не ждет глобальную блокировку писателя. Без WAL (или до initialize)
+        чтение идет через общее соединение под self._lock.
+        """
+        pool = self._read_pool
+        if pool is None:
+            async with self._connection() as db:
+                yield db
+            return
+        
+        timings = CURRENT_CALL.get()
+        started = time.perf_counter() if timings is not None else 0.0
+        db = await pool.get()
+        if timings is not None:
+            timings.connection_wait += time.perf_counter() - started
+        try:
+            if not self._is_connection_alive(db):
+                logger.warning("♻️ Соединение читателя потеряно, переподключаемся...")
+                db = await self._replace_reader(db)
+            yield db
+        finally:
+            if self.profiler is not None:
+                self.profiler.release(db)
+            if self._read_pool is pool:
+                pool.put_nowait(db)
+            else:
+                # Пул закрыт, пока соединение было занято
+                await self._close_quietly(db)
+    
+    async def _replace_reader(self, db: aiosqlite.Connection) -> aiosqlite.Connection:
+        """Замена сломанного соединения читателя новым"""
+        await self._close_quietly(db)
+        if db in self._readers:
+            self._readers.remove(db)
+        new_db = await self._open_read_connection()
+        self._readers.append(new_db)
+        return new_db
+    
+    @asynccontextmanager
+    async def transaction(self, tables: Optional[Tuple[str, ...]] = None):
+        """Транзакция из нескольких запросов с одним коммитом.
+        
+        Пример:
+            async with db.transaction() as tx:
+                await tx.execute("INSERT ...", (...))
+                row = await tx.fetchone("SELECT ...", (...))
+        
+        Блокировка записи берется сразу (BEGIN IMMEDIATE), при исключении
+        внутри блока все изменения откатываются. tables - изменяемые таблицы
+        для сброса кэша запросов (None - неизвестны, сбрасывается весь кэш).
+        """
+        async with self._connection() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            yield Transaction(db)
+            await db.commit()
+        self._bump_tables(tables)
+    
+    @asynccontextmanager
+    async def read_only(self):
+        """Запросы чтения через интерфейс Transaction без блокировки записи.
+        
+        Соединение берется как для обычного чтения (пул читателей в режиме WAL),
+        кэш запросов не сбрасывается. Писать через него нельзя.
+        """
+        async with self._read_connection() as db:
+            yield Transaction(db)
+    
+    def _bump_tables(self, tables: Optional[Tuple[str, ...]]):
+        """Запись закоммичена: ответы кэша запросов по этим таблицам устарели"""
+        if self.query_cache is None:
+            return
+        if tables is None:
+            self.query_cache.bump_all()
+        else:
+            self.query_cache.bump(*tables)
+    
+    # ===== ГРУППОВОЙ КОММИТ ДЛЯ ГОРЯЧИХ ОПЕРАЦИЙ ЗАПИСИ =====
+    
+    async def _submit_write(self, operation: Callable[[aiosqlite.Connection], Awaitable[Any]],
+                            tables: Tuple[str, ...] = ()) -> Any:
+        """Выполнение операции записи с гарантией, что она закоммичена.
+        
+        operation получает соединение и выполняет свои запросы без commit().
+        При включенном групповом коммите операция ставится в очередь писателя,
+        а результат возвращается только после коммита всей пачки.
+        tables - изменяемые таблицы, их версии в кэше запросов растут после коммита.
+        """
+        if self._write_queue is None:
+            async with self._connection() as db:
+                result = await operation(db)
                 await db.commit()
-                logger.info("✅ Асинхронная база данных инициализирована с системой подтверждения оплаты")
+            self._bump_tables(tables)
+            return result
+        
+        timings = CURRENT_CALL.get()
+        if timings is not None:
+            # Время в очереди до начала операции - ожидание блокировки писателя
+            queued_at = time.perf_counter()
+            queued_operation = operation
+            
+            async def operation(db):
+                timings.lock_wait += time.perf_counter() - queued_at
+                return await queued_operation(db)
+        
+        future = asyncio.get_running_loop().create_future()
+        self._write_queue.put_nowait((operation, future))
+        try:
+            return await future
+        finally:
+            # Пачка могла закоммитить часть операций и при ошибке - сбрасываем в любом случае
+            self._bump_tables(tables)
+    
+    async def _start_writer(self):
+        """Запуск фоновой задачи писателя (только при group_commit)"""
+        if not self.group_commit or self._writer_task is not None:
+            return
+        self._write_queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._writer_loop(self._write_queue))
+        logger.info(
+            f"✍️ Групповой коммит включен: до {self.commit_batch_size} операций "
+            f"или {self.commit_interval * 1000:.0f} мс на пачку"
+        )
+    
+    async def _stop_writer(self):
+        """Остановка писателя после обработки уже поставленных в очередь операций"""
+        queue, task = self._write_queue, self._writer_task
+        if task is None:
+            return
+        # Новые операции идут напрямую, очередь дорабатывается до сигнала остановки
+        self._write_queue = None
+        self._writer_task = None
+        queue.put_nowait(None)
+        await task
+    
+    async def _writer_loop(self, queue: asyncio.Queue):
+        """Сбор операций в пачки: N операций или T миллисекунд, что наступит раньше"""
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.commit_interval
+            while len(batch) < self.commit_batch_size:
+                try:
+                    item = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            
+            try:
+                await self._commit_batch(batch)
+            except Exception as e:
+                logger.error(f"❌ Ошибка группового коммита: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+    
+    async def _commit_batch(self, batch: List[Tuple[Callable, asyncio.Future]]):
+        """Выполнение пачки операций в одной транзакции с одним коммитом.
+        
+        Каждая операция изолирована точкой сохранения: ошибка одной операции
+        откатывает только ее, остальные попадают в общий коммит.
+        """
+        outcomes = []
+        async with self._connection() as db:
+            await db.execute("BEGIN")
+            for operation, future in batch:
+                await db.execute("SAVEPOINT write_op")
+                try:
+                    result = await operation(db)
+                except Exception as e:
+                    await db.execute("ROLLBACK TO write_op")
+                    await db.execute("RELEASE write_op")
+                    outcomes.append((future, None, e))
+                    continue
+                await db.execute("RELEASE write_op")
+                outcomes.append((future, result, None))
+            await db.commit()
+        
+        # Результаты отдаются только после того, как пачка закоммичена
+        for future, result, error in outcomes:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+    
+    async def initialize(self):
+        """Инициализация базы данных: применение миграций схемы и запуск фоновых задач"""
+        await self.migrations.migrate()
+        await self._load_dimensions()
+        
+        await self._start_read_pool()
+        await self._start_writer()
+        self.migrations.start_backfills()
+        if self._known_users_task is None:
+            self._known_users_task = asyncio.create_task(self._load_known_users())
+        logger.info("✅ Асинхронная база данных инициализирована с системой подтверждения оплаты")
+    
+    async def _load_known_users(self, chunk_size: int = 5000):
+        """Фоновая загрузка известных пользователей пачками по id.
+        
+        До окончания загрузки незнакомые пользователи просто идут обычным путем
+        через базу. Уже записанные путем записи отпечатки не перезаписываются
+        (они свежее прочитанных здесь).
+        """
+        last_id = -2**63
+        try:
+            while True:
+                async with self._read_connection() as db:
+                    cursor = await db.execute("""
+                        SELECT id, username, first_name, last_name, referral_code
+                        FROM users WHERE id > ? ORDER BY id LIMIT ?
+                    """, (last_id, chunk_size))
+                    rows = await cursor.fetchall()
+                    await cursor.close()
+                if not rows:
+                    break
+                for user_id, username, first_name, last_name, referral_code in rows:
+                    if referral_code == f"ref_{user_id}":
+                        fingerprint = KnownUsers.fingerprint(username, first_name, last_name)
+                        self._known_users.add(user_id, fingerprint, overwrite=False)
+                last_id = rows[-1][0]
+                await asyncio.sleep(0)
+            self._known_users.loaded = True
+            logger.info(f"👥 Загружено известных пользователей: {len(self._known_users)}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Ошибка загрузки известных пользователей: {e}")
+    
+    # ===== СПРАВОЧНИКИ ТИПОВ ПОДПИСОК И СПОСОБОВ ОПЛАТЫ =====
+    
+    async def _load_dimensions(self):
+        """Загрузка справочников id <-> код в память"""
+        async with self._connection() as db:
+            for dimension in (self.subscription_types, self.payment_methods):
+                cursor = await db.execute(f"SELECT id, code FROM {dimension.table}")
+                dimension.load(await cursor.fetchall())
+                await cursor.close()
+        logger.info(
+            f"📖 Справочники загружены: {len(self.subscription_types)} типов подписок, "
+            f"{len(self.payment_methods)} способов оплаты"
+        )
+    
+    async def _ensure_codes(self, subscription_type: str, payment_method: Optional[str] = None) -> Tuple[int, Optional[int]]:
+        """id кодов для записи в таблицы фактов; новые коды сначала регистрируются в справочниках.
+        
+        Регистрация идет отдельной закоммиченной записью, и в память пара
+        попадает только после коммита: id из откаченной транзакции мог бы
+        позже достаться другому коду.
+        """
+        wanted = [(self.subscription_types, subscription_type)]
+        if payment_method is not None:
+            wanted.append((self.payment_methods, payment_method))
+        missing = [(dimension, code) for dimension, code in wanted if code not in dimension]
+        
+        if missing:
+            async def operation(db):
+                registered = []
+                for dimension, code in missing:
+                    cursor = await db.execute(f"""
+                        INSERT INTO {dimension.table} (code) VALUES (?)
+                        ON CONFLICT (code) DO UPDATE SET code = excluded.code
+                        RETURNING id
+                    """, (code,))
+                    registered.append((dimension, (await cursor.fetchone())[0], code))
+                    await cursor.close()
+                return registered
+            
+            for dimension, code_id, code in await self._submit_write(operation):
+                dimension.add(code_id, code)
+                logger.info(f"📖 Новый код в справочнике {dimension.table}: {code} (id {code_id})")
+        
+        subscription_type_id = self.subscription_types.id_of(subscription_type)
+        payment_method_id = self.payment_methods.id_of(payment_method) if payment_method is not None else None
+        return subscription_type_id, payment_method_id
+    
+    def _time_column(self, table: str, text_column: str = "created_at") -> str:
+        """Колонка для сортировок и диапазонов по времени создания.
+        
+        created_ts используется, когда фоновый backfill старых строк завершен,
+        до этого - исходная текстовая колонка, чтобы старые строки не выпадали.
+        """
+        if self.migrations.is_backfill_complete(f"{table}_created_ts"):
+            return "created_ts"
+        return text_column
     
     async def get_or_create_user(self, user_id: int, username: str = "", first_name: str = "", last_name: str = "") -> str:
         """Получение или создание пользователя с реферальным кодом"""
-        async with self._lock:
-            async with aiosqlite.connect(self.db_path) as db:
-                # Проверяем, существует ли пользователь
-                cursor = await db.execute("SELECT referral_code FROM users WHERE id = ?", (user_id,))
-                row = await cursor.fetchone()
-                
-                if row:
-                    await cursor.close()
-                    return row[0]
-                
-                # Создаем нового пользователя
-                referral_code = f"ref_{user_id}"
-                
-                await db.execute("""
-                    INSERT OR IGNORE INTO users (id, username, first_name, last_name, referral_code)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (user_id, username, first_name, last_name, referral_code))
-                
-                await db.commit()
-                logger.info(f"✅ Пользователь {user_id} создан в базе данных")
-                return referral_code
+        # Повторный /start с тем же профилем: ответ из памяти, без базы
+        fingerprint = KnownUsers.fingerprint(username, first_name, last_name)
+        if self._known_users.is_current(user_id, fingerprint):
+            return f"ref_{user_id}"
+        
+        username_lower = normalize_username(username)
+        was_known = user_id in self._known_users
+        params = (user_id, username, username_lower, first_name, last_name, f"ref_{user_id}")
+        
+        async def operation(db):
+            try:
+                return await self._upsert_user(db, params)
+            except aiosqlite.IntegrityError:
+                # username_lower занят устаревшей строкой (прежний владелец сменил имя
+                # и еще не заходил) - освобождаем и повторяем
+                if not username_lower:
+                    raise
+                await self._release_username(db, user_id, username_lower)
+                return await self._upsert_user(db, params)
+        
+        referral_code = await self._submit_write(operation, ("users",))
+        # Кэш сбрасывается после коммита, чтобы в него не попало незакоммиченное состояние.
+        # Старое имя из RETURNING не узнать, поэтому записи, указывающие на этого
+        # пользователя, ищутся по значению (только если он мог быть в кэше)
+        self._invalidate_usernames(username_lower)
+        if was_known or not self._known_users.loaded:
+            self._invalidate_user(user_id)
+        if referral_code == f"ref_{user_id}":
+            self._known_users.add(user_id, fingerprint)
+        if not was_known:
+            logger.info(f"✅ Пользователь {user_id} сохранен в базе данных")
+        return referral_code
+    
+    @staticmethod
+    async def _upsert_user(db: aiosqlite.Connection, params: Tuple) -> str:
+        """Создание пользователя или обновление username/имени одним запросом, возвращает referral_code"""
+        cursor = await db.execute(f"""
+            INSERT INTO users (id, username, username_lower, first_name, last_name, referral_code, created_ts)
+            VALUES (?, ?, ?, ?, ?, ?, {EPOCH_NOW_SQL})
+            ON CONFLICT (id) DO UPDATE SET
+                username = excluded.username,
+                username_lower = excluded.username_lower,
+                first_name = excluded.first_name,
+                last_name = excluded.last_name
+            RETURNING referral_code
+        """, params)
+        row = await cursor.fetchone()
+        await cursor.close()
+        return row[0]
+    
+    # ===== ПОИСК ПО USERNAME (БЕЗ УЧЕТА РЕГИСТРА, С КЭШЕМ) =====
+    
+    @staticmethod
+    async def _release_username(db: aiosqlite.Connection, user_id: int, username_lower: str):
+        """Освобождение username у другой строки (прежний владелец сменил имя и еще не заходил)"""
+        await db.execute("""
+            UPDATE users SET username_lower = NULL WHERE username_lower = ? AND id != ?
+        """, (username_lower, user_id))
+    
+    def _invalidate_usernames(self, *usernames: Optional[str]):
+        """Сброс записей кэша username -> user_id после изменения в базе"""
+        keys = [name for name in usernames if name]
+        if not keys:
+            return
+        self._username_generation += 1
+        self._username_cache.invalidate(*keys)
+    
+    def _invalidate_user(self, user_id: int):
+        """Сброс всех записей кэша username -> user_id, указывающих на пользователя"""
+        self._username_generation += 1
+        self._username_cache.invalidate_value(user_id)
+    
+    async def resolve_username(self, username: str) -> Optional[int]:
+        """user_id по username без учета регистра и @ (из кэша, при промахе - по индексу)"""
+        username_lower = normalize_username(username)
+        if not username_lower:
+            return None
+        
+        user_id = self._username_cache.get(username_lower)
+        if user_id is not None:
+            return user_id
+        
+        generation = self._username_generation
+        async with self._read_connection() as db:
+            cursor = await db.execute("SELECT id FROM users WHERE username_lower = ?", (username_lower,))
+            row = await cursor.fetchone()
+            await cursor.close()
+        if row is None:
+            return None
+        # Если пока шло чтение username поменялся, результат может быть устаревшим - не кэшируем
+        if generation == self._username_generation:
+            self._username_cache.set(username_lower, row[0])
+        return row[0]
     
     async def get_user_by_username(self, username: str) -> Optional[Dict]:
         """Поиск пользователя по username для автоотправки ссылок"""
-        async with self._lock:
-            async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute(
-                    "SELECT id, username, first_name, last_name, referral_code, created_at FROM users WHERE username = ?",
-                    (username,)
-                )
-                row = await cursor.fetchone()
-                await cursor.close()
-                if row:
-                    return {
-                        'id': row[0],
-                        'username': row[1],
-                        'first_name': row[2],
-                        'last_name': row[3],
-                        'referral_code': row[4],
-                        'created_at': row[5]
-                    }
-                return None
+        user_id = await self.resolve_username(username)
+        if user_id is None:
+            return None
+        
+        async with self._read_connection() as db:
+            cursor = await db.execute(
+                "SELECT id, username, first_name, last_name, referral_code, created_at FROM users WHERE id = ?",
+                (user_id,)
+            )
+            row = await cursor.fetchone()
+            await cursor.close()
+            if row:
+                return {
+                    'id': row[0],
+                    'user_id': row[0],
+                    'username': row[1],
+                    'first_name': row[2],
+                    'last_name': row[3],
+                    'referral_code': row[4],
+                    'created_at': row[5]
+                }
+        
+        self._invalidate_usernames(normalize_username(username))
+        return None
     
     async def save_pending_referral(self, user_id: int, referrer_id: int):
         """Сохранение информации о временном реферале"""
-        async with self._lock:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute("""
-                    INSERT OR REPLACE INTO pending_referrals (user_id, referrer_id)
-                    VALUES (?, ?)
-                """, (user_id, referrer_id))
-                await db.commit()
-                logger.info(f"⏳ Ожидающий реферер сохранен: пользователь {user_id} от {referrer_id}")
+        async def operation(db):
+            await db.execute("""
+                INSERT OR REPLACE INTO pending_referrals (user_id, referrer_id)
+                VALUES (?, ?)
+            """, (user_id, referrer_id))
+        
+        await self._submit_write(operation, ("pending_referrals",))
+        logger.info(f"⏳ Ожидающий реферер сохранен: пользователь {user_id} от {referrer_id}")
+    
+    async def create_pending_referral(self, referrer_id: int, user_id: int, username: str = ""):
+        """Ожидающий реферал из /start по реферальной ссылке (связь фиксируется после оплаты)"""
+        await self.save_pending_referral(user_id, referrer_id)
     
     async def get_pending_referrer(self, user_id: int) -> Optional[int]:
         """Получение ожидающего реферера"""
-        async with self._lock:
-            async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute("""
-                    SELECT referrer_id FROM pending_referrals WHERE user_id = ?
-                """, (user_id,))
-                row = await cursor.fetchone()
-                await cursor.close()
-                return row[0] if row else None
+        async with self._read_connection() as db:
+            cursor = await db.execute("""
+                SELECT referrer_id FROM pending_referrals WHERE user_id = ?
+            """, (user_id,))
+            row = await cursor.fetchone()
+            await cursor.close()
+            return row[0] if row else None
     
     async def remove_pending_referral(self, user_id: int):
         """Удаление записи об ожидающем реферале"""
-        async with self._lock:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute("DELETE FROM pending_referrals WHERE user_id = ?", (user_id,))
-                await db.commit()
+        async with self._connection() as db:
+            await db.execute("DELETE FROM pending_referrals WHERE user_id = ?", (user_id,))
+            await db.commit()
+        self._bump_tables(("pending_referrals",))
     
     async def add_referral(self, referrer_id: int, referred_id: int) -> bool:
         """Добавление реферала с предотвращением дублирования"""
         if referrer_id == referred_id:
             return False
         
-        async with self._lock:
-            async with aiosqlite.connect(self.db_path) as db:
-                try:
-                    # Проверяем, не существует ли уже такая связь
-                    cursor = await db.execute("""
-                        SELECT id FROM referrals WHERE referrer_id = ? AND referred_id = ?
-                    """, (referrer_id, referred_id))
-                    
-                    if await cursor.fetchone():
-                        await cursor.close()
-                        logger.warning(f"⚠️ Реферал уже существует: {referred_id} от {referrer_id}")
-                        return False
-                    
-                    await cursor.close()
-                    
-                    # Добавляем новый реферал
-                    await db.execute("""
-                        INSERT INTO referrals (referrer_id, referred_id)
-                        VALUES (?, ?)
-                    """, (referrer_id, referred_id))
-                    
-                    await db.commit()
-                    logger.info(f"✅ Реферал добавлен: {referred_id} от {referrer_id}")
-                    return True
-                    
-                except Exception as e:
-                    logger.error(f"❌ Ошибка добавления реферала: {e}")
-                    return False
+        async def operation(db):
+            # Вставка и проверка дубликата одним запросом: при существующей связи строка не возвращается
+            cursor = await db.execute("""
+                INSERT INTO referrals (referrer_id, referred_id)
+                VALUES (?, ?)
+                ON CONFLICT (referrer_id, referred_id) DO NOTHING
+                RETURNING id
+            """, (referrer_id, referred_id))
+            row = await cursor.fetchone()
+            await cursor.close()
+            return row is not None
+        
+        try:
+            added = await self._submit_write(operation, ("referrals",))
+        except Exception as e:
+            logger.error(f"❌ Ошибка добавления реферала: {e}")
+            return False
+        
+        if added:
+            logger.info(f"✅ Реферал добавлен: {referred_id} от {referrer_id}")
+        else:
+            logger.warning(f"⚠️ Реферал уже существует: {referred_id} от {referrer_id}")
+        return added
     
+    @cached_query
     async def get_user_referrals_count(self, user_id: int) -> int:
         """Получение количества рефералов пользователя"""
-        async with self._lock:
-            async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute("""
-                    SELECT COUNT(*) FROM referrals WHERE referrer_id = ?
-                """, (user_id,))
-                row = await cursor.fetchone()
-                await cursor.close()
-                return row[0] if row else 0
+        async with self._read_connection() as db:
+            cursor = await db.execute("""
+                SELECT COUNT(*) FROM referrals WHERE referrer_id = ?
+            """, (user_id,))
+            row = await cursor.fetchone()
+            await cursor.close()
+            return row[0] if row else 0
     
+    @cached_query
     async def get_user_referral_earnings(self, user_id: int) -> float:
         """Получение заработка пользователя с рефералов"""
-        async with self._lock:
-            async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute("""
-                    SELECT COALESCE(SUM(commission_amount), 0) 
-                    FROM referral_earnings 
-                    WHERE referrer_id = ? AND payment_method = 'TON'
-                """, (user_id,))
-                row = await cursor.fetchone()
-                await cursor.close()
-                return float(row[0]) if row else 0.0
+        ton_id = self.payment_methods.id_of('TON')
+        async with self._read_connection() as db:
+            # Из предагрегата: строки referral_earnings могут быть перенесены в архив
+            cursor = await db.execute("""
+                SELECT COALESCE(SUM(commission_sum), 0) 
+                FROM referral_rollup 
+                WHERE referrer_id = ? AND payment_method_id = ?
+            """, (user_id, ton_id))
+            row = await cursor.fetchone()
+            await cursor.close()
+            return float(row[0]) if row else 0.0
     
+    @cached_query
     async def get_user_referral_stats(self, user_id: int) -> str:
-        """Получение детальной статистики рефералов пользователя"""
-        async with self._lock:
-            async with aiosqlite.connect(self.db_path) as db:
-                # Получаем информацию о рефералах
-                cursor = await db.execute("""
-                    SELECT 
-                        COUNT(r.id) as total_referrals,
-                        COALESCE(SUM(re.commission_amount), 0) as total_earnings,
-                        COUNT(CASE WHEN re.payment_method = 'TON' THEN 1 END) as ton_referrals,
-                        COUNT(CASE WHEN re.payment_method = 'STARS' THEN 1 END) as stars_referrals
-                    FROM users u
-                    LEFT JOIN referrals r ON u.id = r.referred_id
-                    LEFT JOIN referral_earnings re ON r.id = re.referred_id
-                    WHERE u.id = ?
-                """, (user_id,))
-                
-                row = await cursor.fetchone()
-                await cursor.close()
-                
-                if not row or row[0] == 0:
-                    return "У вас пока нет рефералов."
-                
-                total_referrals, total_earnings, ton_referrals, stars_referrals = row
-                
-                return f"""📊 Статистика рефералов:
+        """Получение детальной статистики рефералов пользователя
+
+        Считается по строкам referral_earnings рабочей базы: комиссии, перенесенные
+        в архив (db_archive), сюда не входят - остается последняя по каждой паре
+        """
+        ton_id = self.payment_methods.id_of('TON')
+        stars_id = self.payment_methods.id_of('STARS')
+        async with self._read_connection() as db:
+            # Получаем информацию о рефералах
+            cursor = await db.execute("""
+                SELECT 
+                    COUNT(r.id) as total_referrals,
+                    COALESCE(SUM(re.commission_amount), 0) as total_earnings,
+                    COUNT(CASE WHEN re.payment_method_id = ? THEN 1 END) as ton_referrals,
+                    COUNT(CASE WHEN re.payment_method_id = ? THEN 1 END) as stars_referrals
+                FROM users u
+                LEFT JOIN referrals r ON u.id = r.referred_id
+                LEFT JOIN referral_earnings re ON r.referred_id = re.referred_id
+                WHERE u.id = ?
+            """, (ton_id, stars_id, user_id))
+            
+            row = await cursor.fetchone()
+            await cursor.close()
+            
+            if not row or row[0] == 0:
+                return "У вас пока нет рефералов."
+            
+            total_referrals, total_earnings, ton_referrals, stars_referrals = row
+            
+            return f"""📊 Статистика рефералов:
 👥 Всего рефералов: {total_referrals}
 💰 Заработано TON: {total_earnings:.2f}
 💎 TON рефералов: {ton_referrals}
@@ -267,9 +778,7 @@ class AsyncDatabaseManager:
     
     async def calculate_commission(self, subscription_amount: float, subscription_type: str, payment_method: str) -> float:
         """Расчет комиссии для реферала (только для TON-подписок)"""
-        if payment_method.upper() == 'TON':
-            return round(subscription_amount * 0.10, 2)  # 10% комиссия
-        return 0.0  # За Stars подписки комиссия не начисляется
+        return subscription_commission(subscription_amount, payment_method)
     
     async def add_referral_earnings(self, referrer_id: int, referred_id: int, commission_amount: float, 
                                   subscription_type: str, payment_method: str):
@@ -277,144 +786,234 @@ class AsyncDatabaseManager:
         if commission_amount <= 0:
             return
         
-        async with self._lock:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute("""
-                    INSERT INTO referral_earnings 
-                    (referrer_id, referred_id, commission_amount, subscription_type, payment_method)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (referrer_id, referred_id, commission_amount, subscription_type, payment_method))
-                await db.commit()
-                logger.info(f"💰 Комиссия {commission_amount} TON начислена рефереру {referrer_id}")
+        subscription_type_id, payment_method_id = await self._ensure_codes(subscription_type, payment_method)
+        
+        async def operation(db):
+            await db.execute(f"""
+                INSERT INTO referral_earnings 
+                (referrer_id, referred_id, commission_amount, subscription_type_id, payment_method_id, created_ts)
+                VALUES (?, ?, ?, ?, ?, {EPOCH_NOW_SQL})
+            """, (referrer_id, referred_id, commission_amount, subscription_type_id, payment_method_id))
+        
+        await self._submit_write(operation, ("referral_earnings",))
+        logger.info(f"💰 Комиссия {commission_amount} TON начислена рефереру {referrer_id}")
     
+    async def _get_counter(self, name: str) -> float:
+        """Значение глобального счетчика из таблицы counters (поддерживается триггерами)"""
+        async with self._read_connection() as db:
+            cursor = await db.execute("SELECT value FROM counters WHERE name = ?", (name,))
+            row = await cursor.fetchone()
+            await cursor.close()
+            return row[0] if row else 0
+    
+    @cached_query
     async def get_all_users_count(self) -> int:
         """Получение общего количества пользователей"""
-        async with self._lock:
-            async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute("SELECT COUNT(*) FROM users")
-                row = await cursor.fetchone()
-                await cursor.close()
-                return row[0] if row else 0
+        return int(await self._get_counter('users'))
     
+    @cached_query
     async def get_total_referrals_count(self) -> int:
         """Получение общего количества рефералов"""
-        async with self._lock:
-            async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute("SELECT COUNT(*) FROM referrals")
-                row = await cursor.fetchone()
-                await cursor.close()
-                return row[0] if row else 0
+        return int(await self._get_counter('referrals'))
     
+    @cached_query
     async def get_total_commission_earned(self) -> float:
         """Получение общего заработанного TON по комиссиям"""
-        async with self._lock:
-            async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute("""
-                    SELECT COALESCE(SUM(commission_amount), 0) 
-                    FROM referral_earnings 
-                    WHERE payment_method = 'TON'
-                """)
-                row = await cursor.fetchone()
-                await cursor.close()
-                return float(row[0]) if row else 0.0
+        return round(float(await self._get_counter('commission_ton')), 2)
     
+    @cached_query
     async def get_subscribers(self) -> List[Dict]:
         """Получение списка подписчиков"""
-        async with self._lock:
-            async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute("""
-                    SELECT 
-                        u.id,
-                        u.username,
-                        u.first_name,
-                        u.last_name,
-                        s.subscription_type,
-                        s.status
-                    FROM users u
-                    LEFT JOIN subscriptions s ON u.id = s.user_id
-                    ORDER BY u.created_at DESC
+        order_column = self._time_column("users")
+        async with self._read_connection() as db:
+            # Сначала 20 последних пользователей по индексу времени, потом их подписки
+            cursor = await db.execute(f"""
+                SELECT 
+                    u.id,
+                    u.username,
+                    u.first_name,
+                    u.last_name,
+                    s.subscription_type_id,
+                    s.status
+                FROM (
+                    SELECT id, username, first_name, last_name, {order_column} as created
+                    FROM users
+                    ORDER BY {order_column} DESC, id DESC
                     LIMIT 20
-                """)
-                rows = await cursor.fetchall()
-                await cursor.close()
-                
-                subscribers = []
-                for row in rows:
-                    subscribers.append({
-                        'id': row[0],
-                        'username': row[1] or 'Нет',
-                        'name': f"{row[2] or ''} {row[3] or ''}".strip() or 'Нет имени',
-                        'subscription': row[4] or 'Не подписан',
-                        'status': row[5] or 'pending'
-                    })
-                
-                return subscribers
+                ) u
+                LEFT JOIN subscriptions s ON u.id = s.user_id
+                ORDER BY u.created DESC, u.id DESC, s.id
+                LIMIT 20
+            """)
+            rows = await cursor.fetchall()
+            await cursor.close()
+            
+            subscribers = []
+            for row in rows:
+                subscribers.append({
+                    'id': row[0],
+                    'username': row[1] or 'Нет',
+                    'name': f"{row[2] or ''} {row[3] or ''}".strip() or 'Нет имени',
+                    'subscription': self.subscription_types.code_of(row[4]) or 'Не подписан',
+                    'status': row[5] or 'pending'
+                })
+            
+            return subscribers
     
+    @cached_query
     async def get_referral_stats(self) -> List[Dict]:
         """Получение статистики рефералов по реферерам"""
-        async with self._lock:
-            async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute("""
+        async with self._read_connection() as db:
+            # Рефералы и комиссии агрегируются отдельно и соединяются по реферерам,
+            # без размножения строк referrals × referral_earnings. Комиссии берутся
+            # из предагрегата: старые строки referral_earnings уходят в архив
+            cursor = await db.execute("""
+                SELECT 
+                    u.username,
+                    r.referrer_id,
+                    r.total_referrals,
+                    COALESCE(e.commission, 0) as commission
+                FROM (
+                    SELECT referrer_id, COUNT(*) as total_referrals
+                    FROM referrals
+                    GROUP BY referrer_id
+                ) r
+                JOIN users u ON u.id = r.referrer_id
+                LEFT JOIN (
+                    SELECT referrer_id, SUM(commission_sum) as commission
+                    FROM referral_rollup
+                    GROUP BY referrer_id
+                ) e ON e.referrer_id = r.referrer_id
+                ORDER BY r.total_referrals DESC
+                LIMIT 10
+            """)
+            rows = await cursor.fetchall()
+            await cursor.close()
+            
+            stats = []
+            for row in rows:
+                stats.append({
+                    'username': row[0] or f"ID:{row[1]}",
+                    'total_referrals': row[2],
+                    'commission': round(float(row[3]), 2)
+                })
+            
+            return stats
+    
+    @cached_query
+    async def get_user_referral_stats_by_type(self, user_id: int, subscription_type: str) -> Dict:
+        """Статистика оплативших рефералов пользователя по типу подписки (TON)"""
+        subscription_type_id = self.subscription_types.id_of(subscription_type)
+        ton_id = self.payment_methods.id_of('TON')
+        if subscription_type_id is None or ton_id is None:
+            return {'count': 0, 'total_commission': 0.0}
+        
+        async with self._read_connection() as db:
+            # Одна строка предагрегата referral_rollup по первичному ключу
+            cursor = await db.execute("""
+                SELECT referral_count, commission_sum
+                FROM referral_rollup
+                WHERE referrer_id = ? 
+                AND subscription_type_id = ?
+                AND payment_method_id = ?
+            """, (user_id, subscription_type_id, ton_id))
+            row = await cursor.fetchone()
+            await cursor.close()
+            
+            if row:
+                return {
+                    'count': row[0],
+                    'total_commission': round(float(row[1]), 2)
+                }
+            return {'count': 0, 'total_commission': 0.0}
+    
+    @cached_query
+    async def get_admin_referral_stats_by_type(self, subscription_type: str) -> Dict:
+        """Детальная статистика рефереров по типу подписки для админов"""
+        subscription_type_id = self.subscription_types.id_of(subscription_type)
+        if subscription_type_id is None:
+            return {'total_count': 0, 'total_commission': 0.0, 'referrers': []}
+        
+        async with self._read_connection() as db:
+            # Строки предагрегата referral_rollup по типу подписки, имена подтягиваются после
+            cursor = await db.execute("""
+                SELECT 
+                    e.referrer_id,
+                    u.username,
+                    u.first_name,
+                    e.referral_count,
+                    e.total_commission
+                FROM (
                     SELECT 
-                        u.username,
-                        u.first_name,
-                        COUNT(r.id) as total_referrals,
-                        COALESCE(SUM(re.commission_amount), 0) as commission
-                    FROM users u
-                    LEFT JOIN referrals r ON u.id = r.referrer_id
-                    LEFT JOIN referral_earnings re ON r.referred_id = re.referred_id
-                    GROUP BY u.id
-                    HAVING COUNT(r.id) > 0
-                    ORDER BY total_referrals DESC
-                    LIMIT 10
-                """)
-                rows = await cursor.fetchall()
-                await cursor.close()
-                
-                stats = []
-                for row in rows:
-                    stats.append({
-                        'username': row[0] or f"ID:{row[1]}",
-                        'total_referrals': row[2],
-                        'commission': float(row[3])
-                    })
-                
-                return stats
+                        referrer_id,
+                        SUM(referral_count) as referral_count,
+                        SUM(commission_sum) as total_commission
+                    FROM referral_rollup
+                    WHERE subscription_type_id = ?
+                    GROUP BY referrer_id
+                    HAVING SUM(referral_count) > 0
+                ) e
+                LEFT JOIN users u ON u.id = e.referrer_id
+                ORDER BY e.total_commission DESC, e.referral_count DESC
+            """, (subscription_type_id,))
+            rows = await cursor.fetchall()
+            await cursor.close()
+            
+            referrers = []
+            for row in rows:
+                referrers.append({
+                    'user_id': row[0],
+                    'username': row[1] or row[2] or f"ID:{row[0]}",
+                    'count': row[3],
+                    'commission': round(float(row[4]), 2)
+                })
+            
+            return {
+                'total_count': sum(referrer['count'] for referrer in referrers),
+                'total_commission': round(sum(float(row[4]) for row in rows), 2),
+                'referrers': referrers
+            }
     
     async def add_subscription(self, user_id: int, subscription_type: str, payment_method: str, 
                              amount: float, currency: str = 'TON') -> bool:
-        """Добавление подписки с автоматическим начислением реферальной комиссии"""
+        """Добавление подписки с автоматическим начислением реферальной комиссии.
+        
+        Подписка, комиссия рефереру и удаление ожидающего реферала
+        выполняются в одной транзакции с одним коммитом.
+        """
         try:
-            async with self._lock:
-                async with aiosqlite.connect(self.db_path) as db:
-                    # Добавляем подписку
-                    cursor = await db.execute("""
-                        INSERT INTO subscriptions 
-                        (user_id, subscription_type, payment_method, amount, currency, status)
-                        VALUES (?, ?, ?, ?, ?, 'confirmed')
-                    """, (user_id, subscription_type, payment_method, amount, currency))
-                    
-                    # Проверяем, есть ли ожидающий реферер
-                    pending_referrer = await self.get_pending_referrer(user_id)
-                    
-                    if pending_referrer and payment_method.upper() == 'TON':
-                        # Начисляем комиссию только за TON-подписки
-                        commission = await self.calculate_commission(amount, subscription_type, payment_method)
-                        
-                        # Добавляем запись о заработке
-                        await self.add_referral_earnings(
-                            pending_referrer, user_id, commission, subscription_type, payment_method
-                        )
-                        
-                        # Удаляем ожидающего реферера
-                        await self.remove_pending_referral(user_id)
-                        
-                        logger.info(f"💰 Комиссия {commission} TON начислена рефереру {pending_referrer}")
-                    
-                    await db.commit()
-                    logger.info(f"✅ Подписка добавлена для пользователя {user_id}")
-                    return True
+            commission = await self.calculate_commission(amount, subscription_type, payment_method)
+            subscription_type_id, payment_method_id = await self._ensure_codes(subscription_type, payment_method)
+            pending_referrer = None
+            
+            async with self.transaction(("subscriptions", "referral_earnings", "pending_referrals")) as tx:
+                # Добавляем подписку
+                await tx.execute(f"""
+                    INSERT INTO subscriptions 
+                    (user_id, subscription_type_id, payment_method_id, amount, currency, status, created_ts)
+                    VALUES (?, ?, ?, ?, ?, 'confirmed', {EPOCH_NOW_SQL})
+                """, (user_id, subscription_type_id, payment_method_id, amount, currency))
+                
+                if payment_method.upper() == 'TON':
+                    # Забираем ожидающего реферера (чтение и удаление одним запросом)
+                    row = await tx.fetchone("""
+                        DELETE FROM pending_referrals WHERE user_id = ? RETURNING referrer_id
+                    """, (user_id,))
+                    pending_referrer = row[0] if row else None
                     
+                    # Начисляем комиссию только за TON-подписки
+                    if pending_referrer and commission > 0:
+                        await tx.execute(f"""
+                            INSERT INTO referral_earnings 
+                            (referrer_id, referred_id, commission_amount, subscription_type_id, payment_method_id, created_ts)
+                            VALUES (?, ?, ?, ?, ?, {EPOCH_NOW_SQL})
+                        """, (pending_referrer, user_id, commission, subscription_type_id, payment_method_id))
+            
+            if pending_referrer and commission > 0:
+                logger.info(f"💰 Комиссия {commission} TON начислена рефереру {pending_referrer}")
+            logger.info(f"✅ Подписка добавлена для пользователя {user_id}")
+            return True
+                
         except Exception as e:
             logger.error(f"❌ Ошибка добавления подписки: {e}")
             return False
@@ -423,124 +1022,144 @@ class AsyncDatabaseManager:
     
     async def save_confirmation_log(self, log_data: Dict):
         """Сохранение лога подтверждения оплаты"""
+        async def operation(db):
+            await db.execute(f"""
+                INSERT INTO confirmation_logs (admin_id, subscription_type_id, username, link_id, created_ts)
+                VALUES (?, ?, ?, ?, {EPOCH_NOW_SQL})
+            """, (
+                log_data.get('admin_id'),
+                subscription_type_id,
+                log_data.get('username'),
+                log_data.get('link_id')
+            ))
+            # Дневная корзина для статистики подтверждений
+            await db.execute("""
+                INSERT INTO confirmation_daily (day, subscription_type_id, count)
+                VALUES (DATE('now'), ?, 1)
+                ON CONFLICT (day, subscription_type_id) DO UPDATE SET count = count + 1
+            """, (subscription_type_id,))
+        
         try:
-            async with self._lock:
-                async with aiosqlite.connect(self.db_path) as db:
-                    await db.execute("""
-                        INSERT INTO confirmation_logs (admin_id, subscription_type, username, link_id)
-                        VALUES (?, ?, ?, ?)
-                    """, (
-                        log_data.get('admin_id'),
-                        log_data.get('subscription_type'),
-                        log_data.get('username'),
-                        log_data.get('link_id')
-                    ))
-                    await db.commit()
-                    logger.info(f"📝 Лог подтверждения сохранен: {log_data.get('username')}")
-                    
+            subscription_type_id, _ = await self._ensure_codes(log_data.get('subscription_type'))
+            await self._submit_write(operation, ("confirmation_logs",))
+            logger.info(f"📝 Лог подтверждения сохранен: {log_data.get('username')}")
+            
         except Exception as e:
             logger.error(f"❌ Ошибка сохранения лога подтверждения: {e}")
             raise e
     
+    @cached_query
     async def get_recent_confirmation_logs(self, limit: int = 10) -> List[Dict]:
         """Получение последних логов подтверждений"""
         try:
-            async with self._lock:
-                async with aiosqlite.connect(self.db_path) as db:
-                    cursor = await db.execute("""
-                        SELECT admin_id, subscription_type, username, link_id, timestamp
-                        FROM confirmation_logs
-                        ORDER BY timestamp DESC
-                        LIMIT ?
-                    """, (limit,))
-                    
-                    rows = await cursor.fetchall()
-                    await cursor.close()
-                    
-                    logs = []
-                    for row in rows:
-                        logs.append({
-                            'admin_id': row[0],
-                            'subscription_type': row[1],
-                            'username': row[2],
-                            'link_id': row[3],
-                            'timestamp': row[4]
-                        })
-                    
-                    logger.info(f"📊 Получено {len(logs)} логов подтверждений")
-                    return logs
-                    
+            order_column = self._time_column("confirmation_logs", "timestamp")
+            async with self._read_connection() as db:
+                cursor = await db.execute(f"""
+                    SELECT admin_id, subscription_type_id, username, link_id, timestamp
+                    FROM confirmation_logs
+                    ORDER BY {order_column} DESC
+                    LIMIT ?
+                """, (limit,))
+                
+                rows = await cursor.fetchall()
+                await cursor.close()
+                
+                logs = []
+                for row in rows:
+                    logs.append({
+                        'admin_id': row[0],
+                        'subscription_type': self.subscription_types.code_of(row[1]),
+                        'username': row[2],
+                        'link_id': row[3],
+                        'timestamp': row[4]
+                    })
+                
+                logger.info(f"📊 Получено {len(logs)} логов подтверждений")
+                return logs
+                
         except Exception as e:
             logger.error(f"❌ Ошибка получения логов подтверждений: {e}")
             return []
     
+    @cached_query
     async def get_confirmation_stats(self) -> Dict:
-        """Получение статистики подтверждений"""
+        """Получение статистики подтверждений (из дневных корзин confirmation_daily)"""
         try:
-            async with self._lock:
-                async with aiosqlite.connect(self.db_path) as db:
-                    # Общая статистика
-                    cursor = await db.execute("SELECT COUNT(*) FROM confirmation_logs")
-                    total = (await cursor.fetchone())[0]
-                    await cursor.close()
-                    
-                    # Подтверждения сегодня
-                    cursor = await db.execute("""
-                        SELECT COUNT(*) FROM confirmation_logs 
-                        WHERE DATE(timestamp) = DATE('now')
-                    """)
-                    today = (await cursor.fetchone())[0]
-                    await cursor.close()
-                    
-                    # Подтверждения за неделю
-                    cursor = await db.execute("""
-                        SELECT COUNT(*) FROM confirmation_logs 
-                        WHERE timestamp >= datetime('now', '-7 days')
-                    """)
-                    week = (await cursor.fetchone())[0]
-                    await cursor.close()
-                    
-                    # Самая популярная подписка
-                    cursor = await db.execute("""
-                        SELECT subscription_type, COUNT(*) as count
-                        FROM confirmation_logs
-                        GROUP BY subscription_type
-                        ORDER BY count DESC
-                        LIMIT 1
-                    """)
-                    popular = await cursor.fetchone()
-                    await cursor.close()
-                    
-                    popular_subscription = "нет данных"
-                    if popular:
-                        subscription_names = {
-                            "25_stars": "⭐ 25 звезд",
-                            "50_stars": "⭐ 50 звезд", 
-                            "75_stars": "⭐ 75 звезд",
-                            "100_stars": "⭐ 100 звезд",
-                            "150_ton": "💎 150 TON",
-                            "100_ton": "💎 100 TON",
-                            "50_ton": "💎 50 TON"
-                        }
-                        display_name = subscription_names.get(popular[0], popular[0])
-                        popular_subscription = f"{display_name} ({popular[1]} раз)"
-                    
-                    stats = {
-                        'total': total,
-                        'today': today,
-                        'week': week,
-                        'popular_subscription': popular_subscription
-                    }
-                    
-                    logger.info(f"📈 Статистика подтверждений: {stats}")
-                    return stats
-                    
+            async with self._read_connection() as db:
+                # Всего / сегодня / за последние 7 календарных дней одним проходом по корзинам
+                cursor = await db.execute("""
+                    SELECT 
+                        COALESCE(SUM(count), 0),
+                        COALESCE(SUM(CASE WHEN day = DATE('now') THEN count END), 0),
+                        COALESCE(SUM(CASE WHEN day > DATE('now', '-7 days') THEN count END), 0)
+                    FROM confirmation_daily
+                """)
+                total, today, week = await cursor.fetchone()
+                await cursor.close()
+                
+                # Самая популярная подписка
+                cursor = await db.execute("""
+                    SELECT subscription_type_id, SUM(count) as count
+                    FROM confirmation_daily
+                    GROUP BY subscription_type_id
+                    ORDER BY count DESC
+                    LIMIT 1
+                """)
+                popular = await cursor.fetchone()
+                await cursor.close()
+                
+                popular_subscription = "нет данных"
+                if popular:
+                    code = self.subscription_types.code_of(popular[0])
+                    display_name = SUBSCRIPTION_DISPLAY_NAMES.get(code, code)
+                    popular_subscription = f"{display_name} ({popular[1]} раз)"
+                
+                stats = {
+                    'total': total,
+                    'today': today,
+                    'week': week,
+                    'popular_subscription': popular_subscription
+                }
+                
+                logger.info(f"📈 Статистика подтверждений: {stats}")
+                return stats
+                
         except Exception as e:
             logger.error(f"❌ Ошибка получения статистики подтверждений: {e}")
             return {}
     
+    async def set_profiler(self, profiler: Optional[StatementProfiler]):
+        """Включение (или выключение - None) профилирования SQL на открытых соединениях"""
+        previous, self.profiler = self.profiler, profiler
+        async with self._lock:
+            connections = list(self._readers)
+            if self._is_connection_alive(self._db):
+                connections.append(self._db)
+            # Колбэки ставятся заданиями в потоке соединения, между запросами
+            for db in connections:
+                if previous is not None:
+                    await previous.detach(db)
+                if profiler is not None:
+                    await profiler.attach(db)
+    
     async def close(self):
         """Корректное закрытие соединения с базой данных"""
+        if self.profiler is not None and self.profiler.statements:
+            logger.info(f"📈 Профиль SQL:\n{self.profiler.format_top(10)}")
+        await self.migrations.stop()
+        task, self._known_users_task = self._known_users_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self._stop_writer()
+        readers, self._readers, self._read_pool = self._readers, [], None
+        for db in readers:
+            await self._close_quietly(db)
+        async with self._lock:
+            await self._discard_connection()
         logger.info("🔒 Асинхронная база данных закрыта")
     
     async def create_user(self, user):
@@ -563,93 +1182,166 @@ class AsyncDatabaseManager:
             'stars_revenue': 0  # Здесь можно добавить реальную логику
         }
     
+    @cached_query
     async def get_all_users(self, limit=20):
         """Получение списка всех пользователей"""
-        async with self._lock:
-            async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute("""
-                    SELECT id, username, created_at 
-                    FROM users 
-                    ORDER BY created_at DESC 
+        order_column = self._time_column("users")
+        async with self._read_connection() as db:
+            cursor = await db.execute(f"""
+                SELECT id, username, created_at 
+                FROM users 
+                ORDER BY {order_column} DESC, id DESC 
+                LIMIT ?
+            """, (limit,))
+            rows = await cursor.fetchall()
+            await cursor.close()
+            
+            users = []
+            for row in rows:
+                users.append({
+                    'user_id': row[0],
+                    'username': row[1] or 'без username',
+                    'created_at': str(row[2])
+                })
+            
+            return users
+    
+    async def iter_users(self, batch_size: int = 1000, filter: Optional[str] = None) -> AsyncIterator[Dict]:
+        """Потоковый обход всех пользователей пачками по id (keyset-пагинация).
+        
+        Пример:
+            async for user in db.iter_users(batch_size=500, filter="subscribed"):
+                await send(user['user_id'])
+        
+        В памяти одновременно не больше одной пачки. Соединение занято только
+        на время чтения пачки, между пачками потребитель может делать что угодно.
+        filter - имя сегмента из USER_FILTERS (по умолчанию все пользователи).
+        """
+        condition = USER_FILTERS.get(filter or "all")
+        if condition is None:
+            raise ValueError(f"Неизвестный фильтр пользователей: {filter}")
+        batch_size = max(1, batch_size)
+        
+        last_id = -2**63
+        while True:
+            async with self._read_connection() as db:
+                cursor = await db.execute(f"""
+                    SELECT u.id, u.username, u.first_name, u.last_name, u.created_at
+                    FROM users u
+                    WHERE u.id > ? AND {condition}
+                    ORDER BY u.id
                     LIMIT ?
-                """, (limit,))
+                """, (last_id, batch_size))
                 rows = await cursor.fetchall()
                 await cursor.close()
-                
-                users = []
-                for row in rows:
-                    users.append({
-                        'user_id': row[0],
-                        'username': row[1] or 'без username',
-                        'created_at': str(row[2])
-                    })
-                
-                return users
+            
+            for row in rows:
+                yield {
+                    'user_id': row[0],
+                    'username': row[1] or '',
+                    'first_name': row[2] or '',
+                    'last_name': row[3] or '',
+                    'created_at': str(row[4])
+                }
+            
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
     
-    async def get_referral_stats(self):
-        """Получение реферальной статистики"""
-        async with self._lock:
-            async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute("""
-                    SELECT COUNT(*) FROM referrals
-                """)
-                total_referrals = (await cursor.fetchone())[0]
-                await cursor.close()
-                
-                cursor = await db.execute("""
-                    SELECT COALESCE(SUM(commission_amount), 0) 
-                    FROM referral_earnings 
-                    WHERE payment_method = 'TON'
-                """)
-                total_revenue = (await cursor.fetchone())[0]
-                await cursor.close()
-                
-                # Топ рефереров
-                cursor = await db.execute("""
-                    SELECT 
-                        u.id as referrer_user_id,
-                        u.username as referrer_username,
-                        COUNT(r.id) as referral_count
-                    FROM users u
-                    LEFT JOIN referrals r ON u.id = r.referrer_id
-                    GROUP BY u.id
-                    ORDER BY referral_count DESC
-                    LIMIT 10
-                """)
-                top_referrers = []
+    async def iter_table(self, table: str, batch_size: int = 1000) -> AsyncIterator[List[Tuple]]:
+        """Потоковый обход таблицы из EXPORT_TABLES пачками по id (keyset-пагинация).
+        
+        Отдает списки кортежей в порядке колонок EXPORT_TABLES, id справочников
+        заменены кодами. В памяти одновременно не больше одной пачки.
+        """
+        if table not in EXPORT_TABLES:
+            raise ValueError(f"Неизвестная таблица выгрузки: {table}")
+        db_table, columns = EXPORT_TABLES[table]
+        select = ", ".join(f"{column}_id" if column in CODED_COLUMNS else column for column in columns)
+        # Позиция колонки -> справочник, из которого берется код
+        coded = [(index, getattr(self, f"{column}s")) for index, column in enumerate(columns)
+                 if column in CODED_COLUMNS]
+        batch_size = max(1, batch_size)
+        
+        last_id = -2**63
+        while True:
+            async with self._read_connection() as db:
+                cursor = await db.execute(
+                    f"SELECT {select} FROM {db_table} WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, batch_size)
+                )
                 rows = await cursor.fetchall()
                 await cursor.close()
-                
+            
+            if coded:
+                rows = [list(row) for row in rows]
                 for row in rows:
-                    top_referrers.append({
-                        'referrer_user_id': row[0],
-                        'referrer_username': row[1] or 'без username',
-                        'referral_count': row[2]
-                    })
-                
-                return {
-                    'total_referrals': total_referrals,
-                    'total_revenue': total_revenue,
-                    'top_referrers': top_referrers
-                }
+                    for index, dimension in coded:
+                        row[index] = dimension.code_of(row[index])
+            if rows:
+                yield rows
+            
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
     
+    @cached_query
+    async def get_referral_overview(self):
+        """Получение сводной реферальной статистики (итоги + топ рефереров по количеству)"""
+        total_referrals = await self.get_total_referrals_count()
+        total_revenue = await self.get_total_commission_earned()
+        
+        async with self._read_connection() as db:
+            # Топ рефереров: сначала агрегат по referrals, потом имена только для топа
+            cursor = await db.execute("""
+                SELECT 
+                    r.referrer_id as referrer_user_id,
+                    u.username as referrer_username,
+                    r.referral_count
+                FROM (
+                    SELECT referrer_id, COUNT(*) as referral_count
+                    FROM referrals
+                    GROUP BY referrer_id
+                    ORDER BY referral_count DESC
+                    LIMIT 10
+                ) r
+                LEFT JOIN users u ON u.id = r.referrer_id
+                ORDER BY r.referral_count DESC
+            """)
+            top_referrers = []
+            rows = await cursor.fetchall()
+            await cursor.close()
+            
+            for row in rows:
+                top_referrers.append({
+                    'referrer_user_id': row[0],
+                    'referrer_username': row[1] or 'без username',
+                    'referral_count': row[2]
+                })
+            
+            return {
+                'total_referrals': total_referrals,
+                'total_revenue': total_revenue,
+                'top_referrers': top_referrers
+            }
+    
+    @cached_query
     async def check_subscription_access(self, user_id: int, subscription_amount: int, subscription_type: str) -> Dict:
         """Проверка доступа пользователя к подписке"""
         try:
-            async with self._lock:
-                async with aiosqlite.connect(self.db_path) as db:
-                    cursor = await db.execute("""
-                        SELECT COUNT(*) FROM subscriptions 
-                        WHERE user_id = ? 
-                        AND status = 'confirmed'
-                    """, (user_id,))
-                    subscription_count = (await cursor.fetchone())[0]
-                    await cursor.close()
-                    
-                    return {
-                        'has_access': subscription_count > 0,
-                        'subscription_count': subscription_count
-                    }
+            async with self._read_connection() as db:
+                cursor = await db.execute("""
+                    SELECT COUNT(*) FROM subscriptions 
+                    WHERE user_id = ? 
+                    AND status = 'confirmed'
+                """, (user_id,))
+                subscription_count = (await cursor.fetchone())[0]
+                await cursor.close()
+                
+                return {
+                    'has_access': subscription_count > 0,
+                    'subscription_count': subscription_count
+                }
         except Exception as e:
             logger.error(f"Ошибка проверки доступа: {e}")
             return {'has_access': False, 'subscription_count': 0}
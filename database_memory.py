@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Хранилище PassiveNFT Bot в памяти процесса
+
+Реализует тот же интерфейс, что и AsyncDatabaseManager (db_storage.StorageBackend),
+на словарях и списках, без диска и без потоков. Нужно для замеров пропускной
+способности обработчиков и для быстрых симуляций на больших объемах данных.
+Данные живут до перезапуска процесса.
+"""
+import heapq
+import itertools
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from db_storage import (EXPORT_TABLES, SUBSCRIPTION_DISPLAY_NAMES, USER_SEGMENTS, normalize_username,
+                        subscription_commission)
+
+logger = logging.getLogger(__name__)
+
+
+def _utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class InMemoryStorage:
+    """Хранилище на словарях с теми же ответами, что и у AsyncDatabaseManager"""
+
+    def __init__(self):
+        # Пользователи в порядке регистрации (dict сохраняет порядок вставки)
+        self._users: Dict[int, Dict] = {}
+        self._usernames: Dict[str, int] = {}
+        self._pending: Dict[int, int] = {}
+        # Рефералы: (referrer_id, referred_id) -> id связи
+        self._referrals: Dict[Tuple[int, int], int] = {}
+        self._referral_counts: Dict[int, int] = {}
+        self._earnings: List[Dict] = []
+        # Предагрегат как referral_rollup: (referrer_id, тип, способ) -> [рефералов, комиссия]
+        self._rollup: Dict[Tuple[int, str, str], List] = {}
+        self._rollup_referred: set = set()
+        self._subscriptions: List[Dict] = []
+        self._subscriptions_by_user: Dict[int, List[Dict]] = {}
+        self._confirmation_logs: List[Dict] = []
+        self._link_ids: set = set()
+        self._confirmation_daily: Dict[Tuple[str, str], int] = {}
+        self._commission_ton = 0.0
+
+    # ===== ЖИЗНЕННЫЙ ЦИКЛ =====
+
+    async def initialize(self):
+        logger.info("✅ Хранилище в памяти инициализировано")
+
+    async def close(self):
+        logger.info("🔒 Хранилище в памяти закрыто")
+
+    # ===== ПОЛЬЗОВАТЕЛИ =====
+
+    async def get_or_create_user(self, user_id: int, username: str = "", first_name: str = "", last_name: str = "") -> str:
+        """Получение или создание пользователя с обновлением username и имени"""
+        user = self._users.get(user_id)
+        username_lower = normalize_username(username)
+
+        if user is None:
+            now = _utc_now()
+            user = {
+                'id': user_id,
+                'referral_code': f"ref_{user_id}",
+                'created_at': now.strftime('%Y-%m-%d %H:%M:%S'),
+                'created_ts': int(now.timestamp()),
+                'username_lower': None,
+            }
+            self._users[user_id] = user
+            logger.info(f"✅ Пользователь {user_id} сохранен в памяти")
+
+        if user['username_lower'] != username_lower:
+            if user['username_lower'] and self._usernames.get(user['username_lower']) == user_id:
+                del self._usernames[user['username_lower']]
+            if username_lower:
+                # Прежний владелец имени его теряет, как в уникальном индексе username_lower
+                previous_owner = self._usernames.get(username_lower)
+                if previous_owner is not None and previous_owner != user_id:
+                    self._users[previous_owner]['username_lower'] = None
+                self._usernames[username_lower] = user_id
+            user['username_lower'] = username_lower
+
+        user['username'] = username
+        user['first_name'] = first_name
+        user['last_name'] = last_name
+        return user['referral_code']
+
+    async def create_user(self, user):
+        """Создание пользователя (алиас для get_or_create_user)"""
+        return await self.get_or_create_user(
+            user_id=user.id,
+            username=user.username or "",
+            first_name=user.first_name or "",
+            last_name=user.last_name or ""
+        )
+
+    async def resolve_username(self, username: str) -> Optional[int]:
+        """user_id по username без учета регистра и @"""
+        username_lower = normalize_username(username)
+        return self._usernames.get(username_lower) if username_lower else None
+
+    async def get_user_by_username(self, username: str) -> Optional[Dict]:
+        """Поиск пользователя по username"""
+        user_id = await self.resolve_username(username)
+        if user_id is None:
+            return None
+        user = self._users[user_id]
+        return {
+            'id': user_id,
+            'user_id': user_id,
+            'username': user['username'],
+            'first_name': user['first_name'],
+            'last_name': user['last_name'],
+            'referral_code': user['referral_code'],
+            'created_at': user['created_at']
+        }
+
+    async def get_all_users(self, limit=20):
+        """Последние зарегистрированные пользователи"""
+        return [
+            {
+                'user_id': user['id'],
+                'username': user['username'] or 'без username',
+                'created_at': user['created_at']
+            }
+            for user in self._newest_users(limit)
+        ]
+
+    def _newest_users(self, limit: int) -> List[Dict]:
+        """Последние по времени создания (при равном времени - больший id первым), как ORDER BY в SQL"""
+        return heapq.nlargest(limit, self._users.values(), key=lambda user: (user['created_at'], user['id']))
+
+    async def iter_users(self, batch_size: int = 1000, filter: Optional[str] = None) -> AsyncIterator[Dict]:
+        """Обход пользователей по возрастанию id (сегменты как в AsyncDatabaseManager.iter_users)"""
+        segment = filter or "all"
+        if segment not in USER_SEGMENTS:
+            raise ValueError(f"Неизвестный фильтр пользователей: {filter}")
+
+        for user_id in sorted(self._users):
+            if segment == "subscribed" and not self._has_confirmed_subscription(user_id):
+                continue
+            if segment == "unsubscribed" and self._has_confirmed_subscription(user_id):
+                continue
+            if segment == "referrers" and not self._referral_counts.get(user_id):
+                continue
+            user = self._users[user_id]
+            yield {
+                'user_id': user_id,
+                'username': user['username'] or '',
+                'first_name': user['first_name'] or '',
+                'last_name': user['last_name'] or '',
+                'created_at': user['created_at']
+            }
+
+    async def iter_table(self, table: str, batch_size: int = 1000) -> AsyncIterator[List[Tuple]]:
+        """Обход таблицы из EXPORT_TABLES пачками (колонки как в AsyncDatabaseManager.iter_table)"""
+        if table not in EXPORT_TABLES:
+            raise ValueError(f"Неизвестная таблица выгрузки: {table}")
+        columns = EXPORT_TABLES[table][1]
+        if table == "users":
+            records = (self._users[user_id] for user_id in sorted(self._users))
+        elif table == "subscriptions":
+            records = ({'id': number, **subscription} for number, subscription in enumerate(self._subscriptions, 1))
+        elif table == "earnings":
+            records = iter(self._earnings)
+        else:
+            records = ({'id': referral_id, 'referrer_id': referrer_id, 'referred_id': referred_id}
+                       for (referrer_id, referred_id), referral_id in self._referrals.items())
+
+        batch_size = max(1, batch_size)
+        while True:
+            batch = [tuple(record.get(column) for column in columns)
+                     for record in itertools.islice(records, batch_size)]
+            if batch:
+                yield batch
+            if len(batch) < batch_size:
+                return
+
+    async def get_all_users_count(self) -> int:
+        return len(self._users)
+
+    async def get_subscribers(self) -> List[Dict]:
+        """20 последних пользователей с их подписками"""
+        subscribers = []
+        for user in self._newest_users(20):
+            subscriptions = self._subscriptions_by_user.get(user['id']) or [None]
+            for subscription in subscriptions:
+                subscribers.append({
+                    'id': user['id'],
+                    'username': user['username'] or 'Нет',
+                    'name': f"{user['first_name'] or ''} {user['last_name'] or ''}".strip() or 'Нет имени',
+                    'subscription': subscription['subscription_type'] if subscription else 'Не подписан',
+                    'status': subscription['status'] if subscription else 'pending'
+                })
+                if len(subscribers) >= 20:
+                    return subscribers
+        return subscribers
+
+    # ===== РЕФЕРАЛЫ =====
+
+    async def save_pending_referral(self, user_id: int, referrer_id: int):
+        self._pending[user_id] = referrer_id
+
+    async def create_pending_referral(self, referrer_id: int, user_id: int, username: str = ""):
+        await self.save_pending_referral(user_id, referrer_id)
+
+    async def get_pending_referrer(self, user_id: int) -> Optional[int]:
+        return self._pending.get(user_id)
+
+    async def remove_pending_referral(self, user_id: int):
+        self._pending.pop(user_id, None)
+
+    async def add_referral(self, referrer_id: int, referred_id: int) -> bool:
+        if referrer_id == referred_id or (referrer_id, referred_id) in self._referrals:
+            return False
+        self._referrals[(referrer_id, referred_id)] = len(self._referrals) + 1
+        self._referral_counts[referrer_id] = self._referral_counts.get(referrer_id, 0) + 1
+        return True
+
+    async def calculate_commission(self, subscription_amount: float, subscription_type: str, payment_method: str) -> float:
+        return subscription_commission(subscription_amount, payment_method)
+
+    async def add_referral_earnings(self, referrer_id: int, referred_id: int, commission_amount: float,
+                                    subscription_type: str, payment_method: str):
+        if commission_amount <= 0:
+            return
+        self._record_earning(referrer_id, referred_id, commission_amount, subscription_type, payment_method)
+
+    def _record_earning(self, referrer_id: int, referred_id: int, commission_amount: float,
+                        subscription_type: str, payment_method: str):
+        """Запись комиссии с обновлением предагрегата и счетчика (как триггеры в SQLite)"""
+        self._earnings.append({
+            'id': len(self._earnings) + 1,
+            'referrer_id': referrer_id,
+            'referred_id': referred_id,
+            'commission_amount': commission_amount,
+            'subscription_type': subscription_type,
+            'payment_method': payment_method
+        })
+        key = (referrer_id, subscription_type, payment_method)
+        rollup = self._rollup.setdefault(key, [0, 0.0])
+        if key + (referred_id,) not in self._rollup_referred:
+            self._rollup_referred.add(key + (referred_id,))
+            rollup[0] += 1
+        rollup[1] += commission_amount
+        if payment_method == 'TON':
+            self._commission_ton += commission_amount
+
+    async def get_user_referrals_count(self, user_id: int) -> int:
+        return self._referral_counts.get(user_id, 0)
+
+    async def get_user_referral_earnings(self, user_id: int) -> float:
+        return float(sum(
+            rollup[1] for (referrer_id, _, payment_method), rollup in self._rollup.items()
+            if referrer_id == user_id and payment_method == 'TON'
+        ))
+
+    async def get_user_referral_stats(self, user_id: int) -> str:
+        """Детальная статистика рефералов (та же выборка, что и в AsyncDatabaseManager)"""
+        if user_id not in self._users:
+            return "У вас пока нет рефералов."
+
+        total_referrals = total_earnings = ton_referrals = stars_referrals = 0
+        for referrer_id, referred_id in self._referrals:
+            if referred_id != user_id:
+                continue
+            matched = [e for e in self._earnings if e['referred_id'] == referred_id] or [None]
+            for earning in matched:
+                total_referrals += 1
+                if earning:
+                    total_earnings += earning['commission_amount']
+                    ton_referrals += earning['payment_method'] == 'TON'
+                    stars_referrals += earning['payment_method'] == 'STARS'
+
+        if total_referrals == 0:
+            return "У вас пока нет рефералов."
+
+        return f"""📊 Статистика рефералов:
+👥 Всего рефералов: {total_referrals}
+💰 Заработано TON: {total_earnings:.2f}
+💎 TON рефералов: {ton_referrals}
+⭐ Stars рефералов: {stars_referrals}
+
+💡 Комиссия начисляется только за TON-подписки!"""
+
+    async def get_user_referral_stats_by_type(self, user_id: int, subscription_type: str) -> Dict:
+        rollup = self._rollup.get((user_id, subscription_type, 'TON'))
+        if rollup:
+            return {'count': rollup[0], 'total_commission': round(float(rollup[1]), 2)}
+        return {'count': 0, 'total_commission': 0.0}
+
+    async def get_admin_referral_stats_by_type(self, subscription_type: str) -> Dict:
+        totals: Dict[int, List] = {}
+        for (referrer_id, rollup_type, _), rollup in self._rollup.items():
+            if rollup_type != subscription_type:
+                continue
+            total = totals.setdefault(referrer_id, [0, 0.0])
+            total[0] += rollup[0]
+            total[1] += rollup[1]
+
+        ranked = sorted(
+            ((referrer_id, total) for referrer_id, total in totals.items() if total[0] > 0),
+            key=lambda item: (-item[1][1], -item[1][0], item[0])
+        )
+        referrers = []
+        for referrer_id, (count, commission) in ranked:
+            user = self._users.get(referrer_id) or {}
+            referrers.append({
+                'user_id': referrer_id,
+                'username': user.get('username') or user.get('first_name') or f"ID:{referrer_id}",
+                'count': count,
+                'commission': round(float(commission), 2)
+            })
+
+        return {
+            'total_count': sum(referrer['count'] for referrer in referrers),
+            'total_commission': round(sum(float(total[1]) for _, total in ranked), 2),
+            'referrers': referrers
+        }
+
+    def _top_referrers(self, limit: int = 10) -> List[Tuple[int, int]]:
+        # При равенстве - по id, как группировка в SQLite
+        return sorted(self._referral_counts.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    async def get_referral_stats(self) -> List[Dict]:
+        """Топ-10 рефереров по количеству рефералов"""
+        commissions: Dict[int, float] = {}
+        for earning in self._earnings:
+            commissions[earning['referrer_id']] = commissions.get(earning['referrer_id'], 0.0) + earning['commission_amount']
+
+        ranked = sorted(
+            ((referrer_id, count) for referrer_id, count in self._referral_counts.items()
+             if referrer_id in self._users),
+            key=lambda item: (-item[1], item[0])
+        )[:10]
+        return [
+            {
+                'username': self._users[referrer_id]['username'] or f"ID:{referrer_id}",
+                'total_referrals': count,
+                'commission': round(float(commissions.get(referrer_id, 0.0)), 2)
+            }
+            for referrer_id, count in ranked
+        ]
+
+    async def get_referral_overview(self):
+        """Итоги и топ рефереров по количеству"""
+        return {
+            'total_referrals': await self.get_total_referrals_count(),
+            'total_revenue': await self.get_total_commission_earned(),
+            'top_referrers': [
+                {
+                    'referrer_user_id': referrer_id,
+                    'referrer_username': (self._users.get(referrer_id) or {}).get('username') or 'без username',
+                    'referral_count': count
+                }
+                for referrer_id, count in self._top_referrers()
+            ]
+        }
+
+    async def get_total_referrals_count(self) -> int:
+        return len(self._referrals)
+
+    async def get_total_commission_earned(self) -> float:
+        return round(self._commission_ton, 2)
+
+    # ===== ПОДПИСКИ =====
+
+    async def add_subscription(self, user_id: int, subscription_type: str, payment_method: str,
+                               amount: float, currency: str = 'TON') -> bool:
+        """Подписка с начислением комиссии ожидающему рефереру (только TON)"""
+        commission = subscription_commission(amount, payment_method)
+        subscription = {
+            'user_id': user_id,
+            'subscription_type': subscription_type,
+            'payment_method': payment_method,
+            'amount': amount,
+            'currency': currency,
+            'status': 'confirmed'
+        }
+        self._subscriptions.append(subscription)
+        self._subscriptions_by_user.setdefault(user_id, []).append(subscription)
+
+        if payment_method.upper() == 'TON':
+            pending_referrer = self._pending.pop(user_id, None)
+            if pending_referrer and commission > 0:
+                self._record_earning(pending_referrer, user_id, commission, subscription_type, payment_method)
+        return True
+
+    def _has_confirmed_subscription(self, user_id: int) -> bool:
+        return any(s['status'] == 'confirmed' for s in self._subscriptions_by_user.get(user_id, ()))
+
+    async def check_subscription_access(self, user_id: int, subscription_amount: int, subscription_type: str) -> Dict:
+        count = sum(1 for s in self._subscriptions_by_user.get(user_id, ()) if s['status'] == 'confirmed')
+        return {'has_access': count > 0, 'subscription_count': count}
+
+    async def get_subscription_stats(self):
+        return {
+            'total_users': await self.get_all_users_count(),
+            'ton_subscribers': 0,
+            'stars_subscribers': 0,
+            'total_referrals': await self.get_total_referrals_count(),
+            'ton_revenue': 0,
+            'stars_revenue': 0
+        }
+
+    # ===== ПОДТВЕРЖДЕНИЯ ОПЛАТЫ =====
+
+    async def save_confirmation_log(self, log_data: Dict):
+        link_id = log_data.get('link_id')
+        if link_id in self._link_ids:
+            raise ValueError(f"Лог подтверждения с link_id {link_id} уже существует")
+        now = _utc_now()
+        subscription_type = log_data.get('subscription_type')
+        self._link_ids.add(link_id)
+        self._confirmation_logs.append({
+            'admin_id': log_data.get('admin_id'),
+            'subscription_type': subscription_type,
+            'username': log_data.get('username'),
+            'link_id': link_id,
+            'timestamp': now.strftime('%Y-%m-%d %H:%M:%S')
+        })
+        key = (now.date().isoformat(), subscription_type)
+        self._confirmation_daily[key] = self._confirmation_daily.get(key, 0) + 1
+
+    async def get_recent_confirmation_logs(self, limit: int = 10) -> List[Dict]:
+        return [dict(log) for log in itertools.islice(reversed(self._confirmation_logs), limit)]
+
+    async def get_confirmation_stats(self) -> Dict:
+        """Статистика подтверждений по дневным корзинам (дни UTC)"""
+        today = _utc_now().date()
+        week_start = (today - timedelta(days=7)).isoformat()
+        today = today.isoformat()
+
+        total = today_count = week = 0
+        by_type: Dict[str, int] = {}
+        for (day, subscription_type), count in self._confirmation_daily.items():
+            total += count
+            if day == today:
+                today_count += count
+            if day > week_start:
+                week += count
+            by_type[subscription_type] = by_type.get(subscription_type, 0) + count
+
+        popular_subscription = "нет данных"
+        if by_type:
+            code, count = max(by_type.items(), key=lambda item: item[1])
+            popular_subscription = f"{SUBSCRIPTION_DISPLAY_NAMES.get(code, code)} ({count} раз)"
+
+        return {
+            'total': total,
+            'today': today_count,
+            'week': week,
+            'popular_subscription': popular_subscription
+        }
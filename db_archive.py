@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Архивация истории PassiveNFT Bot по месяцам
+
+- Строки subscriptions, referral_earnings и confirmation_logs старше
+  DB_ARCHIVE_RETENTION_DAYS переносятся в файлы <база>-archive-ГГГГ-ММ.db
+  в каталоге DB_ARCHIVE_DIR; рабочий файл остается небольшим
+- Перенос идет пачками в отдельном потоке на собственном соединении:
+  блокировка записи держится только на время удаления одной пачки
+- Счетчики (counters) и предагрегат referral_rollup при переносе не меняются
+  (флаг 'archiving' в maintenance_flags, см. миграцию archive_guard)
+- В рабочей базе всегда остается последняя строка по ключу, на который
+  опираются бот и триггеры: последняя подписка пользователя (доступ) и
+  последняя комиссия по паре реферер/реферал (подсчет уникальных рефералов)
+- Итоги в боте (counters, referral_rollup, confirmation_daily) архивация
+  не меняет. Исключение - get_user_referral_stats: он суммирует строки
+  referral_earnings рабочей базы и после переноса видит только оставшиеся
+  (последнюю комиссию по каждой паре реферер/реферал). Из бота архив читает только выгрузка (/export, Archiver.iter_archived);
+  Archiver.read_history - API для скриптов и будущих отчетов, бот его не вызывает
+  (архивы подключаются через ATTACH порциями, не больше ATTACH_CHUNK за запрос)
+"""
+import asyncio
+import logging
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+from db_cache import QueryCache
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ArchivedTable:
+    """Таблица истории, строки которой переносятся в архив.
+
+    keep_latest_by - колонки ключа, для которого в рабочей базе остается
+    самая новая строка (пусто - переносятся все старые строки).
+    """
+    name: str
+    keep_latest_by: Tuple[str, ...] = ()
+
+
+ARCHIVED_TABLES: Tuple[ArchivedTable, ...] = (
+    ArchivedTable("subscriptions", keep_latest_by=("user_id",)),
+    ArchivedTable(
+        "referral_earnings",
+        keep_latest_by=("referrer_id", "subscription_type_id", "payment_method_id", "referred_id")
+    ),
+    ArchivedTable("confirmation_logs"),
+)
+
+ARCHIVED_TABLE_NAMES = frozenset(table.name for table in ARCHIVED_TABLES)
+
+ARCHIVE_SCHEMA = "archive"
+# SQLite подключает к соединению не больше 10 баз (SQLITE_LIMIT_ATTACHED)
+ATTACH_CHUNK = 9
+
+
+class Archiver:
+    """Перенос старых строк истории в помесячные файлы архива"""
+
+    def __init__(self, db_path: str, archive_dir: str = "archive", retention_days: int = 180,
+                 batch_size: int = 500, batch_pause_ms: float = 50.0,
+                 interval_hours: float = 24.0, busy_timeout_ms: int = 5000,
+                 query_cache: Optional[QueryCache] = None):
+        self.db_path = Path(db_path)
+        self.archive_dir = Path(archive_dir)
+        self.retention_days = max(1, retention_days)
+        self.batch_size = max(1, batch_size)
+        self.batch_pause = max(0.0, batch_pause_ms) / 1000.0
+        self.interval = max(60.0, interval_hours * 3600.0)
+        self.busy_timeout_ms = busy_timeout_ms
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        # Кэш запросов хранилища в том же процессе: перенос строк меняет ответы
+        self.query_cache = query_cache
+
+    def archive_path(self, month: str) -> Path:
+        """Файл архива за месяц ('2025-01')"""
+        return self.archive_dir / f"{self.db_path.stem}-archive-{month}.db"
+
+    def archive_months(self) -> List[str]:
+        """Месяцы, за которые есть файлы архива (по возрастанию)"""
+        if not self.archive_dir.is_dir():
+            return []
+        prefix = f"{self.db_path.stem}-archive-"
+        return sorted(path.stem[len(prefix):] for path in self.archive_dir.glob(f"{prefix}*.db"))
+
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        if read_only:
+            connection = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, isolation_level=None)
+        else:
+            connection = sqlite3.connect(self.db_path, isolation_level=None)
+        connection.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        return connection
+
+    # ===== ПЕРЕНОС В АРХИВ =====
+
+    async def run_once(self) -> Dict[str, int]:
+        """Один проход архивации по всем таблицам, возвращает число перенесенных строк"""
+        async with self._lock:
+            cutoff = int(time.time()) - self.retention_days * 86400
+            started = time.monotonic()
+            moved: Dict[str, int] = {}
+            for table in ARCHIVED_TABLES:
+                moved[table.name] = 0
+                while True:
+                    count = await asyncio.to_thread(self._archive_batch, table, cutoff)
+                    moved[table.name] += count
+                    if count and self.query_cache is not None:
+                        self.query_cache.bump(table.name)
+                    if count < self.batch_size:
+                        break
+                    # Между пачками блокировка записи свободна для бота
+                    await asyncio.sleep(self.batch_pause)
+        if any(moved.values()):
+            logger.info(
+                f"🗄️ Архивация за {time.monotonic() - started:.1f} с: "
+                + ", ".join(f"{name} {count}" for name, count in moved.items())
+            )
+        return moved
+
+    def _archive_batch(self, table: ArchivedTable, cutoff: int) -> int:
+        """Перенос одной пачки строк таблицы старше cutoff"""
+        connection = self._connect()
+        try:
+            if not self._created_ts_ready(connection, table.name):
+                return 0
+
+            keep_latest = ""
+            if table.keep_latest_by:
+                same_key = " AND ".join(f"newer.{column} = t.{column}" for column in table.keep_latest_by)
+                keep_latest = f"""
+                    AND EXISTS (
+                        SELECT 1 FROM {table.name} newer
+                        WHERE {same_key} AND newer.id > t.id
+                    )
+                """
+            rows = connection.execute(f"""
+                SELECT t.id, strftime('%Y-%m', t.created_ts, 'unixepoch')
+                FROM {table.name} t
+                WHERE t.created_ts < ? {keep_latest}
+                ORDER BY t.id
+                LIMIT ?
+            """, (cutoff, self.batch_size)).fetchall()
+            if not rows:
+                return 0
+
+            by_month: Dict[str, List[int]] = {}
+            for row_id, month in rows:
+                by_month.setdefault(month, []).append(row_id)
+            for month, ids in by_month.items():
+                self._move_rows(connection, table.name, month, ids)
+            return len(rows)
+        finally:
+            connection.close()
+
+    def _move_rows(self, connection: sqlite3.Connection, table: str, month: str, ids: List[int]):
+        """Копия строк в архив месяца, затем удаление из рабочей базы.
+
+        Две отдельные транзакции: если процесс упадет между ними, строки
+        останутся в обеих базах, и следующий проход просто удалит их
+        (повторная вставка в архив игнорируется по id).
+        """
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        connection.execute(f"ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}", (str(self.archive_path(month)),))
+        try:
+            columns = self._ensure_archive_table(connection, table)
+            placeholders = ", ".join("?" * len(ids))
+            column_list = ", ".join(columns)
+
+            connection.execute("BEGIN")
+            try:
+                connection.execute(f"""
+                    INSERT OR IGNORE INTO {ARCHIVE_SCHEMA}.{table} ({column_list})
+                    SELECT {column_list} FROM main.{table} WHERE id IN ({placeholders})
+                """, ids)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute("INSERT OR IGNORE INTO maintenance_flags (name) VALUES ('archiving')")
+                connection.execute(f"""
+                    DELETE FROM main.{table}
+                    WHERE id IN ({placeholders})
+                    AND id IN (SELECT id FROM {ARCHIVE_SCHEMA}.{table})
+                """, ids)
+                connection.execute("DELETE FROM maintenance_flags WHERE name = 'archiving'")
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        finally:
+            connection.execute(f"DETACH DATABASE {ARCHIVE_SCHEMA}")
+
+    @staticmethod
+    def _ensure_archive_table(connection: sqlite3.Connection, table: str) -> List[str]:
+        """Таблица в архиве с колонками рабочей таблицы (новые колонки добавляются)"""
+        columns = [row[1] for row in connection.execute(f"PRAGMA main.table_info({table})")]
+        connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {ARCHIVE_SCHEMA}.{table} AS
+            SELECT * FROM main.{table} WHERE 0
+        """)
+        archived = {row[1] for row in connection.execute(f"PRAGMA {ARCHIVE_SCHEMA}.table_info({table})")}
+        for column in columns:
+            if column not in archived:
+                connection.execute(f"ALTER TABLE {ARCHIVE_SCHEMA}.{table} ADD COLUMN {column}")
+        connection.execute(f"""
+            CREATE UNIQUE INDEX IF NOT EXISTS {ARCHIVE_SCHEMA}.idx_{table}_id ON {table} (id)
+        """)
+        connection.execute(f"""
+            CREATE INDEX IF NOT EXISTS {ARCHIVE_SCHEMA}.idx_{table}_created_ts ON {table} (created_ts)
+        """)
+        return columns
+
+    @staticmethod
+    def _created_ts_ready(connection: sqlite3.Connection, table: str) -> bool:
+        """Заполнен ли created_ts у старых строк (до этого архивировать нельзя)"""
+        row = connection.execute(
+            "SELECT done FROM schema_backfills WHERE name = ?", (f"{table}_created_ts",)
+        ).fetchone()
+        return row is None or bool(row[0])
+
+    # ===== ЧТЕНИЕ ИСТОРИИ ВМЕСТЕ С АРХИВОМ =====
+
+    async def read_history(self, table: str, since_ts: int, until_ts: Optional[int] = None,
+                           limit: Optional[int] = None) -> List[Dict]:
+        """Строки таблицы истории за период [since_ts, until_ts) из рабочей базы и нужных месяцев архива
+
+        В боте не используется (отчеты читают счетчики и предагрегаты) - для скриптов и отладки
+        """
+        if table not in ARCHIVED_TABLE_NAMES:
+            raise ValueError(f"Таблица {table} не архивируется")
+        until_ts = until_ts if until_ts is not None else int(time.time()) + 1
+        return await asyncio.to_thread(self._read_history_sync, table, since_ts, until_ts, limit)
+
+    def _read_history_sync(self, table: str, since_ts: int, until_ts: int, limit: Optional[int]) -> List[Dict]:
+        first = datetime.fromtimestamp(since_ts, timezone.utc).strftime("%Y-%m")
+        last = datetime.fromtimestamp(until_ts, timezone.utc).strftime("%Y-%m")
+        months = [month for month in self.archive_months() if first <= month <= last]
+
+        connection = self._connect(read_only=True)
+        try:
+            columns = [row[1] for row in connection.execute(f"PRAGMA main.table_info({table})")]
+            period = (since_ts, until_ts, limit)
+            rows = self._select_history(connection, table, columns, ["main"], *period)
+            # Месяцы подключаются порциями по ATTACH_CHUNK, каждая порция - свой запрос
+            for start in range(0, len(months), ATTACH_CHUNK):
+                schemas = []
+                try:
+                    for month in months[start:start + ATTACH_CHUNK]:
+                        schema = f"archive_{len(schemas)}"
+                        connection.execute(f"ATTACH DATABASE ? AS {schema}",
+                                           (f"file:{self.archive_path(month)}?mode=ro",))
+                        schemas.append(schema)
+                    rows += self._select_history(connection, table, columns, schemas, *period)
+                finally:
+                    for schema in schemas:
+                        connection.execute(f"DETACH DATABASE {schema}")
+        finally:
+            connection.close()
+
+        # Каждая порция уже отсортирована и ограничена limit - общий порядок и лимит здесь
+        created_ts, row_id = columns.index("created_ts"), columns.index("id")
+        rows.sort(key=lambda row: (row[created_ts], row[row_id]))
+        if limit is not None:
+            rows = rows[:limit]
+        return [dict(zip(columns, row)) for row in rows]
+
+    @staticmethod
+    def _select_history(connection: sqlite3.Connection, table: str, columns: List[str], schemas: List[str],
+                        since_ts: int, until_ts: int, limit: Optional[int]) -> List[Tuple]:
+        """Строки периода из таблицы table в перечисленных подключенных базах"""
+        selects = []
+        for schema in schemas:
+            present = {row[1] for row in connection.execute(f"PRAGMA {schema}.table_info({table})")}
+            if not present:
+                continue
+            # В старых файлах архива может не быть колонок, добавленных позже
+            select_list = ", ".join(column if column in present else f"NULL AS {column}" for column in columns)
+            selects.append(f"SELECT {select_list} FROM {schema}.{table} WHERE created_ts >= ? AND created_ts < ?")
+        if not selects:
+            return []
+
+        params: List = [value for _ in selects for value in (since_ts, until_ts)]
+        sql = f"SELECT * FROM ({' UNION ALL '.join(selects)}) ORDER BY created_ts, id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return connection.execute(sql, params).fetchall()
+
+    async def iter_archived(self, table: str, columns: Sequence[str],
+                            batch_size: int = 1000) -> AsyncIterator[List[Tuple]]:
+        """Все строки таблицы из файлов архива пачками по id (месяцы по возрастанию).
+
+        columns - колонки таблицы, первая из них id. Каждый файл читается
+        keyset-пагинацией, в памяти одновременно не больше одной пачки.
+        """
+        if table not in ARCHIVED_TABLE_NAMES:
+            raise ValueError(f"Таблица {table} не архивируется")
+        batch_size = max(1, batch_size)
+        for month in self.archive_months():
+            last_id = -2**63
+            while True:
+                rows = await asyncio.to_thread(self._archived_batch_sync, month, table, columns, last_id, batch_size)
+                if rows:
+                    yield rows
+                if len(rows) < batch_size:
+                    break
+                last_id = rows[-1][0]
+
+    def _archived_batch_sync(self, month: str, table: str, columns: Sequence[str],
+                             last_id: int, batch_size: int) -> List[Tuple]:
+        connection = sqlite3.connect(f"file:{self.archive_path(month)}?mode=ro", uri=True)
+        try:
+            present = {row[1] for row in connection.execute(f"PRAGMA table_info({table})")}
+            if not present:
+                return []
+            select_list = ", ".join(column if column in present else f"NULL AS {column}" for column in columns)
+            return connection.execute(
+                f"SELECT {select_list} FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                (last_id, batch_size)
+            ).fetchall()
+        finally:
+            connection.close()
+
+    @asynccontextmanager
+    async def paused(self):
+        """Новый проход архивации не начнется, пока выполняется блок (начатый доводится до конца).
+
+        Нужен для согласованного чтения архива и рабочей базы: без паузы строка,
+        перенесенная между ними, пропадет из результата.
+        """
+        async with self._lock:
+            yield
+
+    # ===== ФОНОВАЯ ЗАДАЧА =====
+
+    def start(self):
+        """Запуск периодической архивации (первый проход - сразу после старта)"""
+        if self._task is not None:
+            return
+        self._task = asyncio.create_task(self._loop())
+        logger.info(
+            f"🗄️ Архивация истории старше {self.retention_days} дн. в {self.archive_dir}, "
+            f"раз в {self.interval / 3600:.0f} ч"
+        )
+
+    async def stop(self):
+        """Остановка фоновой задачи (начатая пачка в потоке доводится до конца)"""
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка архивации истории: {e}")
+            await asyncio.sleep(self.interval)
+
+
+def create_archiver(config, query_cache: Optional[QueryCache] = None) -> Optional[Archiver]:
+    """Архиватор по настройкам (None, если выключен или хранилище не SQLite)"""
+    if not getattr(config, 'DB_ARCHIVE_ENABLED', False):
+        return None
+    archiver = open_archives(config)
+    if archiver is not None:
+        archiver.query_cache = query_cache
+    return archiver
+
+
+def open_archives(config) -> Optional[Archiver]:
+    """Архиватор для чтения уже созданных архивов и при выключенной архивации (None не для SQLite)"""
+    if str(getattr(config, 'DB_BACKEND', 'sqlite')).lower() != 'sqlite':
+        return None
+    return Archiver(
+        db_path=getattr(config, 'DB_PATH', 'passive_nft_bot.db'),
+        archive_dir=getattr(config, 'DB_ARCHIVE_DIR', 'archive'),
+        retention_days=getattr(config, 'DB_ARCHIVE_RETENTION_DAYS', 180),
+        batch_size=getattr(config, 'DB_ARCHIVE_BATCH_SIZE', 500),
+        interval_hours=getattr(config, 'DB_ARCHIVE_INTERVAL_HOURS', 24.0)
+    )
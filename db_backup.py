@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Онлайн-резервные копии SQLite для PassiveNFT Bot
+
+- Копия снимается через online backup API SQLite небольшими порциями
+  страниц с паузами между ними: бот продолжает читать и писать
+- Копирование идет в отдельном потоке на собственных соединениях, очередь
+  записи и пул читателей бота не задействуются
+- Снимки с отметкой времени пишутся в DB_BACKUP_DIR, хранятся последние DB_BACKUP_KEEP
+- Восстановление - только при остановленном боте:
+    python db_backup.py list
+    python db_backup.py backup
+    python db_backup.py restore backups/passive_nft_bot-20250101-120000.db
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_TIME_FORMAT = "%Y%m%d-%H%M%S"
+
+
+class BackupRestarted(Exception):
+    """Копирование слишком часто начиналось заново из-за записей в исходную базу"""
+
+
+class BackupManager:
+    """Периодические онлайн-снимки файла базы данных с ротацией.
+
+    pages_per_step страниц копируется за один шаг, между шагами - пауза
+    step_sleep_ms. На шаге SQLite держит только разделяемую блокировку
+    чтения источника: в режиме WAL она не мешает писателю вовсе, без WAL
+    коммит ждет не дольше одного шага (порядка миллисекунд). Если записи
+    перезапускают копирование больше max_restarts раз, файл копируется
+    одним шагом.
+    """
+
+    def __init__(self, db_path: str, backup_dir: str = "backups", keep: int = 24,
+                 interval_minutes: float = 60.0, pages_per_step: int = 64,
+                 step_sleep_ms: float = 5.0, max_restarts: int = 3):
+        self.db_path = Path(db_path)
+        self.backup_dir = Path(backup_dir)
+        self.keep = max(1, keep)
+        self.interval = max(1.0, interval_minutes * 60.0)
+        self.pages_per_step = max(1, pages_per_step)
+        self.step_sleep = max(0.0, step_sleep_ms) / 1000.0
+        self.max_restarts = max(0, max_restarts)
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self.last_backup: Optional[Path] = None
+        self.last_duration: Optional[float] = None
+
+    # ===== СНИМКИ =====
+
+    def snapshot_name(self, moment: Optional[datetime] = None) -> str:
+        """Имя файла снимка: <имя базы>-<время UTC>.db"""
+        moment = moment or datetime.now(timezone.utc)
+        return f"{self.db_path.stem}-{moment.strftime(SNAPSHOT_TIME_FORMAT)}.db"
+
+    def list_snapshots(self) -> List[Path]:
+        """Снимки этой базы от старых к новым"""
+        if not self.backup_dir.is_dir():
+            return []
+        return sorted(self.backup_dir.glob(f"{self.db_path.stem}-[0-9]*.db"))
+
+    async def backup_now(self) -> Path:
+        """Снимок базы прямо сейчас (в отдельном потоке), возвращает путь к нему"""
+        async with self._lock:
+            started = time.monotonic()
+            path = await asyncio.to_thread(self._backup_sync)
+            self.last_backup = path
+            self.last_duration = time.monotonic() - started
+            removed = self._rotate()
+        size_mb = path.stat().st_size / 1024 / 1024
+        logger.info(
+            f"💾 Резервная копия {path.name} готова за {self.last_duration:.1f} с "
+            f"({size_mb:.1f} МБ, удалено старых: {removed})"
+        )
+        return path
+
+    def _backup_sync(self) -> Path:
+        self.backup_dir.mkdir(parents=True, exist_ok=True)
+        target_path = self.backup_dir / self.snapshot_name()
+        partial_path = target_path.with_name(target_path.name + ".part")
+
+        source = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+        try:
+            wal_mode = source.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal"
+            try:
+                copy_database(source, partial_path, self.pages_per_step, self.step_sleep, self.max_restarts)
+            except BackupRestarted:
+                # Весь файл копируется одним шагом внутри одной транзакции чтения,
+                # снимок согласован. В WAL писатель при этом не блокируется, без WAL
+                # коммиты бота ждут конца копирования (в пределах busy_timeout)
+                if wal_mode:
+                    logger.warning("⚠️ Копия перезапускалась из-за записей, копируем одним шагом (WAL)")
+                else:
+                    logger.warning(
+                        "⚠️ Копия перезапускалась из-за записей, копируем одним шагом: "
+                        "без WAL записи ждут конца копирования (включите DB_WAL_MODE)"
+                    )
+                copy_database(source, partial_path, -1, 0.0, 0)
+        finally:
+            source.close()
+
+        check_snapshot(partial_path)
+        os.replace(partial_path, target_path)
+        return target_path
+
+    def _rotate(self) -> int:
+        """Удаление старых снимков сверх keep, возвращает количество удаленных"""
+        snapshots = self.list_snapshots()
+        stale = snapshots[:-self.keep]
+        for path in stale:
+            path.unlink(missing_ok=True)
+        return len(stale)
+
+    # ===== ФОНОВАЯ ЗАДАЧА =====
+
+    def start(self):
+        """Запуск периодического резервного копирования"""
+        if self._task is not None:
+            return
+        self._task = asyncio.create_task(self._loop())
+        logger.info(
+            f"💾 Резервное копирование: каждые {self.interval / 60:.0f} мин в {self.backup_dir}, "
+            f"хранится {self.keep} снимков"
+        )
+
+    async def stop(self):
+        """Остановка фоновой задачи (уже начатое копирование в потоке доводится до конца)"""
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.backup_now()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка резервного копирования: {e}")
+
+
+def create_backup_manager(config) -> Optional[BackupManager]:
+    """Менеджер резервных копий по настройкам (None, если копии выключены или хранилище не SQLite)"""
+    if not getattr(config, 'DB_BACKUP_ENABLED', False):
+        return None
+    if str(getattr(config, 'DB_BACKEND', 'sqlite')).lower() != 'sqlite':
+        return None
+    return BackupManager(
+        db_path=getattr(config, 'DB_PATH', 'passive_nft_bot.db'),
+        backup_dir=getattr(config, 'DB_BACKUP_DIR', 'backups'),
+        keep=getattr(config, 'DB_BACKUP_KEEP', 24),
+        interval_minutes=getattr(config, 'DB_BACKUP_INTERVAL_MIN', 60.0),
+        pages_per_step=getattr(config, 'DB_BACKUP_PAGES_PER_STEP', 64),
+        step_sleep_ms=getattr(config, 'DB_BACKUP_STEP_SLEEP_MS', 5.0)
+    )
+
+
+def copy_database(source: sqlite3.Connection, target_path: Path, pages: int,
+                  step_sleep: float, max_restarts: int):
+    """Копирование базы через backup API порциями pages страниц (-1 - за один шаг).
+
+    Если исходную базу меняет другое соединение, SQLite начинает копирование
+    заново; после max_restarts таких перезапусков выбрасывается BackupRestarted.
+    """
+    restarts = 0
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last_remaining
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > max_restarts:
+                raise BackupRestarted(f"копирование перезапускалось {restarts} раз")
+        last_remaining = remaining
+        # Пауза между шагами: sleep у backup() срабатывает только при занятой базе,
+        # а здесь писатель получает окно для коммита после каждой порции
+        if remaining and step_sleep:
+            time.sleep(step_sleep)
+
+    target_path.unlink(missing_ok=True)
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target, pages=pages, progress=progress, sleep=step_sleep)
+    except BaseException:
+        target.close()
+        target_path.unlink(missing_ok=True)
+        raise
+    target.close()
+
+
+def check_snapshot(path: Path):
+    """Быстрая проверка целостности файла снимка (ValueError, если он поврежден)"""
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        result = connection.execute("PRAGMA quick_check").fetchone()[0]
+    finally:
+        connection.close()
+    if result != "ok":
+        raise ValueError(f"Снимок {path} поврежден: {result}")
+
+
+def restore_snapshot(snapshot: Path, db_path: Path, backup_dir: Optional[Path] = None) -> Optional[Path]:
+    """Восстановление базы из снимка (бот должен быть остановлен).
+
+    Текущая база перед перезаписью сохраняется рядом со снимками
+    (<имя>-pre-restore-<время>.db), ее путь возвращается.
+    """
+    check_snapshot(snapshot)
+
+    saved = None
+    if db_path.exists():
+        backup_dir = backup_dir or snapshot.parent
+        backup_dir.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime(SNAPSHOT_TIME_FORMAT)
+        saved = backup_dir / f"{db_path.stem}-pre-restore-{stamp}.db"
+        current = sqlite3.connect(db_path)
+        try:
+            copy_database(current, saved, -1, 0.0, 0)
+        finally:
+            current.close()
+
+    # Запись через backup API, а не копированием файла: WAL и -shm текущей
+    # базы остаются согласованными с новым содержимым
+    source = sqlite3.connect(f"file:{snapshot}?mode=ro", uri=True)
+    target = sqlite3.connect(db_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    return saved
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Резервные копии базы PassiveNFT Bot")
+    parser.add_argument("--db", default=os.getenv("DB_PATH", "passive_nft_bot.db"), help="файл базы данных")
+    parser.add_argument("--dir", default=os.getenv("DB_BACKUP_DIR", "backups"), help="каталог снимков")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="список снимков")
+    commands.add_parser("backup", help="снять копию сейчас")
+    restore = commands.add_parser("restore", help="восстановить базу из снимка (бот остановлен)")
+    restore.add_argument("snapshot", help="файл снимка")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    manager = BackupManager(args.db, args.dir, keep=int(os.getenv("DB_BACKUP_KEEP", "24")))
+
+    if args.command == "list":
+        for path in manager.list_snapshots():
+            print(f"{path}  {path.stat().st_size / 1024 / 1024:.1f} МБ")
+        return 0
+
+    if args.command == "backup":
+        print(asyncio.run(manager.backup_now()))
+        return 0
+
+    saved = restore_snapshot(Path(args.snapshot), Path(args.db), Path(args.dir))
+    if saved is not None:
+        print(f"Предыдущая база сохранена в {saved}")
+    print(f"✅ База {args.db} восстановлена из {args.snapshot}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Внутрипроцессные кэши для PassiveNFT Bot
+
+- LRU: при переполнении вытесняется давно не использованный ключ
+- TTL: запись старше ttl секунд считается отсутствующей
+- Счетчики попаданий и промахов для статистики
+- KnownUsers: быстрый ответ "пользователь уже в базе" без запроса к ней
+- CodeMap: справочники id <-> код, загружаемые при старте
+- QueryCache: ответы методов чтения хранилища до первой записи в таблицы,
+  от которых они зависят (версии таблиц)
+"""
+import functools
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional, Tuple
+
+from db_storage import DATE_DEPENDENT_QUERIES, QUERY_TABLES
+
+_MISSING = object()
+
+
+class LRUCache:
+    """LRU-кэш с ограничением размера и временем жизни записей.
+
+    Не потокобезопасен: рассчитан на один цикл событий asyncio,
+    где между await никто другой не трогает словарь.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: Optional[float] = None):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Значение по ключу (или default, если его нет или оно устарело)"""
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            self.misses += 1
+            return default
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        """Сохранение значения с вытеснением самого старого ключа при переполнении"""
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, *keys: Hashable):
+        """Удаление ключей (отсутствующие ключи игнорируются)"""
+        for key in keys:
+            self._data.pop(key, None)
+
+    def invalidate_value(self, value: Any):
+        """Удаление всех ключей с данным значением (полный проход - для редких путей)"""
+        stale = [key for key, (cached, _) in self._data.items() if cached == value]
+        for key in stale:
+            del self._data[key]
+
+    def clear(self):
+        """Полная очистка кэша"""
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        """Размер кэша и счетчики попаданий/промахов"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+class KnownUsers:
+    """Пользователи, уже записанные в базу: user_id -> отпечаток профиля.
+
+    Отпечаток - хэш (username, first_name, last_name), с которыми пользователь
+    последний раз прошел через запись. Совпадение означает, что в базе делать
+    нечего; смена username или имени дает промах и обычный путь записи.
+    """
+
+    def __init__(self, max_size: Optional[int] = None):
+        self.max_size = max_size
+        self._fingerprints: Dict[int, int] = {}
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(username: Optional[str], first_name: Optional[str], last_name: Optional[str]) -> int:
+        return hash((username or "", first_name or "", last_name or ""))
+
+    def is_current(self, user_id: int, fingerprint: int) -> bool:
+        """Известен ли пользователь с точно таким профилем"""
+        if self._fingerprints.get(user_id) == fingerprint:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, user_id: int, fingerprint: int, overwrite: bool = True):
+        """Запоминание пользователя (сверх max_size новые не добавляются - они пойдут в базу)"""
+        if not overwrite and user_id in self._fingerprints:
+            return
+        if (self.max_size is not None and user_id not in self._fingerprints
+                and len(self._fingerprints) >= self.max_size):
+            return
+        self._fingerprints[user_id] = fingerprint
+
+    def discard(self, user_id: int):
+        self._fingerprints.pop(user_id, None)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._fingerprints
+
+    def __len__(self) -> int:
+        return len(self._fingerprints)
+
+
+class CodeMap:
+    """Справочник id <-> код в памяти (subscription_types, payment_methods).
+
+    Строки справочников никогда не удаляются, поэтому однажды загруженная
+    пара id/код остается верной до конца работы процесса.
+    """
+
+    def __init__(self, table: str):
+        self.table = table
+        self._ids: Dict[str, int] = {}
+        self._codes: Dict[int, str] = {}
+
+    def load(self, rows):
+        """Загрузка пар (id, code)"""
+        for code_id, code in rows:
+            self.add(code_id, code)
+
+    def add(self, code_id: int, code: str):
+        self._ids[code] = code_id
+        self._codes[code_id] = code
+
+    def id_of(self, code: str) -> Optional[int]:
+        """id кода (None, если код еще не встречался)"""
+        return self._ids.get(code)
+
+    def code_of(self, code_id: int) -> Optional[str]:
+        """Код по id (None для неизвестного id)"""
+        return self._codes.get(code_id)
+
+    def __contains__(self, code: str) -> bool:
+        return code in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+
+class QueryCache:
+    """Кэш ответов методов чтения с инвалидацией по версиям таблиц.
+
+    Каждая закоммиченная запись увеличивает версию своих таблиц (bump),
+    запись кэша хранит версии таблиц на момент начала чтения и считается
+    устаревшей, как только хотя бы одна из них изменилась. Архиватор в том
+    же процессе тоже вызывает bump; записи других процессов кэш не видит -
+    их ограничивает ttl.
+    """
+
+    def __init__(self, maxsize: int = 2000, ttl: Optional[float] = 60.0):
+        self._entries = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._versions: Dict[str, int] = {}
+        # Общая версия: bump_all делает устаревшими все записи сразу
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        # Метод -> [попадания, промахи]
+        self.by_method: Dict[str, list] = {}
+
+    def versions(self, tables: Iterable[str]) -> Tuple[int, ...]:
+        """Текущие версии таблиц (снимок берется до чтения из базы)"""
+        return (self._epoch,) + tuple(self._versions.get(table, 0) for table in tables)
+
+    def lookup(self, method: str, key: Hashable, tables: Tuple[str, ...]) -> Tuple[bool, Any]:
+        """(найдено, значение) для ключа; устаревшая запись удаляется и считается промахом"""
+        counters = self.by_method.setdefault(method, [0, 0])
+        entry = self._entries.get(key, _MISSING)
+        if entry is not _MISSING:
+            value, versions = entry
+            if versions == self.versions(tables):
+                self.hits += 1
+                counters[0] += 1
+                return True, value
+            self._entries.invalidate(key)
+            self.stale += 1
+        self.misses += 1
+        counters[1] += 1
+        return False, None
+
+    def store(self, key: Hashable, value: Any, versions: Tuple[int, ...]):
+        """Сохранение ответа с версиями таблиц, снятыми до чтения"""
+        self._entries.set(key, (value, versions))
+
+    def bump(self, *tables: str):
+        """Запись в таблицы закоммичена: их кэшированные ответы устарели"""
+        for table in tables:
+            self._versions[table] = self._versions.get(table, 0) + 1
+
+    def bump_all(self):
+        """Изменение неизвестного набора таблиц: устаревает весь кэш"""
+        self._epoch += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        """Размер, попадания/промахи (всего и по методам), устаревшие записи"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self._entries.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            'methods': {method: {'hits': hits, 'misses': misses}
+                        for method, (hits, misses) in sorted(self.by_method.items())},
+        }
+
+    def render_prometheus(self) -> str:
+        """Счетчики кэша в текстовом формате Prometheus (дополняет GET /metrics)"""
+        lines = [
+            "# HELP db_query_cache_entries Записей в кэше запросов",
+            "# TYPE db_query_cache_entries gauge",
+            f"db_query_cache_entries {len(self._entries)}",
+            "# HELP db_query_cache_stale_total Записи, устаревшие из-за записи в таблицы",
+            "# TYPE db_query_cache_stale_total counter",
+            f"db_query_cache_stale_total {self.stale}",
+        ]
+        methods = sorted(self.by_method.items())
+        for metric, index, help_text in (
+            ("db_query_cache_hits_total", 0, "Ответы метода из кэша"),
+            ("db_query_cache_misses_total", 1, "Ответы метода из базы"),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            lines += [f'{metric}{{method="{method}"}} {counters[index]}' for method, counters in methods]
+        return "\n".join(lines) + "\n"
+
+
+def cached_query(method):
+    """Кэширование ответа метода хранилища в self.query_cache по (метод, аргументы).
+
+    Таблицы, от которых зависит ответ, берутся из QUERY_TABLES. Ответ
+    отдается вызывающим общим объектом - изменять его нельзя.
+    """
+    name = method.__name__
+    tables = QUERY_TABLES[name]
+    dated = name in DATE_DEPENDENT_QUERIES
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        cache: Optional[QueryCache] = self.query_cache
+        if cache is None:
+            return await method(self, *args, **kwargs)
+        key = (name, args, tuple(sorted(kwargs.items())))
+        if dated:
+            key += (time.strftime("%Y-%m-%d", time.gmtime()),)
+        found, value = cache.lookup(name, key, tables)
+        if found:
+            return value
+        versions = cache.versions(tables)
+        value = await method(self, *args, **kwargs)
+        cache.store(key, value, versions)
+        return value
+
+    return wrapper
+
+
+def create_query_cache(config) -> Optional[QueryCache]:
+    """Кэш запросов по настройкам (None, если DB_QUERY_CACHE_SIZE или DB_QUERY_CACHE_TTL не больше 0).
+
+    Без TTL устаревание от записей вне процесса ничем не ограничено,
+    поэтому бессрочного кэша нет.
+    """
+    maxsize = getattr(config, 'DB_QUERY_CACHE_SIZE', 0)
+    ttl = getattr(config, 'DB_QUERY_CACHE_TTL', 60.0)
+    if maxsize <= 0 or ttl <= 0:
+        return None
+    return QueryCache(maxsize=maxsize, ttl=ttl)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Выгрузка таблиц PassiveNFT Bot в сжатые файлы
+
+- Строки читаются из хранилища пачками по id (StorageBackend.iter_table),
+  в памяти одновременно не больше одной пачки - расход памяти не зависит
+  от размера таблицы
+- Для архивируемых таблиц (subscriptions, referral_earnings) сначала идут
+  строки из помесячных файлов архива (db_archive), затем рабочая таблица:
+  выгрузка содержит всю историю, архивация на это время приостановлена
+- Одинаковые запросы не запускают новую выгрузку: идущая выгрузка той же
+  таблицы и формата общая, готовый файл переиспользуется DB_EXPORT_REUSE_SEC
+  секунд, одновременно выполняется не больше max_concurrent выгрузок
+- Пачка сжимается и пишется в файл gzip (CSV или NDJSON) в отдельном потоке,
+  цикл событий бота не занят сжатием
+- Готовые файлы лежат в DB_EXPORT_DIR и удаляются через DB_EXPORT_TTL_MIN
+  минут: админ получает файл документом в Telegram (/export), а по HTTP он
+  отдается веб-сервером через sendfile без копирования в память процесса
+"""
+import asyncio
+import csv
+import gzip
+import json
+import logging
+import os
+import tempfile
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import IO, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+from db_archive import ARCHIVED_TABLE_NAMES, Archiver, open_archives
+from db_storage import CODED_COLUMNS, EXPORT_TABLES
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ("csv", "ndjson")
+
+
+@dataclass(frozen=True)
+class ExportResult:
+    """Готовый файл выгрузки"""
+    path: Path
+    table: str
+    format: str
+    rows: int
+    size_bytes: int
+    duration: float
+    # Строк из файлов архива (входят в rows)
+    archived_rows: int = 0
+
+
+def _write_batch(stream: IO[str], format: str, columns: Sequence[str], rows: List[Tuple]):
+    if format == "csv":
+        csv.writer(stream).writerows(rows)
+        return
+    stream.writelines(
+        json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) + "\n"
+        for row in rows
+    )
+
+
+class Exporter:
+    """Выгрузка таблиц из EXPORT_TABLES во временные файлы .csv.gz / .ndjson.gz"""
+
+    def __init__(self, storage, export_dir: Optional[str] = None, batch_size: int = 1000,
+                 compress_level: int = 6, ttl_minutes: float = 60.0,
+                 archiver: Optional[Archiver] = None, reuse_seconds: float = 60.0,
+                 max_concurrent: int = 2):
+        self.storage = storage
+        self.export_dir = Path(export_dir or Path(tempfile.gettempdir()) / "passive_nft_exports")
+        self.batch_size = max(1, batch_size)
+        self.compress_level = min(9, max(1, compress_level))
+        self.ttl = max(60.0, ttl_minutes * 60.0)
+        # Архив старой истории SQLite (None - архивов нет, выгружается только хранилище)
+        self.archiver = archiver
+        # Готовый файл отдается повторно, пока он моложе reuse_seconds (и не старше ttl)
+        self.reuse_seconds = max(0.0, min(reuse_seconds, self.ttl))
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrent))
+        # (таблица, формат) -> идущая выгрузка / последняя готовая и время ее окончания
+        self._running: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._recent: Dict[Tuple[str, str], Tuple[ExportResult, float]] = {}
+
+    def file_name(self, table: str, format: str, moment: Optional[datetime] = None) -> str:
+        """Имя файла выгрузки: <таблица>-<время UTC>.<формат>.gz"""
+        moment = moment or datetime.now(timezone.utc)
+        return f"{table}-{moment.strftime('%Y%m%d-%H%M%S')}.{format}.gz"
+
+    async def export(self, table: str, format: str = "csv") -> ExportResult:
+        """Выгрузка таблицы: свежий готовый файл, идущая выгрузка или новая"""
+        if table not in EXPORT_TABLES:
+            raise ValueError(f"Неизвестная таблица выгрузки: {table}")
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"Неизвестный формат выгрузки: {format}")
+        key = (table, format)
+
+        recent = self._recent.get(key)
+        if recent is not None:
+            result, finished = recent
+            if time.monotonic() - finished < self.reuse_seconds and result.path.is_file():
+                return result
+
+        running = self._running.get(key)
+        if running is None:
+            running = asyncio.ensure_future(self._export_new(table, format))
+            self._running[key] = running
+            running.add_done_callback(lambda future: self._export_done(key, future))
+        # Отмена одного запроса (обрыв HTTP-соединения) не прерывает общую выгрузку
+        return await asyncio.shield(running)
+
+    def _export_done(self, key: Tuple[str, str], future: asyncio.Future):
+        self._running.pop(key, None)
+        if future.cancelled():
+            return
+        # Ошибку получают и ожидающие, но их могло не остаться (запросы отменены)
+        error = future.exception()
+        if error is not None:
+            logger.error(f"❌ Ошибка выгрузки {key[0]} ({key[1]}): {error}")
+            return
+        self._recent[key] = (future.result(), time.monotonic())
+
+    async def _export_new(self, table: str, format: str) -> ExportResult:
+        async with self._semaphore:
+            return await self._write_export(table, format)
+
+    async def _batches(self, table: str, counter: Dict[str, int]) -> AsyncIterator[List[Tuple]]:
+        """Пачки строк таблицы: сначала файлы архива (если таблица архивируется), затем хранилище"""
+        db_table, columns = EXPORT_TABLES[table]
+        if self.archiver is not None and db_table in ARCHIVED_TABLE_NAMES:
+            select = [f"{column}_id" if column in CODED_COLUMNS else column for column in columns]
+            # В архиве хранятся id справочников - коды берутся из справочников хранилища
+            coded = [(index, getattr(self.storage, f"{column}s")) for index, column in enumerate(columns)
+                     if column in CODED_COLUMNS]
+            async for rows in self.archiver.iter_archived(db_table, select, self.batch_size):
+                rows = [list(row) for row in rows]
+                for row in rows:
+                    for index, dimension in coded:
+                        row[index] = dimension.code_of(row[index])
+                counter['archived'] += len(rows)
+                yield rows
+        async for rows in self.storage.iter_table(table, self.batch_size):
+            yield rows
+
+    async def _write_export(self, table: str, format: str) -> ExportResult:
+        """Выгрузка таблицы в новый файл, возвращает его описание"""
+        db_table, columns = EXPORT_TABLES[table]
+
+        await asyncio.to_thread(self.export_dir.mkdir, parents=True, exist_ok=True)
+        removed = await asyncio.to_thread(self.cleanup)
+        if removed:
+            logger.info(f"🧹 Удалено старых выгрузок: {removed}")
+
+        started = time.monotonic()
+        path = self.export_dir / self.file_name(table, format)
+        # Уникальное имя .part: две выгрузки одной таблицы в одну секунду не пересекаются
+        descriptor, partial_name = tempfile.mkstemp(prefix=path.name + ".", suffix=".part", dir=self.export_dir)
+        os.close(descriptor)
+        partial_path = Path(partial_name)
+
+        rows = 0
+        counter = {'archived': 0}
+        # Архивация не переносит строки, пока читаются и архив, и рабочая таблица
+        hold = (self.archiver.paused() if self.archiver is not None and db_table in ARCHIVED_TABLE_NAMES
+                else nullcontext())
+        stream = gzip.open(partial_path, "wt", encoding="utf-8", newline="", compresslevel=self.compress_level)
+        try:
+            if format == "csv":
+                await asyncio.to_thread(_write_batch, stream, format, columns, [columns])
+            async with hold:
+                async for batch in self._batches(table, counter):
+                    await asyncio.to_thread(_write_batch, stream, format, columns, batch)
+                    rows += len(batch)
+            await asyncio.to_thread(stream.close)
+            # Имя без .part появляется только у полностью записанного файла
+            await asyncio.to_thread(os.replace, partial_path, path)
+        except BaseException:
+            stream.close()
+            partial_path.unlink(missing_ok=True)
+            raise
+
+        result = ExportResult(
+            path=path, table=table, format=format, rows=rows,
+            size_bytes=path.stat().st_size, duration=time.monotonic() - started,
+            archived_rows=counter['archived']
+        )
+        logger.info(
+            f"📤 Выгрузка {table} ({format}): {rows} строк (из архива {result.archived_rows}), "
+            f"{result.size_bytes / 1024:.0f} КБ за {result.duration:.1f} с"
+        )
+        return result
+
+    def resolve(self, name: str) -> Optional[Path]:
+        """Путь к готовой выгрузке по имени файла (None, если ее нет или имя чужое)"""
+        path = self.export_dir / Path(name).name
+        if path.name != name or not path.name.endswith(".gz") or not path.is_file():
+            return None
+        return path
+
+    def cleanup(self, now: Optional[float] = None) -> int:
+        """Удаление выгрузок старше ttl, возвращает количество удаленных файлов"""
+        if not self.export_dir.is_dir():
+            return 0
+        now = now if now is not None else time.time()
+        removed = 0
+        for path in self.export_dir.iterdir():
+            if not path.name.endswith((".gz", ".part")):
+                continue
+            try:
+                if now - path.stat().st_mtime > self.ttl:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+
+def create_exporter(config, storage, archiver: Optional[Archiver] = None) -> Optional[Exporter]:
+    """Выгрузка таблиц по настройкам (None, если выключена).
+
+    archiver - работающий архиватор бота: выгрузка приостанавливает его проходы.
+    Без него архивы SQLite все равно читаются (они могли остаться от прежних запусков).
+    """
+    if not getattr(config, 'DB_EXPORT_ENABLED', False):
+        return None
+    return Exporter(
+        storage,
+        export_dir=getattr(config, 'DB_EXPORT_DIR', '') or None,
+        batch_size=getattr(config, 'DB_EXPORT_BATCH_SIZE', 1000),
+        ttl_minutes=getattr(config, 'DB_EXPORT_TTL_MIN', 60.0),
+        archiver=archiver or open_archives(config),
+        reuse_seconds=getattr(config, 'DB_EXPORT_REUSE_SEC', 60.0)
+    )
@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Массовый импорт пользователей и рефералов в PassiveNFT Bot
+
+- Файл CSV (с заголовком) или NDJSON, можно сжатый .gz, читается потоком:
+  в памяти одновременно не больше одной пачки строк
+- Строки проверяются, некорректные пропускаются с записью в лог (номер строки
+  и причина), пачка вставляется через executemany в одной транзакции
+- После каждой закоммиченной пачки позиция сохраняется в файл контрольной
+  точки рядом с исходным; после сбоя повторный запуск продолжает с нее
+- Существующие пользователи и связи не перезаписываются, username, уже
+  занятый другим пользователем, у импортируемой строки не сохраняется
+- Колонки: users - id, username, first_name, last_name, created_at;
+  referrals - referrer_id, referred_id, created_at (created_at - ISO-дата
+  или Unix-время, по умолчанию - момент импорта). Рефералы импортируются
+  после пользователей: связь с неизвестным пользователем отклоняется
+- Работающий бот не узнает об импорте из командной строки: его кэш ответов
+  статистики (DB_QUERY_CACHE_TTL) обновится не позже чем через TTL, а
+  импортированные пользователи при первом /start проходят обычным путем через
+  базу. Importer внутри процесса бота сбрасывает кэш запросов сам
+  (транзакции без списка таблиц)
+
+    python db_import.py users old_users.csv
+    python db_import.py referrals old_referrals.ndjson.gz --batch-size 10000
+"""
+import argparse
+import asyncio
+import csv
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+from typing import IO, Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+from db_storage import SQLStorageBackend, create_storage, normalize_username
+
+logger = logging.getLogger(__name__)
+
+IMPORT_KINDS = ("users", "referrals")
+IMPORT_FORMATS = ("csv", "ndjson")
+
+# Параметров в одном IN (...) - с запасом под лимит переменных старых сборок SQLite
+IN_CHUNK_SIZE = 500
+
+INSERT_USERS_SQL = """
+    INSERT INTO users (id, username, username_lower, first_name, last_name, referral_code, created_at, created_ts)
+    VALUES {}
+    ON CONFLICT (id) DO NOTHING
+    RETURNING id
+"""
+INSERT_REFERRALS_SQL = """
+    INSERT INTO referrals (referrer_id, referred_id, created_at)
+    VALUES {}
+    ON CONFLICT (referrer_id, referred_id) DO NOTHING
+    RETURNING id
+"""
+# Строк в одном многострочном INSERT (до 8 параметров на строку, предел SQLite - 32766)
+INSERT_CHUNK_ROWS = 500
+
+
+@dataclass
+class ImportResult:
+    """Итог импорта файла (счетчики - по всему файлу, включая прошлые запуски)"""
+    kind: str
+    source: Path
+    rows: int = 0
+    inserted: int = 0
+    skipped: int = 0
+    rejected: int = 0
+    resumed_from: int = 0
+    duration: float = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        """Скорость этого запуска (строки до контрольной точки не учитываются)"""
+        return (self.rows - self.resumed_from) / self.duration if self.duration > 0 else 0.0
+
+
+# ===== РАЗБОР СТРОК =====
+
+def _parse_id(record: Dict, field: str) -> int:
+    value = record.get(field)
+    if value is None or str(value).strip() == "":
+        raise ValueError(f"нет поля {field}")
+    try:
+        number = int(str(value).strip())
+    except ValueError:
+        raise ValueError(f"{field} не целое число: {value!r}")
+    if number <= 0 or number >= 2**63:
+        raise ValueError(f"{field} вне диапазона: {number}")
+    return number
+
+
+def _parse_text(record: Dict, field: str, max_length: int = 256) -> str:
+    value = record.get(field)
+    text = "" if value is None else str(value).strip()
+    if len(text) > max_length:
+        raise ValueError(f"{field} длиннее {max_length} символов")
+    return text
+
+
+def _parse_created_at(record: Dict, now: datetime) -> datetime:
+    """created_at как datetime UTC без часового пояса (так время хранится в базе)"""
+    value = record.get("created_at")
+    if value is None or str(value).strip() == "":
+        return now
+    text = str(value).strip()
+    try:
+        if text.isdigit():
+            moment = datetime.fromtimestamp(int(text), timezone.utc)
+        else:
+            moment = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    except (ValueError, OverflowError, OSError):
+        raise ValueError(f"created_at не дата: {value!r}")
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment.replace(microsecond=0)
+
+
+def parse_user(record: Dict, now: datetime) -> Tuple:
+    """(id, username, username_lower, first_name, last_name, created_at) из записи файла"""
+    user_id = _parse_id(record, "id")
+    username = _parse_text(record, "username", 64).lstrip("@")
+    return (
+        user_id, username, normalize_username(username),
+        _parse_text(record, "first_name"), _parse_text(record, "last_name"),
+        _parse_created_at(record, now)
+    )
+
+
+def parse_referral(record: Dict, now: datetime) -> Tuple:
+    """(referrer_id, referred_id, created_at) из записи файла"""
+    referrer_id = _parse_id(record, "referrer_id")
+    referred_id = _parse_id(record, "referred_id")
+    if referrer_id == referred_id:
+        raise ValueError("пользователь не может быть своим рефералом")
+    return referrer_id, referred_id, _parse_created_at(record, now)
+
+
+PARSERS: Dict[str, Callable[[Dict, datetime], Tuple]] = {
+    "users": parse_user,
+    "referrals": parse_referral,
+}
+
+
+# ===== ЧТЕНИЕ ФАЙЛА =====
+
+def detect_format(path: Path) -> str:
+    """Формат по расширению: .csv / .ndjson / .jsonl (можно с .gz)"""
+    suffixes = [suffix.lower() for suffix in path.suffixes if suffix.lower() != ".gz"]
+    extension = suffixes[-1] if suffixes else ""
+    if extension == ".csv":
+        return "csv"
+    if extension in (".ndjson", ".jsonl", ".json"):
+        return "ndjson"
+    raise ValueError(f"Не удалось определить формат {path.name}, укажите его явно")
+
+
+def _open_text(path: Path) -> IO[str]:
+    if path.suffix.lower() == ".gz":
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, "r", encoding="utf-8", newline="")
+
+
+def read_records(stream: IO[str], format: str) -> Iterator[Tuple[int, object]]:
+    """(номер строки файла, запись) по одной; запись - dict или ValueError при ошибке разбора"""
+    if format == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_number, ValueError(f"некорректный JSON: {e.msg}")
+            continue
+        yield line_number, record if isinstance(record, dict) else ValueError("строка не JSON-объект")
+
+
+# ===== ИМПОРТ =====
+
+class Importer:
+    """Импорт файлов пачками через SQLStorageBackend.transaction() (SQLite и PostgreSQL)"""
+
+    def __init__(self, storage: SQLStorageBackend, batch_size: int = 5000, progress_interval: float = 5.0,
+                 max_logged_rejects: int = 20):
+        if not isinstance(storage, SQLStorageBackend):
+            raise ValueError("Импорт требует SQL-хранилище (DB_BACKEND=sqlite или postgres)")
+        self.storage = storage
+        self.batch_size = max(1, batch_size)
+        self.progress_interval = progress_interval
+        self.max_logged_rejects = max_logged_rejects
+
+    @staticmethod
+    def checkpoint_path(source: Path, kind: str) -> Path:
+        """Файл контрольной точки: <файл>.<вид>.checkpoint.json рядом с исходным"""
+        return source.with_name(f"{source.name}.{kind}.checkpoint.json")
+
+    @staticmethod
+    def _source_fingerprint(source: Path) -> Dict:
+        stat = source.stat()
+        return {"size": stat.st_size, "mtime": int(stat.st_mtime)}
+
+    def _load_checkpoint(self, source: Path, kind: str) -> Optional[Dict]:
+        path = self.checkpoint_path(source, kind)
+        try:
+            checkpoint = json.loads(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Контрольная точка {path.name} не читается ({e}), импорт с начала")
+            return None
+        # Файл изменился после сбоя - позиция в нем больше ничего не значит
+        if checkpoint.get("source") != self._source_fingerprint(source):
+            logger.warning(f"⚠️ {source.name} изменился после контрольной точки, импорт с начала")
+            return None
+        return checkpoint
+
+    def _save_checkpoint(self, source: Path, result: ImportResult):
+        path = self.checkpoint_path(source, result.kind)
+        partial = path.with_name(path.name + ".part")
+        partial.write_text(json.dumps({
+            "source": self._source_fingerprint(source),
+            "rows": result.rows,
+            "inserted": result.inserted,
+            "skipped": result.skipped,
+            "rejected": result.rejected,
+        }), encoding="utf-8")
+        # Контрольная точка заменяется целиком: после сбоя остается старая или новая
+        os.replace(partial, path)
+
+    async def import_file(self, kind: str, source: Path, format: Optional[str] = None,
+                          resume: bool = True) -> ImportResult:
+        """Импорт файла целиком (с продолжением с контрольной точки при resume)"""
+        if kind not in IMPORT_KINDS:
+            raise ValueError(f"Неизвестный вид импорта: {kind}")
+        source = Path(source)
+        format = format or detect_format(source)
+        if format not in IMPORT_FORMATS:
+            raise ValueError(f"Неизвестный формат импорта: {format}")
+        parse = PARSERS[kind]
+        insert = self._insert_users if kind == "users" else self._insert_referrals
+
+        result = ImportResult(kind=kind, source=source)
+        checkpoint = self._load_checkpoint(source, kind) if resume else None
+        if checkpoint is not None:
+            result.rows = result.resumed_from = checkpoint["rows"]
+            result.inserted = checkpoint["inserted"]
+            result.skipped = checkpoint["skipped"]
+            result.rejected = checkpoint["rejected"]
+            logger.info(f"↩️ Импорт {source.name} продолжается с записи {result.rows}")
+
+        started = last_report = time.monotonic()
+        stream = await asyncio.to_thread(_open_text, source)
+        try:
+            records = read_records(stream, format)
+            # Уже импортированные записи пропускаются без разбора
+            if result.resumed_from:
+                await asyncio.to_thread(self._skip, records, result.resumed_from)
+
+            while True:
+                batch, count = await asyncio.to_thread(self._next_batch, records, parse, result)
+                if count == 0:
+                    break
+                if batch:
+                    inserted, rejected = await insert(batch)
+                    result.inserted += inserted
+                    result.rejected += rejected
+                    result.skipped += len(batch) - inserted - rejected
+                result.rows += count
+                await asyncio.to_thread(self._save_checkpoint, source, result)
+
+                result.duration = time.monotonic() - started
+                if time.monotonic() - last_report >= self.progress_interval:
+                    last_report = time.monotonic()
+                    self._log_progress(result)
+        finally:
+            stream.close()
+
+        result.duration = time.monotonic() - started
+        self.checkpoint_path(source, kind).unlink(missing_ok=True)
+        logger.info(
+            f"✅ Импорт {kind} из {source.name} завершен: {result.rows} записей за {result.duration:.1f} с "
+            f"({result.rows_per_second:.0f} строк/с), добавлено {result.inserted}, "
+            f"уже было {result.skipped}, отклонено {result.rejected}"
+        )
+        return result
+
+    @staticmethod
+    def _skip(records: Iterator, count: int):
+        for _ in zip(range(count), records):
+            pass
+
+    def _next_batch(self, records: Iterator, parse: Callable, result: ImportResult) -> Tuple[List[Tuple], int]:
+        """Следующая пачка проверенных строк и число прочитанных записей"""
+        now = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+        batch = []
+        count = 0
+        for line_number, record in records:
+            count += 1
+            try:
+                if isinstance(record, ValueError):
+                    raise record
+                batch.append(parse(record, now))
+            except ValueError as e:
+                result.rejected += 1
+                if result.rejected <= self.max_logged_rejects:
+                    logger.warning(f"⚠️ {result.source.name}:{line_number} отклонена: {e}")
+            if count >= self.batch_size:
+                break
+        return batch, count
+
+    def _log_progress(self, result: ImportResult):
+        logger.info(
+            f"📥 Импорт {result.kind}: {result.rows} записей, {result.rows_per_second:.0f} строк/с "
+            f"(добавлено {result.inserted}, уже было {result.skipped}, отклонено {result.rejected})"
+        )
+
+    @staticmethod
+    async def _existing(tx, sql: str, values: Sequence) -> Set:
+        """Значения из values, найденные запросом sql с IN ({}) (частями по IN_CHUNK_SIZE)"""
+        found = set()
+        values = list(values)
+        for start in range(0, len(values), IN_CHUNK_SIZE):
+            chunk = values[start:start + IN_CHUNK_SIZE]
+            rows = await tx.fetchall(sql.format(", ".join("?" * len(chunk))), tuple(chunk))
+            found.update(row[0] for row in rows)
+        return found
+
+    async def _insert_users(self, batch: List[Tuple]) -> Tuple[int, int]:
+        """Вставка пачки пользователей, возвращает (добавлено, отклонено)"""
+        async with self.storage.transaction() as tx:
+            existing = await self._existing(tx, "SELECT id FROM users WHERE id IN ({})", {row[0] for row in batch})
+            taken = await self._existing(
+                tx, "SELECT username_lower FROM users WHERE username_lower IN ({})",
+                {row[2] for row in batch if row[2]}
+            )
+            params = []
+            seen_ids = set()
+            for user_id, username, username_lower, first_name, last_name, created_at in batch:
+                if user_id in existing or user_id in seen_ids:
+                    continue
+                seen_ids.add(user_id)
+                # username остается у текущего владельца, у импортируемой строки - только имя для показа
+                if username_lower in taken:
+                    username_lower = None
+                elif username_lower:
+                    taken.add(username_lower)
+                created_ts = int(created_at.replace(tzinfo=timezone.utc).timestamp())
+                params.append((user_id, username, username_lower, first_name, last_name,
+                               f"ref_{user_id}", created_at, created_ts))
+            inserted = await self._insert_returning(tx, INSERT_USERS_SQL, params)
+        return inserted, 0
+
+    @staticmethod
+    async def _insert_returning(tx, sql: str, params: List[Tuple]) -> int:
+        """Многострочный INSERT ... RETURNING частями по INSERT_CHUNK_ROWS, возвращает число вставленных.
+
+        Строки, пропущенные ON CONFLICT DO NOTHING (повторный импорт, записи бота
+        параллельно), не попадают в число добавленных ни в SQLite, ни в PostgreSQL
+        """
+        inserted = 0
+        for start in range(0, len(params), INSERT_CHUNK_ROWS):
+            chunk = params[start:start + INSERT_CHUNK_ROWS]
+            placeholders = "(" + ", ".join("?" * len(chunk[0])) + ")"
+            rows = await tx.fetchall(sql.format(", ".join([placeholders] * len(chunk))),
+                                     tuple(value for row in chunk for value in row))
+            inserted += len(rows)
+        return inserted
+
+    async def _insert_referrals(self, batch: List[Tuple]) -> Tuple[int, int]:
+        """Вставка пачки связей реферер -> реферал, возвращает (добавлено, отклонено)"""
+        async with self.storage.transaction() as tx:
+            user_ids = {row[0] for row in batch} | {row[1] for row in batch}
+            known = await self._existing(tx, "SELECT id FROM users WHERE id IN ({})", user_ids)
+            params = [row for row in batch if row[0] in known and row[1] in known]
+            inserted = await self._insert_returning(tx, INSERT_REFERRALS_SQL, params)
+        unknown = len(batch) - len(params)
+        if unknown:
+            logger.warning(f"⚠️ Отклонено связей с неизвестными пользователями: {unknown}")
+        return inserted, unknown
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Массовый импорт пользователей и рефералов PassiveNFT Bot",
+        epilog="Работающий бот увидит импорт в статистике не позже чем через DB_QUERY_CACHE_TTL секунд "
+               "(или после перезапуска)."
+    )
+    parser.add_argument("kind", choices=IMPORT_KINDS, help="что импортировать")
+    parser.add_argument("source", help="файл CSV или NDJSON (можно .gz)")
+    parser.add_argument("--format", choices=IMPORT_FORMATS, help="формат файла (по умолчанию - по расширению)")
+    parser.add_argument("--batch-size", type=int, default=int(os.getenv("DB_IMPORT_BATCH_SIZE", "5000")),
+                        help="строк в одной транзакции")
+    parser.add_argument("--restart", action="store_true", help="игнорировать контрольную точку и начать сначала")
+    parser.add_argument("--backend", default=os.getenv("DB_BACKEND", "sqlite"), choices=("sqlite", "postgres"))
+    parser.add_argument("--db", default=os.getenv("DB_PATH", "passive_nft_bot.db"), help="файл базы SQLite")
+    parser.add_argument("--dsn", default=os.getenv("DB_POSTGRES_DSN", ""), help="строка подключения PostgreSQL")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    config = SimpleNamespace(
+        DB_BACKEND=args.backend, DB_PATH=args.db,
+        DB_WAL_MODE=os.getenv("DB_WAL_MODE", "true").lower() in ("1", "true", "yes")
+    )
+    if args.dsn:
+        config.DB_POSTGRES_DSN = args.dsn
+
+    async def run() -> ImportResult:
+        storage = create_storage(config)
+        await storage.initialize()
+        try:
+            importer = Importer(storage, batch_size=args.batch_size)
+            return await importer.import_file(args.kind, Path(args.source), args.format, resume=not args.restart)
+        finally:
+            await storage.close()
+
+    result = asyncio.run(run())
+    print(
+        f"{result.kind}: {result.rows} записей, добавлено {result.inserted}, уже было {result.skipped}, "
+        f"отклонено {result.rejected}, {result.rows_per_second:.0f} строк/с"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
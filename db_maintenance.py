@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Фоновое обслуживание базы SQLite для PassiveNFT Bot
+
+- Задачи: PRAGMA optimize, ANALYZE, wal_checkpoint(TRUNCATE), incremental_vacuum
+- Запуск в часы низкой нагрузки: сигнал нагрузки - частота входящих
+  обновлений Telegram (record_activity вызывается на каждое обновление).
+  Задача, просроченная вдвое, выполняется и под нагрузкой
+- Время каждой задачи ограничено: запрос прерывается обработчиком
+  прогресса SQLite по истечении бюджета, очистка идет короткими порциями
+- Время последнего запуска, длительность и результат каждой задачи
+  хранятся в таблице maintenance_runs и переживают перезапуск
+"""
+import asyncio
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class MaintenanceJob:
+    """Задача обслуживания: функция (соединение, срок) -> описание результата"""
+    name: str
+    interval_hours: float
+    run: Callable[[sqlite3.Connection, float], str]
+
+
+def _optimize(connection: sqlite3.Connection, deadline: float) -> str:
+    # analysis_limit ограничивает число строк, просматриваемых на индекс
+    connection.execute("PRAGMA analysis_limit = 1000")
+    connection.execute("PRAGMA optimize")
+    return "ok"
+
+
+def _analyze(connection: sqlite3.Connection, deadline: float) -> str:
+    connection.execute("PRAGMA analysis_limit = 1000")
+    connection.execute("ANALYZE")
+    return "ok"
+
+
+def _wal_checkpoint(connection: sqlite3.Connection, deadline: float) -> str:
+    if connection.execute("PRAGMA journal_mode").fetchone()[0].lower() != "wal":
+        return "skipped: not WAL"
+    # TRUNCATE ждет читателей и на это время придерживает новых писателей,
+    # поэтому ждем не дольше 100 мс, а при занятости откатываемся на PASSIVE
+    connection.execute("PRAGMA busy_timeout = 100")
+    busy, log_pages, checkpointed = connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    if busy:
+        busy, log_pages, checkpointed = connection.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        return f"passive: {checkpointed}/{log_pages} pages"
+    return f"truncated: {checkpointed} pages"
+
+
+def _incremental_vacuum(connection: sqlite3.Connection, deadline: float, pages_per_step: int = 256) -> str:
+    if connection.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return "skipped: auto_vacuum != INCREMENTAL"
+    initial = remaining = connection.execute("PRAGMA freelist_count").fetchone()[0]
+    while remaining and time.monotonic() < deadline:
+        # Каждая порция - отдельная короткая транзакция записи. executescript
+        # доводит прагму до конца (execute освобождает лишь одну страницу за шаг)
+        connection.executescript(f"PRAGMA incremental_vacuum({min(pages_per_step, remaining)})")
+        remaining = connection.execute("PRAGMA freelist_count").fetchone()[0]
+    return f"freed {initial - remaining} pages, {remaining} left"
+
+
+DEFAULT_JOBS: Tuple[MaintenanceJob, ...] = (
+    MaintenanceJob("wal_checkpoint", interval_hours=1.0, run=_wal_checkpoint),
+    MaintenanceJob("optimize", interval_hours=6.0, run=_optimize),
+    MaintenanceJob("incremental_vacuum", interval_hours=24.0, run=_incremental_vacuum),
+    MaintenanceJob("analyze", interval_hours=168.0, run=_analyze),
+)
+
+
+class MaintenanceScheduler:
+    """Планировщик задач обслуживания внутри процесса бота.
+
+    Раз в check_interval секунд частота обновлений за прошедший период
+    сравнивается с idle_updates_per_minute; при низкой нагрузке
+    выполняются задачи, у которых подошел срок, по одной за раз.
+    """
+
+    def __init__(self, db_path: str, jobs: Tuple[MaintenanceJob, ...] = DEFAULT_JOBS,
+                 job_budget_ms: float = 1000.0, idle_updates_per_minute: float = 5.0,
+                 check_interval: float = 60.0):
+        self.db_path = Path(db_path)
+        self.jobs = {job.name: job for job in jobs}
+        self.job_budget = max(0.01, job_budget_ms / 1000.0)
+        self.idle_updates_per_minute = idle_updates_per_minute
+        self.check_interval = max(1.0, check_interval)
+        # Счетчик обновлений с начала текущего периода (сигнал нагрузки)
+        self._updates = 0
+        self._period_started = time.monotonic()
+        self.updates_per_minute = 0.0
+        # job -> (время последнего запуска, длительность мс, результат)
+        self.last_runs: Dict[str, Tuple[int, float, str]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def record_activity(self):
+        """Отметка входящего обновления (вызывается на каждое обновление Telegram)"""
+        self._updates += 1
+
+    def _sample_traffic(self) -> float:
+        now = time.monotonic()
+        elapsed = max(now - self._period_started, 1e-6)
+        self.updates_per_minute = self._updates * 60.0 / elapsed
+        self._updates = 0
+        self._period_started = now
+        return self.updates_per_minute
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.db_path, isolation_level=None)
+        # Ожидание блокировок тоже входит в бюджет задачи
+        connection.execute(f"PRAGMA busy_timeout = {int(self.job_budget * 1000)}")
+        return connection
+
+    # ===== ВЫПОЛНЕНИЕ ЗАДАЧ =====
+
+    def due_jobs(self, now: Optional[int] = None, overdue_factor: float = 1.0):
+        """Задачи, у которых с последнего запуска прошло больше interval * overdue_factor"""
+        now = now if now is not None else int(time.time())
+        for job in self.jobs.values():
+            last_run = self.last_runs.get(job.name, (0, 0.0, ""))[0]
+            if now - last_run >= job.interval_hours * 3600 * overdue_factor:
+                yield job
+
+    async def run_job(self, name: str) -> Tuple[float, str]:
+        """Выполнение задачи сейчас (в отдельном потоке), возвращает (длительность мс, результат)"""
+        job = self.jobs[name]
+        duration_ms, status = await asyncio.to_thread(self._run_job_sync, job)
+        level = logging.INFO if not status.startswith("error") else logging.WARNING
+        logger.log(level, f"🧹 Обслуживание {name}: {status} ({duration_ms:.0f} мс)")
+        return duration_ms, status
+
+    def _run_job_sync(self, job: MaintenanceJob) -> Tuple[float, str]:
+        started_at = int(time.time())
+        started = time.monotonic()
+        deadline = started + self.job_budget
+
+        def progress() -> int:
+            # Ненулевой ответ прерывает текущий запрос SQLite
+            return 1 if time.monotonic() > deadline else 0
+
+        connection = self._connect()
+        try:
+            connection.set_progress_handler(progress, 10000)
+            try:
+                status = job.run(connection, deadline)
+            except sqlite3.OperationalError as e:
+                status = "timeout: interrupted" if "interrupt" in str(e) else f"error: {e}"
+            connection.set_progress_handler(None, 0)
+            duration_ms = (time.monotonic() - started) * 1000
+            self.last_runs[job.name] = (started_at, duration_ms, status)
+            connection.execute("""
+                INSERT INTO maintenance_runs (job, last_run_ts, duration_ms, status)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (job) DO UPDATE SET
+                    last_run_ts = excluded.last_run_ts,
+                    duration_ms = excluded.duration_ms,
+                    status = excluded.status
+            """, (job.name, started_at, duration_ms, status))
+            return duration_ms, status
+        finally:
+            connection.close()
+
+    def _load_last_runs_sync(self):
+        connection = self._connect()
+        try:
+            rows = connection.execute("SELECT job, last_run_ts, duration_ms, status FROM maintenance_runs").fetchall()
+        finally:
+            connection.close()
+        self.last_runs = {job: (last_run, duration, status) for job, last_run, duration, status in rows}
+
+    # ===== ФОНОВАЯ ЗАДАЧА =====
+
+    async def start(self):
+        """Загрузка истории запусков и старт планировщика"""
+        if self._task is not None:
+            return
+        await asyncio.to_thread(self._load_last_runs_sync)
+        self._period_started = time.monotonic()
+        self._task = asyncio.create_task(self._loop())
+        logger.info(
+            f"🧹 Обслуживание БД: задачи {', '.join(self.jobs)}, бюджет {self.job_budget * 1000:.0f} мс, "
+            f"тихий режим до {self.idle_updates_per_minute:g} обновлений/мин"
+        )
+
+    async def stop(self):
+        """Остановка планировщика (выполняющаяся задача ограничена бюджетом и доработает сама)"""
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            idle = self._sample_traffic() <= self.idle_updates_per_minute
+            # Под нагрузкой - только сильно просроченные задачи, чтобы их не откладывать вечно
+            job = next(self.due_jobs(overdue_factor=1.0 if idle else 2.0), None)
+            if job is None:
+                continue
+            try:
+                await self.run_job(job.name)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка обслуживания {job.name}: {e}")
+
+    def status(self) -> Dict[str, Dict]:
+        """Последний запуск каждой задачи (для статистики и метрик)"""
+        status = {}
+        for name in self.jobs:
+            last_run, duration_ms, result = self.last_runs.get(name, (None, None, None))
+            status[name] = {'last_run_ts': last_run, 'duration_ms': duration_ms, 'status': result}
+        return status
+
+
+def create_maintenance_scheduler(config) -> Optional[MaintenanceScheduler]:
+    """Планировщик обслуживания по настройкам (None, если выключен или хранилище не SQLite)"""
+    if not getattr(config, 'DB_MAINTENANCE_ENABLED', False):
+        return None
+    if str(getattr(config, 'DB_BACKEND', 'sqlite')).lower() != 'sqlite':
+        return None
+    return MaintenanceScheduler(
+        db_path=getattr(config, 'DB_PATH', 'passive_nft_bot.db'),
+        job_budget_ms=getattr(config, 'DB_MAINTENANCE_JOB_BUDGET_MS', 1000.0),
+        idle_updates_per_minute=getattr(config, 'DB_MAINTENANCE_IDLE_UPDATES_PER_MIN', 5.0)
+    )
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Метрики методов хранилища PassiveNFT Bot
+
+- Для каждого метода StorageBackend: число вызовов и ошибок, гистограммы
+  ожидания блокировки записи, ожидания соединения (пул читателей / пул
+  PostgreSQL), собственно выполнения и числа возвращенных строк
+- Методы оборачиваются на экземпляре хранилища (instrument): при
+  выключенных метриках обертки нет вовсе, а хранилище делает лишь одно
+  чтение ContextVar на соединение (десятки наносекунд)
+- Фазы ожидания хранилище добавляет в CURRENT_CALL текущего вызова, время
+  выполнения - все остальное время вызова
+- Выборка: замеряется каждый sample_every-й вызов метода, вызовы и ошибки
+  считаются всегда
+- snapshot() - данные внутри процесса, render_prometheus() - текст
+  для GET /metrics веб-сервера
+"""
+import functools
+import inspect
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
+
+from db_storage import StorageBackend
+
+# Границы корзин: время в секундах и число строк
+LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+ROW_BUCKETS: Tuple[float, ...] = (0, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class CallTimings:
+    """Время ожидания внутри одного замеряемого вызова (заполняет хранилище)"""
+    __slots__ = ("lock_wait", "connection_wait")
+
+    def __init__(self):
+        self.lock_wait = 0.0
+        self.connection_wait = 0.0
+
+
+# Замеряемый вызов в текущей задаче (None - вызов не замеряется)
+CURRENT_CALL: ContextVar[Optional[CallTimings]] = ContextVar("db_current_call", default=None)
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин (как histogram в Prometheus)"""
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # Последняя корзина - значения больше верхней границы (+Inf)
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Верхняя граница корзины, в которую попадает квантиль q (None, если данных нет)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'avg': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+
+class MethodStats:
+    """Счетчики и гистограммы одного метода хранилища"""
+    __slots__ = ("calls", "errors", "lock_wait", "connection_wait", "execute", "rows")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.lock_wait = Histogram(LATENCY_BUCKETS)
+        self.connection_wait = Histogram(LATENCY_BUCKETS)
+        self.execute = Histogram(LATENCY_BUCKETS)
+        self.rows = Histogram(ROW_BUCKETS)
+
+    def record(self, elapsed: float, timings: CallTimings):
+        self.lock_wait.observe(timings.lock_wait)
+        self.connection_wait.observe(timings.connection_wait)
+        self.execute.observe(max(0.0, elapsed - timings.lock_wait - timings.connection_wait))
+
+
+def _row_count(result: Any) -> int:
+    """Строк в ответе метода: длина списка, 0 для None/False, иначе 1"""
+    if result is None or result is False:
+        return 0
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    return 1
+
+
+def instrumented_methods() -> List[str]:
+    """Асинхронные методы StorageBackend, кроме жизненного цикла"""
+    return [
+        name for name, member in vars(StorageBackend).items()
+        if inspect.iscoroutinefunction(member) and name not in ("initialize", "close")
+    ]
+
+
+class DatabaseMetrics:
+    """Реестр метрик методов хранилища"""
+
+    def __init__(self, sample_rate: float = 1.0):
+        self.methods: Dict[str, MethodStats] = {}
+        self.sample_every = 1
+        self.set_sample_rate(sample_rate)
+
+    def set_sample_rate(self, sample_rate: float):
+        """Доля замеряемых вызовов (0 < rate <= 1): 0.1 - каждый десятый"""
+        if sample_rate <= 0:
+            raise ValueError("sample_rate должен быть больше 0 (для выключения - uninstrument)")
+        self.sample_every = max(1, round(1 / min(1.0, sample_rate)))
+
+    # ===== ПОДКЛЮЧЕНИЕ К ХРАНИЛИЩУ =====
+
+    def instrument(self, storage):
+        """Обертка методов на экземпляре хранилища (класс не меняется)"""
+        for name in instrumented_methods():
+            method = getattr(storage, name, None)
+            if method is None or name in vars(storage):
+                continue
+            setattr(storage, name, self._wrap(name, method))
+        return storage
+
+    @staticmethod
+    def uninstrument(storage):
+        """Снятие оберток: вызовы снова идут напрямую в методы класса"""
+        for name in instrumented_methods():
+            vars(storage).pop(name, None)
+        return storage
+
+    def _wrap(self, name: str, method):
+        stats = self.methods.setdefault(name, MethodStats())
+
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            stats.calls += 1
+            if stats.calls % self.sample_every:
+                try:
+                    return await method(*args, **kwargs)
+                except Exception:
+                    stats.errors += 1
+                    raise
+
+            timings = CallTimings()
+            token = CURRENT_CALL.set(timings)
+            started = time.perf_counter()
+            try:
+                result = await method(*args, **kwargs)
+            except Exception:
+                stats.errors += 1
+                raise
+            finally:
+                CURRENT_CALL.reset(token)
+                stats.record(time.perf_counter() - started, timings)
+            stats.rows.observe(_row_count(result))
+            return result
+
+        return wrapper
+
+    # ===== ЧТЕНИЕ =====
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Сводка по методам (вызовы, ошибки, среднее и квантили каждой фазы)"""
+        return {
+            name: {
+                'calls': stats.calls,
+                'errors': stats.errors,
+                'lock_wait': stats.lock_wait.snapshot(),
+                'connection_wait': stats.connection_wait.snapshot(),
+                'execute': stats.execute.snapshot(),
+                'rows': stats.rows.snapshot(),
+            }
+            for name, stats in sorted(self.methods.items())
+            if stats.calls
+        }
+
+    def render_prometheus(self) -> str:
+        """Метрики в текстовом формате Prometheus"""
+        lines = [
+            "# HELP db_method_calls_total Вызовы метода хранилища",
+            "# TYPE db_method_calls_total counter",
+        ]
+        active = [(name, stats) for name, stats in sorted(self.methods.items()) if stats.calls]
+        lines += [f'db_method_calls_total{{method="{name}"}} {stats.calls}' for name, stats in active]
+        lines += [
+            "# HELP db_method_errors_total Вызовы метода, завершившиеся исключением",
+            "# TYPE db_method_errors_total counter",
+        ]
+        lines += [f'db_method_errors_total{{method="{name}"}} {stats.errors}' for name, stats in active]
+
+        for metric, attribute, help_text in (
+            ("db_method_lock_wait_seconds", "lock_wait", "Ожидание блокировки записи"),
+            ("db_method_connection_wait_seconds", "connection_wait", "Ожидание соединения из пула"),
+            ("db_method_execute_seconds", "execute", "Выполнение без учета ожиданий"),
+            ("db_method_rows", "rows", "Строк в ответе метода"),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for name, stats in active:
+                histogram: Histogram = getattr(stats, attribute)
+                cumulative = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{method="{name}",le="{bound:g}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{method="{name}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{metric}_sum{{method="{name}"}} {histogram.sum:.6f}')
+                lines.append(f'{metric}_count{{method="{name}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+
+def create_database_metrics(config) -> Optional[DatabaseMetrics]:
+    """Метрики хранилища по настройкам (None, если выключены)"""
+    sample_rate = getattr(config, 'DB_METRICS_SAMPLE_RATE', 1.0)
+    if not getattr(config, 'DB_METRICS_ENABLED', False) or sample_rate <= 0:
+        return None
+    return DatabaseMetrics(sample_rate=sample_rate)
@@ -0,0 +1,1253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Версионированные миграции схемы для PassiveNFT Bot
+
+- Версия схемы хранится в таблице schema_migrations
+- Пронумерованные миграции применяются при старте, каждая в своей транзакции
+- Тяжелые изменения данных (backfill новых колонок) выполняются в фоне
+  небольшими пачками, чтобы старт и работа бота не ждали переписывания
+  всей таблицы
+"""
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from db_storage import SQLStorageBackend
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Backfill:
+    """Фоновое заполнение данных по диапазонам id.
+
+    sql выполняется с параметрами (lo, hi) и должен обновлять только строки
+    с lo < id <= hi. Новые строки, записанные после миграции, уже должны
+    заполняться кодом записи - backfill догоняет только старые.
+    """
+    name: str
+    table: str
+    sql: str
+    chunk_size: int = 500
+    key: str = "id"
+
+
+@dataclass(frozen=True)
+class Migration:
+    """Пронумерованная миграция схемы"""
+    version: int
+    name: str
+    statements: Tuple[str, ...] = ()
+    # Для сложных миграций: функция, получающая Transaction
+    apply: Optional[Callable[..., Awaitable[None]]] = None
+    backfills: Tuple[Backfill, ...] = field(default_factory=tuple)
+
+
+# ===== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ДЛЯ СЛОЖНЫХ МИГРАЦИЙ =====
+
+async def rebuild_table(tx, table: str, create_sql: str, copy_sql: str):
+    """Пересоздание таблицы с новой схемой (SQLite не умеет менять тип колонки).
+
+    create_sql создает {table}_new, copy_sql копирует в нее строки из {table}.
+    Счетчик AUTOINCREMENT переносится, чтобы id удаленных строк не выдавались
+    повторно. Индексы и триггеры старой таблицы удаляются вместе с ней -
+    их нужно создать заново после вызова.
+    """
+    new_table = f"{table}_new"
+    await tx.execute(create_sql)
+    await tx.execute(copy_sql)
+    await tx.execute("DELETE FROM sqlite_sequence WHERE name = ?", (new_table,))
+    await tx.execute("""
+        INSERT INTO sqlite_sequence (name, seq)
+        SELECT ?, seq FROM sqlite_sequence WHERE name = ?
+    """, (new_table, table))
+    await tx.execute(f"DROP TABLE {table}")
+    await tx.execute(f"ALTER TABLE {new_table} RENAME TO {table}")
+
+
+async def _apply_dimension_tables(tx):
+    """Перевод subscription_type и payment_method на целочисленные ключи справочников"""
+    await tx.execute("""
+        CREATE TABLE IF NOT EXISTS subscription_types (
+            id INTEGER PRIMARY KEY,
+            code TEXT NOT NULL UNIQUE
+        )
+    """)
+    await tx.execute("""
+        CREATE TABLE IF NOT EXISTS payment_methods (
+            id INTEGER PRIMARY KEY,
+            code TEXT NOT NULL UNIQUE
+        )
+    """)
+    await tx.execute("INSERT OR IGNORE INTO payment_methods (code) VALUES ('TON'), ('STARS')")
+    await tx.execute("""
+        INSERT OR IGNORE INTO payment_methods (code)
+        SELECT payment_method FROM subscriptions
+        UNION SELECT payment_method FROM referral_earnings
+        UNION SELECT payment_method FROM referral_rollup
+    """)
+    await tx.execute("""
+        INSERT OR IGNORE INTO subscription_types (code)
+        SELECT subscription_type FROM subscriptions
+        UNION SELECT subscription_type FROM referral_earnings
+        UNION SELECT subscription_type FROM referral_rollup
+        UNION SELECT subscription_type FROM confirmation_logs
+        UNION SELECT subscription_type FROM confirmation_daily
+    """)
+
+    # Триггеры читают текстовые колонки - удаляются до пересоздания таблиц
+    for trigger in ("trg_counters_earnings_insert", "trg_counters_earnings_delete",
+                    "trg_referral_rollup_insert", "trg_referral_rollup_delete"):
+        await tx.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+
+    await rebuild_table(tx, "subscriptions", """
+        CREATE TABLE subscriptions_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            subscription_type_id INTEGER NOT NULL,
+            payment_method_id INTEGER NOT NULL,
+            amount REAL,
+            currency TEXT DEFAULT 'TON',
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_ts INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (subscription_type_id) REFERENCES subscription_types (id),
+            FOREIGN KEY (payment_method_id) REFERENCES payment_methods (id)
+        )
+    """, """
+        INSERT INTO subscriptions_new
+            (id, user_id, subscription_type_id, payment_method_id, amount, currency, status, created_at, created_ts)
+        SELECT s.id, s.user_id, st.id, pm.id, s.amount, s.currency, s.status, s.created_at, s.created_ts
+        FROM subscriptions s
+        JOIN subscription_types st ON st.code = s.subscription_type
+        JOIN payment_methods pm ON pm.code = s.payment_method
+    """)
+    await tx.execute("CREATE INDEX idx_subscriptions_user_status ON subscriptions (user_id, status)")
+    await tx.execute("CREATE INDEX idx_subscriptions_created_ts ON subscriptions (created_ts)")
+
+    await rebuild_table(tx, "referral_earnings", """
+        CREATE TABLE referral_earnings_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            referrer_id INTEGER NOT NULL,
+            referred_id INTEGER NOT NULL,
+            commission_amount REAL NOT NULL,
+            subscription_type_id INTEGER NOT NULL,
+            payment_method_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_ts INTEGER,
+            FOREIGN KEY (referrer_id) REFERENCES users (id),
+            FOREIGN KEY (referred_id) REFERENCES users (id),
+            FOREIGN KEY (subscription_type_id) REFERENCES subscription_types (id),
+            FOREIGN KEY (payment_method_id) REFERENCES payment_methods (id)
+        )
+    """, """
+        INSERT INTO referral_earnings_new
+            (id, referrer_id, referred_id, commission_amount, subscription_type_id, payment_method_id,
+             created_at, created_ts)
+        SELECT e.id, e.referrer_id, e.referred_id, e.commission_amount, st.id, pm.id,
+               e.created_at, e.created_ts
+        FROM referral_earnings e
+        JOIN subscription_types st ON st.code = e.subscription_type
+        JOIN payment_methods pm ON pm.code = e.payment_method
+    """)
+    await tx.execute("""
+        CREATE INDEX idx_earnings_referrer_type
+        ON referral_earnings (referrer_id, subscription_type_id, payment_method_id, referred_id, commission_amount)
+    """)
+    await tx.execute("CREATE INDEX idx_earnings_referred ON referral_earnings (referred_id)")
+    await tx.execute("CREATE INDEX idx_earnings_created_ts ON referral_earnings (created_ts)")
+
+    await rebuild_table(tx, "confirmation_logs", """
+        CREATE TABLE confirmation_logs_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            subscription_type_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            link_id TEXT NOT NULL UNIQUE,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_ts INTEGER,
+            FOREIGN KEY (subscription_type_id) REFERENCES subscription_types (id)
+        )
+    """, """
+        INSERT INTO confirmation_logs_new
+            (id, admin_id, subscription_type_id, username, link_id, timestamp, created_ts)
+        SELECT c.id, c.admin_id, st.id, c.username, c.link_id, c.timestamp, c.created_ts
+        FROM confirmation_logs c
+        JOIN subscription_types st ON st.code = c.subscription_type
+    """)
+    await tx.execute("CREATE INDEX idx_confirmation_logs_created_ts ON confirmation_logs (created_ts)")
+
+    await rebuild_table(tx, "referral_rollup", """
+        CREATE TABLE referral_rollup_new (
+            referrer_id INTEGER NOT NULL,
+            subscription_type_id INTEGER NOT NULL,
+            payment_method_id INTEGER NOT NULL,
+            referral_count INTEGER NOT NULL DEFAULT 0,
+            commission_sum REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (referrer_id, subscription_type_id, payment_method_id)
+        ) WITHOUT ROWID
+    """, """
+        INSERT INTO referral_rollup_new
+            (referrer_id, subscription_type_id, payment_method_id, referral_count, commission_sum)
+        SELECT r.referrer_id, st.id, pm.id, r.referral_count, r.commission_sum
+        FROM referral_rollup r
+        JOIN subscription_types st ON st.code = r.subscription_type
+        JOIN payment_methods pm ON pm.code = r.payment_method
+    """)
+    await tx.execute("""
+        CREATE INDEX idx_referral_rollup_type
+        ON referral_rollup (subscription_type_id, referrer_id)
+    """)
+
+    await rebuild_table(tx, "confirmation_daily", """
+        CREATE TABLE confirmation_daily_new (
+            day TEXT NOT NULL,
+            subscription_type_id INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, subscription_type_id)
+        ) WITHOUT ROWID
+    """, """
+        INSERT INTO confirmation_daily_new (day, subscription_type_id, count)
+        SELECT d.day, st.id, d.count
+        FROM confirmation_daily d
+        JOIN subscription_types st ON st.code = d.subscription_type
+    """)
+
+    # Те же триггеры счетчиков и предагрегата, но на целочисленных ключах
+    await tx.execute("""
+        CREATE TRIGGER trg_counters_earnings_insert AFTER INSERT ON referral_earnings
+        WHEN NEW.payment_method_id = (SELECT id FROM payment_methods WHERE code = 'TON')
+        BEGIN
+            UPDATE counters SET value = value + NEW.commission_amount WHERE name = 'commission_ton';
+        END
+    """)
+    await tx.execute("""
+        CREATE TRIGGER trg_counters_earnings_delete AFTER DELETE ON referral_earnings
+        WHEN OLD.payment_method_id = (SELECT id FROM payment_methods WHERE code = 'TON')
+        BEGIN
+            UPDATE counters SET value = value - OLD.commission_amount WHERE name = 'commission_ton';
+        END
+    """)
+    await tx.execute("""
+        CREATE TRIGGER trg_referral_rollup_insert AFTER INSERT ON referral_earnings
+        BEGIN
+            INSERT INTO referral_rollup
+                (referrer_id, subscription_type_id, payment_method_id, referral_count, commission_sum)
+            VALUES (
+                NEW.referrer_id, NEW.subscription_type_id, NEW.payment_method_id,
+                NOT EXISTS (
+                    SELECT 1 FROM referral_earnings
+                    WHERE referrer_id = NEW.referrer_id
+                    AND subscription_type_id = NEW.subscription_type_id
+                    AND payment_method_id = NEW.payment_method_id
+                    AND referred_id = NEW.referred_id
+                    AND id != NEW.id
+                ),
+                NEW.commission_amount
+            )
+            ON CONFLICT (referrer_id, subscription_type_id, payment_method_id) DO UPDATE SET
+                referral_count = referral_count + excluded.referral_count,
+                commission_sum = commission_sum + excluded.commission_sum;
+        END
+    """)
+    await tx.execute("""
+        CREATE TRIGGER trg_referral_rollup_delete AFTER DELETE ON referral_earnings
+        BEGIN
+            UPDATE referral_rollup SET
+                commission_sum = commission_sum - OLD.commission_amount,
+                referral_count = referral_count - NOT EXISTS (
+                    SELECT 1 FROM referral_earnings
+                    WHERE referrer_id = OLD.referrer_id
+                    AND subscription_type_id = OLD.subscription_type_id
+                    AND payment_method_id = OLD.payment_method_id
+                    AND referred_id = OLD.referred_id
+                )
+            WHERE referrer_id = OLD.referrer_id
+            AND subscription_type_id = OLD.subscription_type_id
+            AND payment_method_id = OLD.payment_method_id;
+        END
+    """)
+
+
+# Пока в maintenance_flags есть строка 'archiving', удаление строк referral_earnings
+# не трогает счетчики и предагрегат: строки переезжают в архив, а не исчезают
+ARCHIVING_GUARD_SQL = "NOT EXISTS (SELECT 1 FROM maintenance_flags WHERE name = 'archiving')"
+
+
+async def _apply_archive_guard(tx):
+    """Флаг архивации и триггеры удаления referral_earnings, которые его учитывают"""
+    await tx.execute("""
+        CREATE TABLE IF NOT EXISTS maintenance_flags (
+            name TEXT PRIMARY KEY
+        ) WITHOUT ROWID
+    """)
+    await tx.execute("DROP TRIGGER IF EXISTS trg_counters_earnings_delete")
+    await tx.execute("DROP TRIGGER IF EXISTS trg_referral_rollup_delete")
+    await tx.execute(f"""
+        CREATE TRIGGER trg_counters_earnings_delete AFTER DELETE ON referral_earnings
+        WHEN OLD.payment_method_id = (SELECT id FROM payment_methods WHERE code = 'TON')
+        AND {ARCHIVING_GUARD_SQL}
+        BEGIN
+            UPDATE counters SET value = value - OLD.commission_amount WHERE name = 'commission_ton';
+        END
+    """)
+    await tx.execute(f"""
+        CREATE TRIGGER trg_referral_rollup_delete AFTER DELETE ON referral_earnings
+        WHEN {ARCHIVING_GUARD_SQL}
+        BEGIN
+            UPDATE referral_rollup SET
+                commission_sum = commission_sum - OLD.commission_amount,
+                referral_count = referral_count - NOT EXISTS (
+                    SELECT 1 FROM referral_earnings
+                    WHERE referrer_id = OLD.referrer_id
+                    AND subscription_type_id = OLD.subscription_type_id
+                    AND payment_method_id = OLD.payment_method_id
+                    AND referred_id = OLD.referred_id
+                )
+            WHERE referrer_id = OLD.referrer_id
+            AND subscription_type_id = OLD.subscription_type_id
+            AND payment_method_id = OLD.payment_method_id;
+        END
+    """)
+
+
+# ===== СПИСОК МИГРАЦИЙ (только добавлять в конец, не менять примененные) =====
+
+MIGRATIONS: List[Migration] = [
+    Migration(
+        version=1,
+        name="baseline_schema",
+        statements=(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                referral_code TEXT UNIQUE
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS referrals (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                referrer_id INTEGER NOT NULL,
+                referred_id INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (referrer_id) REFERENCES users (id),
+                FOREIGN KEY (referred_id) REFERENCES users (id),
+                UNIQUE(referrer_id, referred_id)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS pending_referrals (
+                user_id INTEGER PRIMARY KEY,
+                referrer_id INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (id),
+                FOREIGN KEY (referrer_id) REFERENCES users (id)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS subscriptions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                subscription_type TEXT NOT NULL,
+                payment_method TEXT NOT NULL,
+                amount REAL,
+                currency TEXT DEFAULT 'TON',
+                status TEXT DEFAULT 'pending',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS referral_earnings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                referrer_id INTEGER NOT NULL,
+                referred_id INTEGER NOT NULL,
+                commission_amount REAL NOT NULL,
+                subscription_type TEXT NOT NULL,
+                payment_method TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (referrer_id) REFERENCES users (id),
+                FOREIGN KEY (referred_id) REFERENCES users (id)
+            )
+            """,
+            # ТАБЛИЦА ДЛЯ СИСТЕМЫ ПОДТВЕРЖДЕНИЯ ОПЛАТЫ
+            """
+            CREATE TABLE IF NOT EXISTS confirmation_logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_id INTEGER NOT NULL,
+                subscription_type TEXT NOT NULL,
+                username TEXT NOT NULL,
+                link_id TEXT NOT NULL UNIQUE,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """,
+        ),
+    ),
+    Migration(
+        version=2,
+        name="hot_path_indexes",
+        statements=(
+            # Реферер по приглашенному (referrer_id уже покрыт UNIQUE(referrer_id, referred_id))
+            "CREATE INDEX IF NOT EXISTS idx_referrals_referred ON referrals (referred_id)",
+            # Покрывающий индекс для статистики пользователя по типу подписки и TON-заработка
+            """
+            CREATE INDEX IF NOT EXISTS idx_earnings_referrer_type
+            ON referral_earnings (referrer_id, subscription_type, payment_method, referred_id, commission_amount)
+            """,
+            # Покрывающий индекс для админской статистики по типу подписки
+            """
+            CREATE INDEX IF NOT EXISTS idx_earnings_type_referrer
+            ON referral_earnings (subscription_type, referrer_id, referred_id, commission_amount)
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_earnings_referred ON referral_earnings (referred_id)",
+            "CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)",
+            "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_subscriptions_user_status ON subscriptions (user_id, status)",
+            "CREATE INDEX IF NOT EXISTS idx_confirmation_logs_timestamp ON confirmation_logs (timestamp)",
+            "CREATE INDEX IF NOT EXISTS idx_confirmation_logs_type ON confirmation_logs (subscription_type)",
+        ),
+    ),
+    Migration(
+        version=3,
+        name="global_counters",
+        statements=(
+            # Глобальные счетчики для админской статистики: чтение одной строки вместо COUNT/SUM
+            """
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value NUMERIC NOT NULL DEFAULT 0
+            )
+            """,
+            # Начальные значения считаются один раз, в той же транзакции, что и триггеры
+            """
+            INSERT OR REPLACE INTO counters (name, value) VALUES
+                ('users', (SELECT COUNT(*) FROM users)),
+                ('referrals', (SELECT COUNT(*) FROM referrals)),
+                ('commission_ton', (SELECT COALESCE(SUM(commission_amount), 0)
+                                    FROM referral_earnings WHERE payment_method = 'TON'))
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_counters_users_insert AFTER INSERT ON users
+            BEGIN
+                UPDATE counters SET value = value + 1 WHERE name = 'users';
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_counters_users_delete AFTER DELETE ON users
+            BEGIN
+                UPDATE counters SET value = value - 1 WHERE name = 'users';
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_counters_referrals_insert AFTER INSERT ON referrals
+            BEGIN
+                UPDATE counters SET value = value + 1 WHERE name = 'referrals';
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_counters_referrals_delete AFTER DELETE ON referrals
+            BEGIN
+                UPDATE counters SET value = value - 1 WHERE name = 'referrals';
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_counters_earnings_insert AFTER INSERT ON referral_earnings
+            WHEN NEW.payment_method = 'TON'
+            BEGIN
+                UPDATE counters SET value = value + NEW.commission_amount WHERE name = 'commission_ton';
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_counters_earnings_delete AFTER DELETE ON referral_earnings
+            WHEN OLD.payment_method = 'TON'
+            BEGIN
+                UPDATE counters SET value = value - OLD.commission_amount WHERE name = 'commission_ton';
+            END
+            """,
+        ),
+    ),
+    Migration(
+        version=4,
+        name="referral_rollup",
+        statements=(
+            # Предагрегат по реферерам и планам: статистика по типу подписки - поиск по ключу
+            """
+            CREATE TABLE IF NOT EXISTS referral_rollup (
+                referrer_id INTEGER NOT NULL,
+                subscription_type TEXT NOT NULL,
+                payment_method TEXT NOT NULL,
+                referral_count INTEGER NOT NULL DEFAULT 0,
+                commission_sum REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (referrer_id, subscription_type, payment_method)
+            ) WITHOUT ROWID
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_referral_rollup_type
+            ON referral_rollup (subscription_type, referrer_id)
+            """,
+            # Начальное заполнение одним агрегатом, в той же транзакции, что и триггеры
+            """
+            INSERT OR REPLACE INTO referral_rollup
+                (referrer_id, subscription_type, payment_method, referral_count, commission_sum)
+            SELECT referrer_id, subscription_type, payment_method,
+                   COUNT(DISTINCT referred_id), SUM(commission_amount)
+            FROM referral_earnings
+            GROUP BY referrer_id, subscription_type, payment_method
+            """,
+            # referral_count - число разных оплативших рефералов: +1 только для первой оплаты
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_referral_rollup_insert AFTER INSERT ON referral_earnings
+            BEGIN
+                INSERT INTO referral_rollup
+                    (referrer_id, subscription_type, payment_method, referral_count, commission_sum)
+                VALUES (
+                    NEW.referrer_id, NEW.subscription_type, NEW.payment_method,
+                    NOT EXISTS (
+                        SELECT 1 FROM referral_earnings
+                        WHERE referrer_id = NEW.referrer_id
+                        AND subscription_type = NEW.subscription_type
+                        AND payment_method = NEW.payment_method
+                        AND referred_id = NEW.referred_id
+                        AND id != NEW.id
+                    ),
+                    NEW.commission_amount
+                )
+                ON CONFLICT (referrer_id, subscription_type, payment_method) DO UPDATE SET
+                    referral_count = referral_count + excluded.referral_count,
+                    commission_sum = commission_sum + excluded.commission_sum;
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_referral_rollup_delete AFTER DELETE ON referral_earnings
+            BEGIN
+                UPDATE referral_rollup SET
+                    commission_sum = commission_sum - OLD.commission_amount,
+                    referral_count = referral_count - NOT EXISTS (
+                        SELECT 1 FROM referral_earnings
+                        WHERE referrer_id = OLD.referrer_id
+                        AND subscription_type = OLD.subscription_type
+                        AND payment_method = OLD.payment_method
+                        AND referred_id = OLD.referred_id
+                    )
+                WHERE referrer_id = OLD.referrer_id
+                AND subscription_type = OLD.subscription_type
+                AND payment_method = OLD.payment_method;
+            END
+            """,
+            # Админская статистика по типу теперь читает referral_rollup
+            "DROP INDEX IF EXISTS idx_earnings_type_referrer",
+        ),
+    ),
+    Migration(
+        version=5,
+        name="confirmation_daily_buckets",
+        statements=(
+            # Дневные корзины подтверждений (день UTC, как CURRENT_TIMESTAMP)
+            """
+            CREATE TABLE IF NOT EXISTS confirmation_daily (
+                day TEXT NOT NULL,
+                subscription_type TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, subscription_type)
+            ) WITHOUT ROWID
+            """,
+            """
+            INSERT OR REPLACE INTO confirmation_daily (day, subscription_type, count)
+            SELECT DATE(timestamp), subscription_type, COUNT(*)
+            FROM confirmation_logs
+            GROUP BY DATE(timestamp), subscription_type
+            """,
+            # Статистика по типам теперь читает корзины
+            "DROP INDEX IF EXISTS idx_confirmation_logs_type",
+        ),
+    ),
+    Migration(
+        version=6,
+        name="epoch_timestamps",
+        statements=(
+            # Целочисленное время (секунды Unix, UTC) рядом с текстовым: сравнение
+            # чисел по индексу вместо строк и DATE(), 8 байт вместо 19 символов
+            "ALTER TABLE users ADD COLUMN created_ts INTEGER",
+            "ALTER TABLE subscriptions ADD COLUMN created_ts INTEGER",
+            "ALTER TABLE referral_earnings ADD COLUMN created_ts INTEGER",
+            "ALTER TABLE confirmation_logs ADD COLUMN created_ts INTEGER",
+            "CREATE INDEX IF NOT EXISTS idx_users_created_ts ON users (created_ts)",
+            "CREATE INDEX IF NOT EXISTS idx_subscriptions_created_ts ON subscriptions (created_ts)",
+            "CREATE INDEX IF NOT EXISTS idx_earnings_created_ts ON referral_earnings (created_ts)",
+            "CREATE INDEX IF NOT EXISTS idx_confirmation_logs_created_ts ON confirmation_logs (created_ts)",
+            # Сортировки и диапазоны переходят на created_ts
+            "DROP INDEX IF EXISTS idx_users_created_at",
+            "DROP INDEX IF EXISTS idx_confirmation_logs_timestamp",
+        ),
+        # Новые строки получают created_ts при вставке, старые догоняются в фоне
+        backfills=(
+            Backfill(
+                name="users_created_ts",
+                table="users",
+                sql="""
+                    UPDATE users SET created_ts = CAST(strftime('%s', created_at) AS INTEGER)
+                    WHERE id > ? AND id <= ? AND created_ts IS NULL
+                """,
+            ),
+            Backfill(
+                name="subscriptions_created_ts",
+                table="subscriptions",
+                sql="""
+                    UPDATE subscriptions SET created_ts = CAST(strftime('%s', created_at) AS INTEGER)
+                    WHERE id > ? AND id <= ? AND created_ts IS NULL
+                """,
+            ),
+            Backfill(
+                name="referral_earnings_created_ts",
+                table="referral_earnings",
+                sql="""
+                    UPDATE referral_earnings SET created_ts = CAST(strftime('%s', created_at) AS INTEGER)
+                    WHERE id > ? AND id <= ? AND created_ts IS NULL
+                """,
+            ),
+            Backfill(
+                name="confirmation_logs_created_ts",
+                table="confirmation_logs",
+                sql="""
+                    UPDATE confirmation_logs SET created_ts = CAST(strftime('%s', timestamp) AS INTEGER)
+                    WHERE id > ? AND id <= ? AND created_ts IS NULL
+                """,
+            ),
+        ),
+    ),
+    Migration(
+        version=7,
+        name="username_lower",
+        statements=(
+            # Нормализованный username (нижний регистр, без @) для поиска без учета регистра
+            "ALTER TABLE users ADD COLUMN username_lower TEXT",
+            # Заполняется сразу, до уникального индекса: при совпадении имени у нескольких
+            # строк (кто-то сменил username, а другой занял старый) имя получает самая новая
+            """
+            UPDATE users SET username_lower = ranked.username_lower
+            FROM (
+                SELECT id, LOWER(LTRIM(TRIM(username), '@')) as username_lower,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY LOWER(LTRIM(TRIM(username), '@'))
+                           ORDER BY created_at DESC, id DESC
+                       ) as position
+                FROM users
+                WHERE LTRIM(TRIM(username), '@') != ''
+            ) ranked
+            WHERE ranked.id = users.id AND ranked.position = 1
+            """,
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username_lower ON users (username_lower)",
+            # Поиск по точному username больше не используется
+            "DROP INDEX IF EXISTS idx_users_username",
+        ),
+    ),
+    Migration(
+        version=8,
+        name="dimension_tables",
+        # Справочники subscription_types / payment_methods и целочисленные ключи
+        # вместо повторяющихся строк в subscriptions, referral_earnings,
+        # confirmation_logs и предагрегатах
+        apply=_apply_dimension_tables,
+    ),
+    Migration(
+        version=9,
+        name="archive_guard",
+        # Архивация старых строк истории (db_archive) без изменения итогов
+        apply=_apply_archive_guard,
+    ),
+    Migration(
+        version=10,
+        name="maintenance_runs",
+        statements=(
+            # Последний запуск задач обслуживания (db_maintenance)
+            """
+            CREATE TABLE IF NOT EXISTS maintenance_runs (
+                job TEXT PRIMARY KEY,
+                last_run_ts INTEGER NOT NULL,
+                duration_ms REAL NOT NULL,
+                status TEXT NOT NULL
+            ) WITHOUT ROWID
+            """,
+        ),
+    ),
+]
+
+
+# ===== МИГРАЦИИ ДЛЯ POSTGRESQL (те же версии, имена и итоговая схема) =====
+#
+# Отличия от SQLite:
+# - внешние ключи на users не объявляются: в SQLite они не проверяются,
+#   и бот допускает реферера без строки в users
+# - триггеры - функции plpgsql, корзины confirmation_daily - тип DATE
+# - created_ts заполняется прямо в миграции одним UPDATE: читатели
+#   в PostgreSQL не ждут пишущую транзакцию, фоновый backfill не нужен
+# - справочники вводятся через ALTER TABLE, без пересоздания таблиц
+
+_PG_NOW = "date_trunc('second', now() AT TIME ZONE 'utc')"
+_PG_EPOCH_NOW = "EXTRACT(EPOCH FROM now())::bigint"
+
+
+_PG_ARCHIVING_GUARD = """
+            IF TG_OP = 'DELETE' AND EXISTS (SELECT 1 FROM maintenance_flags WHERE name = 'archiving') THEN
+                RETURN NULL;
+            END IF;"""
+
+
+def _pg_rollup_trigger(type_column: str, method_column: str, archive_guard: bool = False) -> Tuple[str, str]:
+    """Функция и триггер предагрегата referral_rollup для заданных колонок типа и способа оплаты"""
+    same_key = f"""
+                referrer_id = {{row}}.referrer_id
+                AND {type_column} = {{row}}.{type_column}
+                AND {method_column} = {{row}}.{method_column}
+    """
+    function = f"""
+        CREATE OR REPLACE FUNCTION trg_referral_rollup() RETURNS trigger AS $$
+        BEGIN{_PG_ARCHIVING_GUARD if archive_guard else ""}
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO referral_rollup
+                    (referrer_id, {type_column}, {method_column}, referral_count, commission_sum)
+                VALUES (
+                    NEW.referrer_id, NEW.{type_column}, NEW.{method_column},
+                    CASE WHEN EXISTS (
+                        SELECT 1 FROM referral_earnings
+                        WHERE {same_key.format(row='NEW')}
+                        AND referred_id = NEW.referred_id
+                        AND id != NEW.id
+                    ) THEN 0 ELSE 1 END,
+                    NEW.commission_amount
+                )
+                ON CONFLICT (referrer_id, {type_column}, {method_column}) DO UPDATE SET
+                    referral_count = referral_rollup.referral_count + excluded.referral_count,
+                    commission_sum = referral_rollup.commission_sum + excluded.commission_sum;
+            ELSE
+                UPDATE referral_rollup SET
+                    commission_sum = commission_sum - OLD.commission_amount,
+                    referral_count = referral_count - CASE WHEN EXISTS (
+                        SELECT 1 FROM referral_earnings
+                        WHERE {same_key.format(row='OLD')}
+                        AND referred_id = OLD.referred_id
+                    ) THEN 0 ELSE 1 END
+                WHERE {same_key.format(row='OLD')};
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """
+    trigger = """
+        CREATE TRIGGER trg_referral_rollup AFTER INSERT OR DELETE ON referral_earnings
+        FOR EACH ROW EXECUTE FUNCTION trg_referral_rollup()
+    """
+    return function, trigger
+
+
+def _pg_commission_counter_function(ton_condition: str, archive_guard: bool = False) -> str:
+    """Функция счетчика commission_ton (условие TON - по тексту или по id справочника)"""
+    return f"""
+        CREATE OR REPLACE FUNCTION trg_counters_earnings() RETURNS trigger AS $$
+        BEGIN{_PG_ARCHIVING_GUARD if archive_guard else ""}
+            IF TG_OP = 'INSERT' THEN
+                IF {ton_condition.format(row='NEW')} THEN
+                    UPDATE counters SET value = value + NEW.commission_amount WHERE name = 'commission_ton';
+                END IF;
+            ELSIF {ton_condition.format(row='OLD')} THEN
+                UPDATE counters SET value = value - OLD.commission_amount WHERE name = 'commission_ton';
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """
+
+
+_PG_ROLLUP_TEXT = _pg_rollup_trigger("subscription_type", "payment_method")
+_PG_ROLLUP_IDS = _pg_rollup_trigger("subscription_type_id", "payment_method_id")
+
+
+POSTGRES_MIGRATIONS: List[Migration] = [
+    Migration(
+        version=1,
+        name="baseline_schema",
+        statements=(
+            f"""
+            CREATE TABLE IF NOT EXISTS users (
+                id BIGINT PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                created_at TIMESTAMP DEFAULT {_PG_NOW},
+                referral_code TEXT UNIQUE
+            )
+            """,
+            f"""
+            CREATE TABLE IF NOT EXISTS referrals (
+                id BIGSERIAL PRIMARY KEY,
+                referrer_id BIGINT NOT NULL,
+                referred_id BIGINT NOT NULL,
+                created_at TIMESTAMP DEFAULT {_PG_NOW},
+                UNIQUE (referrer_id, referred_id)
+            )
+            """,
+            f"""
+            CREATE TABLE IF NOT EXISTS pending_referrals (
+                user_id BIGINT PRIMARY KEY,
+                referrer_id BIGINT NOT NULL,
+                created_at TIMESTAMP DEFAULT {_PG_NOW}
+            )
+            """,
+            f"""
+            CREATE TABLE IF NOT EXISTS subscriptions (
+                id BIGSERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                subscription_type TEXT NOT NULL,
+                payment_method TEXT NOT NULL,
+                amount DOUBLE PRECISION,
+                currency TEXT DEFAULT 'TON',
+                status TEXT DEFAULT 'pending',
+                created_at TIMESTAMP DEFAULT {_PG_NOW}
+            )
+            """,
+            f"""
+            CREATE TABLE IF NOT EXISTS referral_earnings (
+                id BIGSERIAL PRIMARY KEY,
+                referrer_id BIGINT NOT NULL,
+                referred_id BIGINT NOT NULL,
+                commission_amount DOUBLE PRECISION NOT NULL,
+                subscription_type TEXT NOT NULL,
+                payment_method TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT {_PG_NOW}
+            )
+            """,
+            f"""
+            CREATE TABLE IF NOT EXISTS confirmation_logs (
+                id BIGSERIAL PRIMARY KEY,
+                admin_id BIGINT NOT NULL,
+                subscription_type TEXT NOT NULL,
+                username TEXT NOT NULL,
+                link_id TEXT NOT NULL UNIQUE,
+                timestamp TIMESTAMP DEFAULT {_PG_NOW}
+            )
+            """,
+        ),
+    ),
+    Migration(
+        version=2,
+        name="hot_path_indexes",
+        statements=(
+            "CREATE INDEX IF NOT EXISTS idx_referrals_referred ON referrals (referred_id)",
+            """
+            CREATE INDEX IF NOT EXISTS idx_earnings_referrer_type
+            ON referral_earnings (referrer_id, subscription_type, payment_method, referred_id, commission_amount)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_earnings_type_referrer
+            ON referral_earnings (subscription_type, referrer_id, referred_id, commission_amount)
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_earnings_referred ON referral_earnings (referred_id)",
+            "CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)",
+            "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_subscriptions_user_status ON subscriptions (user_id, status)",
+            "CREATE INDEX IF NOT EXISTS idx_confirmation_logs_timestamp ON confirmation_logs (timestamp)",
+            "CREATE INDEX IF NOT EXISTS idx_confirmation_logs_type ON confirmation_logs (subscription_type)",
+        ),
+    ),
+    Migration(
+        version=3,
+        name="global_counters",
+        statements=(
+            """
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value NUMERIC NOT NULL DEFAULT 0
+            )
+            """,
+            """
+            INSERT INTO counters (name, value) VALUES
+                ('users', (SELECT COUNT(*) FROM users)),
+                ('referrals', (SELECT COUNT(*) FROM referrals)),
+                ('commission_ton', (SELECT COALESCE(SUM(commission_amount), 0)
+                                    FROM referral_earnings WHERE payment_method = 'TON'))
+            ON CONFLICT (name) DO UPDATE SET value = excluded.value
+            """,
+            """
+            CREATE OR REPLACE FUNCTION trg_counters_users() RETURNS trigger AS $$
+            BEGIN
+                UPDATE counters SET value = value + CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END
+                WHERE name = 'users';
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+            """,
+            """
+            CREATE TRIGGER trg_counters_users AFTER INSERT OR DELETE ON users
+            FOR EACH ROW EXECUTE FUNCTION trg_counters_users()
+            """,
+            """
+            CREATE OR REPLACE FUNCTION trg_counters_referrals() RETURNS trigger AS $$
+            BEGIN
+                UPDATE counters SET value = value + CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END
+                WHERE name = 'referrals';
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+            """,
+            """
+            CREATE TRIGGER trg_counters_referrals AFTER INSERT OR DELETE ON referrals
+            FOR EACH ROW EXECUTE FUNCTION trg_counters_referrals()
+            """,
+            _pg_commission_counter_function("{row}.payment_method = 'TON'"),
+            """
+            CREATE TRIGGER trg_counters_earnings AFTER INSERT OR DELETE ON referral_earnings
+            FOR EACH ROW EXECUTE FUNCTION trg_counters_earnings()
+            """,
+        ),
+    ),
+    Migration(
+        version=4,
+        name="referral_rollup",
+        statements=(
+            """
+            CREATE TABLE IF NOT EXISTS referral_rollup (
+                referrer_id BIGINT NOT NULL,
+                subscription_type TEXT NOT NULL,
+                payment_method TEXT NOT NULL,
+                referral_count INTEGER NOT NULL DEFAULT 0,
+                commission_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+                PRIMARY KEY (referrer_id, subscription_type, payment_method)
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_referral_rollup_type
+            ON referral_rollup (subscription_type, referrer_id)
+            """,
+            """
+            INSERT INTO referral_rollup
+                (referrer_id, subscription_type, payment_method, referral_count, commission_sum)
+            SELECT referrer_id, subscription_type, payment_method,
+                   COUNT(DISTINCT referred_id), SUM(commission_amount)
+            FROM referral_earnings
+            GROUP BY referrer_id, subscription_type, payment_method
+            ON CONFLICT (referrer_id, subscription_type, payment_method) DO UPDATE SET
+                referral_count = excluded.referral_count,
+                commission_sum = excluded.commission_sum
+            """,
+            _PG_ROLLUP_TEXT[0],
+            _PG_ROLLUP_TEXT[1],
+            "DROP INDEX IF EXISTS idx_earnings_type_referrer",
+        ),
+    ),
+    Migration(
+        version=5,
+        name="confirmation_daily_buckets",
+        statements=(
+            """
+            CREATE TABLE IF NOT EXISTS confirmation_daily (
+                day DATE NOT NULL,
+                subscription_type TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, subscription_type)
+            )
+            """,
+            """
+            INSERT INTO confirmation_daily (day, subscription_type, count)
+            SELECT timestamp::date, subscription_type, COUNT(*)
+            FROM confirmation_logs
+            GROUP BY timestamp::date, subscription_type
+            ON CONFLICT (day, subscription_type) DO UPDATE SET count = excluded.count
+            """,
+            "DROP INDEX IF EXISTS idx_confirmation_logs_type",
+        ),
+    ),
+    Migration(
+        version=6,
+        name="epoch_timestamps",
+        statements=tuple(
+            statement
+            for table, text_column in (("users", "created_at"), ("subscriptions", "created_at"),
+                                       ("referral_earnings", "created_at"), ("confirmation_logs", "timestamp"))
+            for statement in (
+                f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS created_ts BIGINT DEFAULT {_PG_EPOCH_NOW}",
+                f"UPDATE {table} SET created_ts = EXTRACT(EPOCH FROM {text_column})::bigint "
+                f"WHERE {text_column} IS NOT NULL",
+            )
+        ) + (
+            "CREATE INDEX IF NOT EXISTS idx_users_created_ts ON users (created_ts)",
+            "CREATE INDEX IF NOT EXISTS idx_subscriptions_created_ts ON subscriptions (created_ts)",
+            "CREATE INDEX IF NOT EXISTS idx_earnings_created_ts ON referral_earnings (created_ts)",
+            "CREATE INDEX IF NOT EXISTS idx_confirmation_logs_created_ts ON confirmation_logs (created_ts)",
+            "DROP INDEX IF EXISTS idx_users_created_at",
+            "DROP INDEX IF EXISTS idx_confirmation_logs_timestamp",
+        ),
+    ),
+    Migration(
+        version=7,
+        name="username_lower",
+        statements=(
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS username_lower TEXT",
+            """
+            UPDATE users SET username_lower = ranked.username_lower
+            FROM (
+                SELECT id, LOWER(LTRIM(TRIM(username), '@')) as username_lower,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY LOWER(LTRIM(TRIM(username), '@'))
+                           ORDER BY created_at DESC, id DESC
+                       ) as position
+                FROM users
+                WHERE LTRIM(TRIM(username), '@') != ''
+            ) ranked
+            WHERE ranked.id = users.id AND ranked.position = 1
+            """,
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username_lower ON users (username_lower)",
+            "DROP INDEX IF EXISTS idx_users_username",
+        ),
+    ),
+    Migration(
+        version=8,
+        name="dimension_tables",
+        statements=(
+            "CREATE TABLE IF NOT EXISTS subscription_types (id SERIAL PRIMARY KEY, code TEXT NOT NULL UNIQUE)",
+            "CREATE TABLE IF NOT EXISTS payment_methods (id SERIAL PRIMARY KEY, code TEXT NOT NULL UNIQUE)",
+            "INSERT INTO payment_methods (code) VALUES ('TON'), ('STARS') ON CONFLICT (code) DO NOTHING",
+            """
+            INSERT INTO payment_methods (code)
+            SELECT payment_method FROM subscriptions
+            UNION SELECT payment_method FROM referral_earnings
+            UNION SELECT payment_method FROM referral_rollup
+            ON CONFLICT (code) DO NOTHING
+            """,
+            """
+            INSERT INTO subscription_types (code)
+            SELECT subscription_type FROM subscriptions
+            UNION SELECT subscription_type FROM referral_earnings
+            UNION SELECT subscription_type FROM referral_rollup
+            UNION SELECT subscription_type FROM confirmation_logs
+            UNION SELECT subscription_type FROM confirmation_daily
+            ON CONFLICT (code) DO NOTHING
+            """,
+        ) + tuple(
+            # Колонка id справочника рядом с текстом, заполнение, затем удаление текста
+            # (индексы и ключи на текстовой колонке удаляются вместе с ней)
+            statement
+            for table, column, dimension in (
+                ("subscriptions", "subscription_type", "subscription_types"),
+                ("subscriptions", "payment_method", "payment_methods"),
+                ("referral_earnings", "subscription_type", "subscription_types"),
+                ("referral_earnings", "payment_method", "payment_methods"),
+                ("confirmation_logs", "subscription_type", "subscription_types"),
+                ("referral_rollup", "subscription_type", "subscription_types"),
+                ("referral_rollup", "payment_method", "payment_methods"),
+                ("confirmation_daily", "subscription_type", "subscription_types"),
+            )
+            for statement in (
+                f"ALTER TABLE {table} ADD COLUMN {column}_id INTEGER REFERENCES {dimension} (id)",
+                f"UPDATE {table} t SET {column}_id = d.id FROM {dimension} d WHERE d.code = t.{column}",
+                f"ALTER TABLE {table} ALTER COLUMN {column}_id SET NOT NULL",
+                f"ALTER TABLE {table} DROP COLUMN {column}",
+            )
+        ) + (
+            "ALTER TABLE referral_rollup ADD PRIMARY KEY (referrer_id, subscription_type_id, payment_method_id)",
+            "ALTER TABLE confirmation_daily ADD PRIMARY KEY (day, subscription_type_id)",
+            """
+            CREATE INDEX idx_earnings_referrer_type
+            ON referral_earnings (referrer_id, subscription_type_id, payment_method_id, referred_id, commission_amount)
+            """,
+            "CREATE INDEX idx_referral_rollup_type ON referral_rollup (subscription_type_id, referrer_id)",
+            _pg_commission_counter_function(
+                "{row}.payment_method_id = (SELECT id FROM payment_methods WHERE code = 'TON')"
+            ),
+            _PG_ROLLUP_IDS[0],
+        ),
+    ),
+    Migration(
+        version=9,
+        name="archive_guard",
+        statements=(
+            "CREATE TABLE IF NOT EXISTS maintenance_flags (name TEXT PRIMARY KEY)",
+            _pg_commission_counter_function(
+                "{row}.payment_method_id = (SELECT id FROM payment_methods WHERE code = 'TON')",
+                archive_guard=True
+            ),
+            _pg_rollup_trigger("subscription_type_id", "payment_method_id", archive_guard=True)[0],
+        ),
+    ),
+    Migration(
+        version=10,
+        name="maintenance_runs",
+        statements=(
+            """
+            CREATE TABLE IF NOT EXISTS maintenance_runs (
+                job TEXT PRIMARY KEY,
+                last_run_ts BIGINT NOT NULL,
+                duration_ms DOUBLE PRECISION NOT NULL,
+                status TEXT NOT NULL
+            )
+            """,
+        ),
+    ),
+]
+
+
+class MigrationRunner:
+    """Применение миграций при старте и фоновые backfill-задачи"""
+
+    def __init__(self, manager: SQLStorageBackend, migrations: Optional[List[Migration]] = None,
+                 backfill_pause: float = 0.05):
+        self.manager = manager
+        self.migrations = sorted(migrations if migrations is not None else MIGRATIONS,
+                                 key=lambda m: m.version)
+        self.backfill_pause = backfill_pause
+        self._backfills: Dict[str, Backfill] = {
+            backfill.name: backfill
+            for migration in self.migrations
+            for backfill in migration.backfills
+        }
+        self._completed_backfills: Set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def latest_version(self) -> int:
+        return self.migrations[-1].version if self.migrations else 0
+
+    async def _ensure_bookkeeping(self):
+        """Служебные таблицы для версии схемы и прогресса backfill"""
+        async with self.manager.transaction() as tx:
+            await tx.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            await tx.execute("""
+                CREATE TABLE IF NOT EXISTS schema_backfills (
+                    name TEXT PRIMARY KEY,
+                    last_key BIGINT,
+                    done INTEGER NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+    async def current_version(self) -> int:
+        """Текущая версия схемы в базе данных"""
+        async with self.manager.read_only() as tx:
+            row = await tx.fetchone("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+        return row[0] if row else 0
+
+    async def migrate(self) -> int:
+        """Применение всех еще не примененных миграций, возвращает версию схемы"""
+        await self._ensure_bookkeeping()
+        version = await self.current_version()
+
+        for migration in self.migrations:
+            if migration.version <= version:
+                continue
+            logger.info(f"🧱 Применение миграции {migration.version}: {migration.name}")
+            async with self.manager.transaction() as tx:
+                for statement in migration.statements:
+                    await tx.execute(statement)
+                if migration.apply is not None:
+                    await migration.apply(tx)
+                for backfill in migration.backfills:
+                    await tx.execute("""
+                        INSERT INTO schema_backfills (name, last_key, done)
+                        VALUES (?, NULL, 0)
+                        ON CONFLICT (name) DO NOTHING
+                    """, (backfill.name,))
+                await tx.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (?, ?)",
+                    (migration.version, migration.name)
+                )
+            version = migration.version
+
+        async with self.manager.read_only() as tx:
+            rows = await tx.fetchall("SELECT name FROM schema_backfills WHERE done = 1")
+        self._completed_backfills = {row[0] for row in rows}
+
+        logger.info(f"✅ Схема базы данных на версии {version}")
+        return version
+
+    def is_backfill_complete(self, name: str) -> bool:
+        """Завершено ли фоновое заполнение с данным именем"""
+        return name in self._completed_backfills
+
+    def start_backfills(self):
+        """Запуск фоновой задачи, догоняющей незавершенные backfill"""
+        if self._task is not None or not self._backfills:
+            return
+        pending = [name for name in self._backfills if name not in self._completed_backfills]
+        if not pending:
+            return
+        self._task = asyncio.create_task(self._run_backfills(pending))
+
+    async def stop(self):
+        """Остановка фоновых backfill (прогресс сохранен, продолжится при следующем старте)"""
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run_backfills(self, names: List[str]):
+        for name in names:
+            try:
+                await self._run_backfill(self._backfills[name])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка backfill {name}: {e}")
+
+    async def _run_backfill(self, backfill: Backfill):
+        """Заполнение одной задачи пачками по ключу, по транзакции на пачку"""
+        async with self.manager.read_only() as tx:
+            row = await tx.fetchone(
+                "SELECT last_key, done FROM schema_backfills WHERE name = ?", (backfill.name,)
+            )
+        if row is None or row[1]:
+            self._completed_backfills.add(backfill.name)
+            return
+
+        last_key = row[0]
+        processed = 0
+        logger.info(f"🔄 Фоновый backfill {backfill.name} начат (с ключа {last_key})")
+        while True:
+            # Пачка меняет только свою таблицу: кэш запросов сбрасывается по ней, а не целиком
+            async with self.manager.transaction(tables=(backfill.table,)) as tx:
+                row = await tx.fetchone(f"""
+                    SELECT MAX({backfill.key}), COUNT(*) FROM (
+                        SELECT {backfill.key} FROM {backfill.table}
+                        WHERE {backfill.key} > ?
+                        ORDER BY {backfill.key}
+                        LIMIT ?
+                    ) AS chunk
+                """, (last_key if last_key is not None else -2**63, backfill.chunk_size))
+                hi, count = row[0], row[1]
+
+                if hi is None:
+                    await tx.execute("""
+                        UPDATE schema_backfills SET done = 1, updated_at = CURRENT_TIMESTAMP
+                        WHERE name = ?
+                    """, (backfill.name,))
+                    break
+
+                lo = last_key if last_key is not None else -2**63
+                await tx.execute(backfill.sql, (lo, hi))
+                await tx.execute("""
+                    UPDATE schema_backfills SET last_key = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE name = ?
+                """, (hi, backfill.name))
+
+            last_key = hi
+            processed += count
+            # Отдаем блокировку записи обработчикам бота между пачками
+            await asyncio.sleep(self.backfill_pause)
+
+        self._completed_backfills.add(backfill.name)
+        logger.info(f"✅ Фоновый backfill {backfill.name} завершен ({processed} строк)")
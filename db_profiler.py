@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Профилирование SQL-запросов SQLite для PassiveNFT Bot
+
+- На соединения хранилища ставятся trace-callback (начало каждого запроса)
+  и обработчик прогресса (каждые progress_steps инструкций VM SQLite)
+- Запросы нормализуются: литералы заменяются на ?, списки IN (?, ?, ...)
+  сворачиваются, пробелы схлопываются - запросы, отличающиеся только
+  значениями, складываются в одну строку статистики
+- По каждому запросу: число выполнений, суммарное и максимальное время,
+  шаги VM (пропорциональны числу просмотренных строк)
+- Время - сумма интервалов между вызовами обработчика прогресса: точность
+  порядка progress_steps инструкций, запрос короче этого учитывается по
+  числу выполнений, но не по времени
+- top() / format_top() - таблица самых дорогих запросов по требованию
+"""
+import re
+import threading
+import time
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_BLOB_RE = re.compile(r"\b[xX]\?")
+_NUMBER_RE = re.compile(r"(?<![\w$.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+_IN_LIST_RE = re.compile(r"\bIN \(\s*\?(?:\s*,\s*\?)+\s*\)", re.IGNORECASE)
+_SPACE_RE = re.compile(r"\s+")
+
+# Запросы сверх лимита различных строк статистики складываются сюда
+OTHER_STATEMENTS = "<прочие запросы>"
+
+
+@lru_cache(maxsize=4096)
+def normalize_statement(sql: str) -> str:
+    """Текст запроса без литералов: WHERE id = 5 AND name = 'x' -> WHERE id = ? AND name = ?"""
+    sql = _STRING_RE.sub("?", sql)
+    sql = _BLOB_RE.sub("?", sql)
+    sql = _NUMBER_RE.sub("?", sql)
+    sql = _SPACE_RE.sub(" ", sql).strip()
+    return _IN_LIST_RE.sub("IN (?, ...)", sql)
+
+
+class StatementStats:
+    """Накопленная статистика одного нормализованного запроса"""
+    __slots__ = ("calls", "total", "max", "steps")
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.steps = 0
+
+
+class _ConnectionState:
+    """Текущий запрос соединения (меняется только в потоке этого соединения)"""
+    __slots__ = ("stats", "raw", "elapsed", "steps", "last_tick")
+
+    def __init__(self):
+        self.stats: Optional[StatementStats] = None
+        self.raw: Optional[str] = None
+        self.elapsed = 0.0
+        self.steps = 0
+        self.last_tick = 0.0
+
+
+class StatementProfiler:
+    """Сбор статистики запросов с соединений aiosqlite.
+
+    Хранилище вызывает attach для каждого нового соединения и release,
+    когда соединение возвращается после использования (запрос на нем
+    гарантированно завершен).
+    """
+
+    def __init__(self, progress_steps: int = 100, max_statements: int = 2000):
+        self.progress_steps = max(1, progress_steps)
+        self.max_statements = max(1, max_statements)
+        self.statements: Dict[str, StatementStats] = {}
+        self.started = time.monotonic()
+        # Колбэки приходят из потоков разных соединений
+        self._lock = threading.Lock()
+        self._states: Dict[int, _ConnectionState] = {}
+
+    # ===== ПОДКЛЮЧЕНИЕ К СОЕДИНЕНИЯМ =====
+
+    async def attach(self, db):
+        """Установка колбэков на соединение aiosqlite"""
+        state = _ConnectionState()
+        self._states[id(db)] = state
+        await db.set_trace_callback(lambda sql: self._on_statement(state, sql))
+        await db.set_progress_handler(lambda: self._on_progress(state), self.progress_steps)
+
+    async def detach(self, db):
+        """Снятие колбэков с соединения"""
+        await db.set_trace_callback(None)
+        await db.set_progress_handler(None, 0)
+        state = self._states.pop(id(db), None)
+        if state is not None:
+            self._finish(state)
+
+    def release(self, db):
+        """Соединение вернулось после использования: текущий запрос на нем завершен"""
+        state = self._states.get(id(db))
+        if state is not None and state.stats is not None:
+            self._finish(state)
+
+    # ===== КОЛБЭКИ (В ПОТОКЕ СОЕДИНЕНИЯ) =====
+
+    def _on_statement(self, state: _ConnectionState, sql: str):
+        # Подпрограммы триггеров приходят с текстом родительского запроса:
+        # это продолжение того же выполнения, а не новый вызов
+        if state.stats is not None and sql == state.raw:
+            return
+        self._finish(state)
+        key = normalize_statement(sql)
+        with self._lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                if len(self.statements) >= self.max_statements:
+                    key = OTHER_STATEMENTS
+                stats = self.statements.setdefault(key, StatementStats())
+            stats.calls += 1
+        state.stats = stats
+        state.raw = sql
+        state.elapsed = 0.0
+        state.steps = 0
+        state.last_tick = time.perf_counter()
+
+    def _on_progress(self, state: _ConnectionState) -> int:
+        now = time.perf_counter()
+        if state.stats is not None:
+            state.elapsed += now - state.last_tick
+            state.steps += self.progress_steps
+        state.last_tick = now
+        # Ноль - продолжать выполнение запроса
+        return 0
+
+    def _finish(self, state: _ConnectionState):
+        stats = state.stats
+        if stats is None:
+            return
+        with self._lock:
+            stats.total += state.elapsed
+            stats.steps += state.steps
+            if state.elapsed > stats.max:
+                stats.max = state.elapsed
+        state.stats = None
+        state.raw = None
+
+    # ===== ОТЧЕТ =====
+
+    def reset(self):
+        """Обнуление накопленной статистики"""
+        with self._lock:
+            self.statements.clear()
+        self.started = time.monotonic()
+
+    def top(self, limit: int = 10, order_by: str = "total") -> List[Dict[str, Any]]:
+        """Самые дорогие запросы: order_by - total, max, calls или steps"""
+        if order_by not in StatementStats.__slots__:
+            raise ValueError(f"Неизвестная сортировка: {order_by}")
+        with self._lock:
+            items = [(key, stats.calls, stats.total, stats.max, stats.steps)
+                     for key, stats in self.statements.items()]
+        grand_total = sum(item[2] for item in items) or 1.0
+        column = StatementStats.__slots__.index(order_by) + 1
+        items.sort(key=lambda item: item[column], reverse=True)
+        return [
+            {
+                'statement': key,
+                'calls': calls,
+                'total_ms': total * 1000,
+                'avg_ms': total * 1000 / calls if calls else 0.0,
+                'max_ms': max_time * 1000,
+                'steps': steps,
+                'share': total / grand_total,
+            }
+            for key, calls, total, max_time, steps in items[:max(1, limit)]
+        ]
+
+    def format_top(self, limit: int = 10, order_by: str = "total", width: int = 70) -> str:
+        """Таблица top() моноширинным текстом (для лога и Telegram <pre>)"""
+        rows = self.top(limit, order_by)
+        minutes = (time.monotonic() - self.started) / 60
+        lines = [
+            f"SQL за {minutes:.0f} мин, сортировка по {order_by}",
+            f"{'доля':>5} {'всего мс':>9} {'макс мс':>8} {'вызовов':>8} {'шаги VM':>10}  запрос",
+        ]
+        for row in rows:
+            statement = row['statement']
+            if len(statement) > width:
+                statement = statement[:width - 1] + "…"
+            lines.append(
+                f"{row['share']:>5.0%} {row['total_ms']:>9.1f} {row['max_ms']:>8.1f} "
+                f"{row['calls']:>8} {row['steps']:>10}  {statement}"
+            )
+        return "\n".join(lines)
+
+
+def create_statement_profiler(config) -> Optional[StatementProfiler]:
+    """Профилировщик SQL по настройкам (None, если выключен)"""
+    if not getattr(config, 'DB_PROFILE_SQL', False):
+        return None
+    return StatementProfiler(progress_steps=getattr(config, 'DB_PROFILE_PROGRESS_STEPS', 100))
@@ -0,0 +1,16 @@
+import asyncio
+import sys
+from pathlib import Path
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+async def wait_backfills(manager, timeout: float = 10.0):
+    """Ожидание фоновых backfill миграций (архивация и время создания зависят от них)"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    names = list(manager.migrations._backfills)
+    while not all(manager.migrations.is_backfill_complete(name) for name in names):
+        assert loop.time() < deadline, "backfill не завершился"
+        await asyncio.sleep(0.02)
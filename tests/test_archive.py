@@ -0,0 +1,116 @@
+"""Архивация истории: перенос в помесячные файлы и чтение обратно"""
+import asyncio
+import sqlite3
+from datetime import datetime, timezone
+
+from conftest import wait_backfills
+from database_async import AsyncDatabaseManager
+from db_archive import ATTACH_CHUNK, Archiver
+
+MONTHS = 14
+
+
+def month_ts(index: int) -> int:
+    """15-е число index-го месяца, начиная с января 2023 (UTC)"""
+    year, month = divmod(index, 12)
+    return int(datetime(2023 + year, month + 1, 15, tzinfo=timezone.utc).timestamp())
+
+
+def test_archive_round_trip(tmp_path):
+    path = str(tmp_path / "bot.db")
+    assert MONTHS > ATTACH_CHUNK + 1
+
+    async def scenario():
+        manager = AsyncDatabaseManager(db_path=path)
+        await manager.initialize()
+        try:
+            await wait_backfills(manager)
+            await manager.get_or_create_user(1, "alice", "Alice", "")
+            for index in range(MONTHS):
+                await manager.add_subscription(1, "4_ton", "TON", 4.0)
+                await manager.save_confirmation_log({
+                    'admin_id': 100, 'subscription_type': '4_ton',
+                    'username': f"user{index}", 'link_id': f"link-{index}"
+                })
+
+            # Разносим строки по месяцам прошлого
+            connection = sqlite3.connect(path)
+            for table in ("subscriptions", "confirmation_logs"):
+                ids = [row[0] for row in connection.execute(f"SELECT id FROM {table} ORDER BY id")]
+                connection.executemany(f"UPDATE {table} SET created_ts = ? WHERE id = ?",
+                                       [(month_ts(index), row_id) for index, row_id in enumerate(ids)])
+            connection.commit()
+            connection.close()
+
+            stats_before = await manager.get_confirmation_stats()
+
+            archiver = Archiver(path, archive_dir=str(tmp_path / "archive"), retention_days=30,
+                                batch_size=5, batch_pause_ms=0)
+            moved = await archiver.run_once()
+            # Последняя подписка пользователя остается в рабочей базе (проверка доступа)
+            assert moved == {'subscriptions': MONTHS - 1, 'referral_earnings': 0, 'confirmation_logs': MONTHS}
+            assert len(archiver.archive_months()) == MONTHS
+            assert await archiver.run_once() == {'subscriptions': 0, 'referral_earnings': 0, 'confirmation_logs': 0}
+
+            connection = sqlite3.connect(path)
+            assert connection.execute("SELECT COUNT(*) FROM confirmation_logs").fetchone()[0] == 0
+            assert connection.execute("SELECT COUNT(*) FROM subscriptions").fetchone()[0] == 1
+            connection.close()
+
+            # Итоги из корзин и доступ не изменились
+            assert (await manager.get_confirmation_stats())['total'] == stats_before['total'] == MONTHS
+            assert (await manager.check_subscription_access(1, 4, "4_ton"))['has_access']
+
+            # Чтение обратно: больше месяцев, чем можно подключить за раз
+            logs = await archiver.read_history("confirmation_logs", 0)
+            assert [row['username'] for row in logs] == [f"user{index}" for index in range(MONTHS)]
+            subscriptions = await archiver.read_history("subscriptions", 0)
+            assert [row['created_ts'] for row in subscriptions] == [month_ts(index) for index in range(MONTHS)]
+
+            limited = await archiver.read_history("confirmation_logs", 0, limit=3)
+            assert [row['username'] for row in limited] == ["user0", "user1", "user2"]
+            window = await archiver.read_history("confirmation_logs", month_ts(10), month_ts(13))
+            assert [row['username'] for row in window] == ["user10", "user11", "user12"]
+        finally:
+            await manager.close()
+
+    asyncio.run(scenario())
+
+
+def test_referral_stats_after_archiving_earnings(tmp_path):
+    path = str(tmp_path / "bot.db")
+
+    async def scenario():
+        manager = AsyncDatabaseManager(db_path=path)
+        await manager.initialize()
+        try:
+            await wait_backfills(manager)
+            await manager.get_or_create_user(1, "alice", "Alice", "")
+            await manager.get_or_create_user(2, "bob", "Bob", "")
+            await manager.add_referral(1, 2)
+            for amount in (0.4, 1.0, 2.5):
+                await manager.add_referral_earnings(1, 2, amount, "4_ton", "TON")
+
+            connection = sqlite3.connect(path)
+            ids = [row[0] for row in connection.execute("SELECT id FROM referral_earnings ORDER BY id")]
+            connection.executemany("UPDATE referral_earnings SET created_ts = ? WHERE id = ?",
+                                   [(month_ts(index), row_id) for index, row_id in enumerate(ids)])
+            connection.commit()
+            connection.close()
+            assert "Заработано TON: 3.90\n💎 TON рефералов: 3" in await manager.get_user_referral_stats(2)
+
+            archiver = Archiver(path, archive_dir=str(tmp_path / "archive"), retention_days=30,
+                                batch_size=5, batch_pause_ms=0)
+            assert (await archiver.run_once())['referral_earnings'] == 2
+
+            # Итоги реферера идут из referral_rollup и не меняются
+            assert await manager.get_user_referral_earnings(1) == 3.9
+            assert await manager.get_user_referral_stats_by_type(1, "4_ton") == {'count': 1, 'total_commission': 3.9}
+            # Детальная статистика читает строки рабочей базы: остается последняя комиссия пары
+            assert "Заработано TON: 2.50\n💎 TON рефералов: 1" in await manager.get_user_referral_stats(2)
+            archived = await archiver.read_history("referral_earnings", 0)
+            assert [row['commission_amount'] for row in archived] == [0.4, 1.0, 2.5]
+        finally:
+            await manager.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,45 @@
+"""Резервные копии SQLite под постоянной записью"""
+import asyncio
+import sqlite3
+import threading
+import time
+
+from db_backup import BackupManager
+
+
+def test_backup_without_wal_survives_steady_writes(tmp_path):
+    path = tmp_path / "bot.db"
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, payload TEXT)")
+    connection.executemany("INSERT INTO items (payload) VALUES (?)", [("x" * 200,)] * 2000)
+    connection.commit()
+    connection.close()
+
+    stop = threading.Event()
+
+    def writer():
+        # Коммит каждые несколько миллисекунд: пошаговое копирование все время начинается заново
+        db = sqlite3.connect(path, timeout=5)
+        while not stop.is_set():
+            db.execute("INSERT INTO items (payload) VALUES ('y')")
+            db.commit()
+            time.sleep(0.001)
+        db.close()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        manager = BackupManager(str(path), str(tmp_path / "backups"), pages_per_step=1,
+                                step_sleep_ms=2.0, max_restarts=1)
+        snapshot = asyncio.run(manager.backup_now())
+    finally:
+        stop.set()
+        thread.join()
+
+    copy = sqlite3.connect(snapshot)
+    try:
+        assert copy.execute("PRAGMA journal_mode").fetchone()[0] != "wal"
+        assert copy.execute("SELECT COUNT(*) FROM items WHERE payload != 'y'").fetchone()[0] == 2000
+    finally:
+        copy.close()
+    assert manager.list_snapshots() == [snapshot]
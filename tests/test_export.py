@@ -0,0 +1,61 @@
+"""Выгрузка таблиц: история из архива, повторное использование файла"""
+import asyncio
+import csv
+import gzip
+import sqlite3
+from datetime import datetime, timezone
+
+from conftest import wait_backfills
+from database_async import AsyncDatabaseManager
+from db_archive import Archiver
+from db_export import Exporter
+
+
+def test_export_includes_archived_rows(tmp_path):
+    path = str(tmp_path / "bot.db")
+
+    async def scenario():
+        manager = AsyncDatabaseManager(db_path=path)
+        await manager.initialize()
+        try:
+            await wait_backfills(manager)
+            await manager.get_or_create_user(1, "alice", "Alice", "")
+            for _ in range(5):
+                await manager.add_subscription(1, "4_ton", "TON", 4.0)
+
+            # Четыре подписки из пяти - в прошлом году, по одной в месяц
+            connection = sqlite3.connect(path)
+            ids = [row[0] for row in connection.execute("SELECT id FROM subscriptions ORDER BY id")]
+            connection.executemany("UPDATE subscriptions SET created_ts = ? WHERE id = ?", [
+                (int(datetime(2023, month, 1, tzinfo=timezone.utc).timestamp()), row_id)
+                for month, row_id in zip(range(1, 5), ids)
+            ])
+            connection.commit()
+            connection.close()
+
+            archiver = Archiver(path, archive_dir=str(tmp_path / "archive"), retention_days=30, batch_pause_ms=0)
+            assert (await archiver.run_once())['subscriptions'] == 4
+
+            exporter = Exporter(manager, export_dir=str(tmp_path / "exports"), batch_size=2, archiver=archiver)
+            result = await exporter.export("subscriptions", "csv")
+            assert (result.rows, result.archived_rows) == (5, 4)
+            with gzip.open(result.path, "rt", encoding="utf-8", newline="") as stream:
+                header, *rows = list(csv.reader(stream))
+            assert sorted(int(row[0]) for row in rows) == ids
+            assert {(row[header.index("subscription_type")], row[header.index("payment_method")]) for row in rows} == {
+                ("4_ton", "TON")
+            }
+
+            # Свежий файл отдается повторно, новая выгрузка не запускается
+            assert await exporter.export("subscriptions", "csv") is result
+
+            # Одновременные запросы без повторного использования делят одну выгрузку
+            exporter.reuse_seconds = 0
+            first, second = await asyncio.gather(
+                exporter.export("users", "ndjson"), exporter.export("users", "ndjson")
+            )
+            assert first is second and first.rows == 1
+        finally:
+            await manager.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,52 @@
+"""Массовый импорт: счетчики добавленных и пропущенных строк"""
+import asyncio
+
+from conftest import wait_backfills
+from database_async import AsyncDatabaseManager
+from db_cache import QueryCache
+from db_import import Importer
+
+
+def test_import_counts_only_inserted_rows(tmp_path):
+    path = str(tmp_path / "bot.db")
+    users = tmp_path / "users.csv"
+    users.write_text(
+        "id,username,first_name,last_name,created_at\n"
+        "1,alice,Alice,,2024-01-01\n"        # уже есть в базе
+        "2,ALICE,Alice2,,2024-01-02\n"       # username занят - сохраняется без username_lower
+        "3,carol,Carol,,2024-01-03\n"
+        "3,carol,Carol,,2024-01-03\n"        # повтор в файле
+        "x,bad,Bad,,2024-01-04\n",           # некорректный id
+        encoding="utf-8"
+    )
+    referrals = tmp_path / "referrals.csv"
+    referrals.write_text("referrer_id,referred_id\n1,2\n1,2\n1,99\n", encoding="utf-8")
+
+    async def scenario():
+        manager = AsyncDatabaseManager(db_path=path, query_cache=QueryCache())
+        await manager.initialize()
+        try:
+            await wait_backfills(manager)
+            await manager.get_or_create_user(1, "alice", "Alice", "")
+            assert await manager.get_all_users_count() == 1
+
+            importer = Importer(manager, batch_size=10)
+            result = await importer.import_file("users", users)
+            assert (result.rows, result.inserted, result.skipped, result.rejected) == (5, 2, 2, 1)
+
+            # Импорт внутри процесса сбрасывает кэш запросов
+            assert await manager.get_all_users_count() == 3
+            assert (await manager.get_user_by_username("alice"))["id"] == 1
+
+            result = await importer.import_file("referrals", referrals)
+            assert (result.inserted, result.skipped, result.rejected) == (1, 1, 1)
+            assert await manager.get_user_referrals_count(1) == 1
+
+            # Повторный импорт того же файла ничего не добавляет
+            result = await importer.import_file("referrals", referrals, resume=False)
+            assert (result.rows, result.inserted, result.skipped, result.rejected) == (3, 0, 2, 1)
+            assert await manager.get_total_referrals_count() == 1
+        finally:
+            await manager.close()
+
+    asyncio.run(scenario())
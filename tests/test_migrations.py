@@ -0,0 +1,95 @@
+"""Миграции схемы SQLite: обновление базы из исходной (до версионирования) схемы"""
+import asyncio
+import sqlite3
+from datetime import datetime, timezone
+
+from conftest import wait_backfills
+from database_async import AsyncDatabaseManager
+from db_migrations import MIGRATIONS
+
+def create_baseline_db(path):
+    """База в исходной схеме бота: без schema_migrations, типы подписок строками"""
+    connection = sqlite3.connect(path)
+    for statement in MIGRATIONS[0].statements:
+        connection.execute(statement)
+    connection.executemany(
+        "INSERT INTO users (id, username, first_name, last_name, created_at, referral_code) VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            (1, "Alice", "Alice", "", "2024-01-10 08:00:00", "ref_1"),
+            (2, "@bob", "Bob", "", "2024-01-11 09:30:00", "ref_2"),
+            (3, "", "Carol", "", "2024-01-12 12:00:00", "ref_3"),
+        ]
+    )
+    connection.execute("INSERT INTO referrals (referrer_id, referred_id, created_at) VALUES (1, 2, '2024-01-11 09:31:00')")
+    connection.executemany(
+        "INSERT INTO subscriptions (user_id, subscription_type, payment_method, amount, currency, status, created_at) "
+        "VALUES (?, ?, ?, ?, 'TON', 'confirmed', ?)",
+        [(2, "4_ton", "TON", 4.0, "2024-01-15 10:00:00"), (3, "1_month", "STARS", 250.0, "2024-01-16 10:00:00")]
+    )
+    connection.execute(
+        "INSERT INTO referral_earnings (referrer_id, referred_id, commission_amount, subscription_type, payment_method, created_at) "
+        "VALUES (1, 2, 0.4, '4_ton', 'TON', '2024-01-15 10:00:00')"
+    )
+    connection.execute(
+        "INSERT INTO confirmation_logs (admin_id, subscription_type, username, link_id, timestamp) "
+        "VALUES (100, '4_ton', 'bob', 'link-1', '2024-01-15 10:05:00')"
+    )
+    connection.commit()
+    connection.close()
+
+
+def epoch(text):
+    return int(datetime.strptime(text, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp())
+
+
+def test_migrate_from_baseline(tmp_path):
+    path = str(tmp_path / "bot.db")
+    create_baseline_db(path)
+
+    async def scenario():
+        manager = AsyncDatabaseManager(db_path=path)
+        manager.migrations.backfill_pause = 0
+        await manager.initialize()
+        try:
+            await wait_backfills(manager)
+            assert await manager.migrations.current_version() == manager.migrations.latest_version
+
+            # Итоги из counters и referral_rollup совпадают с исходными строками
+            assert await manager.get_all_users_count() == 3
+            assert await manager.get_total_referrals_count() == 1
+            assert await manager.get_total_commission_earned() == 0.4
+            assert await manager.get_user_referrals_count(1) == 1
+
+            # username_lower заполнен, поиск без учета регистра и @
+            user = await manager.get_user_by_username("BOB")
+            assert user is not None and user["id"] == 2
+
+            # Строковые типы подписок перенесены в справочники
+            rows = [row async for batch in manager.iter_table("subscriptions") for row in batch]
+            assert [(row[1], row[2], row[3]) for row in rows] == [(2, "4_ton", "TON"), (3, "1_month", "STARS")]
+            earnings = [row async for batch in manager.iter_table("earnings") for row in batch]
+            assert [(row[4], row[5]) for row in earnings] == [("4_ton", "TON")]
+        finally:
+            await manager.close()
+
+        # created_ts догнан фоновыми backfill по текстовому времени
+        connection = sqlite3.connect(path)
+        try:
+            assert connection.execute("SELECT created_ts FROM subscriptions ORDER BY id").fetchall() == [
+                (epoch("2024-01-15 10:00:00"),), (epoch("2024-01-16 10:00:00"),)
+            ]
+            assert connection.execute("SELECT created_ts FROM confirmation_logs").fetchone()[0] == epoch("2024-01-15 10:05:00")
+            assert connection.execute("SELECT COUNT(*) FROM users WHERE created_ts IS NULL").fetchone()[0] == 0
+        finally:
+            connection.close()
+
+        # Повторный старт ничего не применяет заново
+        manager = AsyncDatabaseManager(db_path=path)
+        await manager.initialize()
+        try:
+            assert await manager.migrations.current_version() == manager.migrations.latest_version
+            assert await manager.get_all_users_count() == 3
+        finally:
+            await manager.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,96 @@
+"""Бэкенд PostgreSQL на живом сервере: запускается только при заданном DB_POSTGRES_DSN.
+
+Каждый тест работает в своей схеме (search_path в DSN), схема удаляется после теста.
+"""
+import asyncio
+import os
+import uuid
+
+import pytest
+
+from conftest import wait_backfills
+from database_memory import InMemoryStorage
+from db_cache import QueryCache
+from test_storage_parity import run_sequence
+
+DSN = os.getenv("DB_POSTGRES_DSN")
+pytestmark = pytest.mark.skipif(not DSN, reason="DB_POSTGRES_DSN не задан")
+
+asyncpg = pytest.importorskip("asyncpg") if DSN else None
+
+
+async def scratch_manager():
+    """PostgresDatabaseManager в новой пустой схеме, возвращает (manager, schema)"""
+    from database_postgres import PostgresDatabaseManager
+    schema = f"test_{uuid.uuid4().hex[:12]}"
+    connection = await asyncpg.connect(DSN)
+    try:
+        await connection.execute(f"CREATE SCHEMA {schema}")
+    finally:
+        await connection.close()
+    # Неизвестные параметры DSN asyncpg передает серверу как настройки сессии
+    separator = "&" if "?" in DSN else "?"
+    return PostgresDatabaseManager(dsn=f"{DSN}{separator}search_path={schema}", query_cache=QueryCache()), schema
+
+
+async def drop_schema(schema: str):
+    connection = await asyncpg.connect(DSN)
+    try:
+        await connection.execute(f"DROP SCHEMA {schema} CASCADE")
+    finally:
+        await connection.close()
+
+
+def test_postgres_migrations_and_parity_with_memory():
+    async def scenario():
+        manager, schema = await scratch_manager()
+        memory = InMemoryStorage()
+        try:
+            await manager.initialize()
+            await memory.initialize()
+            await wait_backfills(manager)
+            assert await manager.migrations.current_version() == manager.migrations.latest_version
+
+            postgres_result = await run_sequence(manager)
+            memory_result = await run_sequence(memory)
+            for key in postgres_result:
+                assert postgres_result[key] == memory_result[key], key
+            assert postgres_result["totals"] == (3, 1.9)
+
+            # Повторный старт: миграции уже применены
+            await manager.close()
+            await manager.initialize()
+            assert await manager.migrations.current_version() == manager.migrations.latest_version
+            assert await manager.get_all_users_count() == 5
+        finally:
+            await manager.close()
+            await memory.close()
+            await drop_schema(schema)
+
+    asyncio.run(scenario())
+
+
+def test_postgres_import_counts_only_inserted_rows(tmp_path):
+    from db_import import Importer
+    referrals = tmp_path / "referrals.csv"
+    referrals.write_text("referrer_id,referred_id\n1,2\n1,2\n1,99\n", encoding="utf-8")
+
+    async def scenario():
+        manager, schema = await scratch_manager()
+        try:
+            await manager.initialize()
+            await wait_backfills(manager)
+            await manager.get_or_create_user(1, "alice", "Alice", "")
+            await manager.get_or_create_user(2, "bob", "Bob", "")
+
+            importer = Importer(manager, batch_size=10)
+            result = await importer.import_file("referrals", referrals)
+            assert (result.inserted, result.skipped, result.rejected) == (1, 1, 1)
+            result = await importer.import_file("referrals", referrals, resume=False)
+            assert (result.inserted, result.skipped, result.rejected) == (0, 2, 1)
+            assert await manager.get_total_referrals_count() == 1
+        finally:
+            await manager.close()
+            await drop_schema(schema)
+
+    asyncio.run(scenario())
@@ -0,0 +1,104 @@
+"""Кэш ответов хранилища: сброс по записям, архивации и смене даты"""
+import asyncio
+import dataclasses
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import db_cache
+from conftest import wait_backfills
+from database_async import AsyncDatabaseManager
+from db_archive import Archiver
+from db_cache import QueryCache, create_query_cache
+
+
+def test_create_query_cache_requires_positive_size_and_ttl():
+    assert create_query_cache(SimpleNamespace(DB_QUERY_CACHE_SIZE=0, DB_QUERY_CACHE_TTL=60)) is None
+    assert create_query_cache(SimpleNamespace(DB_QUERY_CACHE_SIZE=100, DB_QUERY_CACHE_TTL=0)) is None
+    cache = create_query_cache(SimpleNamespace(DB_QUERY_CACHE_SIZE=100, DB_QUERY_CACHE_TTL=30))
+    assert cache is not None and cache.stats()['maxsize'] == 100
+
+
+def test_query_cache_invalidation(tmp_path, monkeypatch):
+    path = str(tmp_path / "bot.db")
+
+    async def scenario():
+        cache = QueryCache(maxsize=3)
+        manager = AsyncDatabaseManager(db_path=path, wal_mode=True, group_commit=True, query_cache=cache)
+        await manager.initialize()
+        try:
+            await wait_backfills(manager)
+            await manager.get_or_create_user(1, "alice", "Alice", "")
+            assert await manager.get_all_users_count() == 1
+            assert await manager.get_all_users_count() == 1
+            assert cache.stats()['methods']['get_all_users_count'] == {'hits': 1, 'misses': 1}
+
+            # Запись в users делает ответ устаревшим
+            await manager.get_or_create_user(2, "bob", "Bob", "")
+            assert await manager.get_all_users_count() == 2
+            assert cache.stale == 1
+
+            # Размер ограничен
+            for user_id in range(10):
+                await manager.get_user_referrals_count(user_id)
+            assert len(cache) == 3
+
+            # Смена даты UTC - новый ключ для статистики "сегодня / за неделю"
+            await manager.save_confirmation_log({'admin_id': 100, 'subscription_type': '4_ton',
+                                                 'username': 'bob', 'link_id': 'link-1'})
+            assert (await manager.get_confirmation_stats())['today'] == 1
+            assert (await manager.get_confirmation_stats())['today'] == 1
+            tomorrow = time.gmtime(time.time() + 86400)
+            monkeypatch.setattr(db_cache.time, "gmtime", lambda *args: tomorrow)
+            await manager.get_confirmation_stats()
+            assert cache.stats()['methods']['get_confirmation_stats'] == {'hits': 1, 'misses': 2}
+            monkeypatch.undo()
+
+            # Архивация в том же процессе сбрасывает ответы по перенесенным таблицам
+            await manager.add_subscription(1, "4_ton", "TON", 4.0)
+            await manager.add_subscription(1, "4_ton", "TON", 4.0)
+            assert (await manager.check_subscription_access(1, 4, "4_ton"))['subscription_count'] == 2
+            connection = sqlite3.connect(path)
+            connection.execute("UPDATE subscriptions SET created_ts = 1600000000 WHERE id = 1")
+            connection.commit()
+            connection.close()
+            archiver = Archiver(path, archive_dir=str(tmp_path / "archive"), retention_days=30,
+                                batch_pause_ms=0, query_cache=cache)
+            assert (await archiver.run_once())['subscriptions'] == 1
+            assert (await manager.check_subscription_access(1, 4, "4_ton"))['subscription_count'] == 1
+        finally:
+            await manager.close()
+
+    asyncio.run(scenario())
+
+
+def test_backfill_invalidates_only_its_table(tmp_path):
+    path = str(tmp_path / "bot.db")
+
+    async def scenario():
+        cache = QueryCache()
+        manager = AsyncDatabaseManager(db_path=path, query_cache=cache)
+        await manager.initialize()
+        try:
+            await wait_backfills(manager)
+            await manager.get_or_create_user(1, "alice", "Alice", "")
+            await manager.get_all_users_count()
+            await manager.get_total_referrals_count()
+
+            # Повторный прогон backfill по users (по пачке на строку)
+            connection = sqlite3.connect(path)
+            connection.execute("UPDATE schema_backfills SET done = 0, last_key = NULL WHERE name = 'users_created_ts'")
+            connection.commit()
+            connection.close()
+            backfill = manager.migrations._backfills['users_created_ts']
+            await manager.migrations._run_backfill(dataclasses.replace(backfill, chunk_size=1))
+
+            await manager.get_all_users_count()
+            await manager.get_total_referrals_count()
+            methods = cache.stats()['methods']
+            assert methods['get_all_users_count'] == {'hits': 0, 'misses': 2}
+            assert methods['get_total_referrals_count'] == {'hits': 1, 'misses': 1}
+        finally:
+            await manager.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,151 @@
+"""Одна и та же последовательность вызовов на AsyncDatabaseManager и InMemoryStorage"""
+import asyncio
+
+from conftest import wait_backfills
+from database_async import AsyncDatabaseManager
+from database_memory import InMemoryStorage
+from db_cache import QueryCache
+from db_storage import EXPORT_TABLES, USER_SEGMENTS
+
+
+def without_clock(rows):
+    """Словари без created_at: время записи у бэкендов берется из разных часов"""
+    return [{key: value for key, value in row.items() if key != "created_at"} for row in rows]
+
+
+async def run_sequence(storage):
+    """Записи через общий интерфейс хранилища, затем все методы чтения"""
+    for user_id, username in [(1, "alice"), (2, "Bob"), (3, "@carol"), (4, "dave"), (5, "")]:
+        await storage.get_or_create_user(user_id, username, f"F{user_id}", "")
+    await storage.get_or_create_user(2, "bobby", "F2", "L2")  # смена username
+
+    await storage.create_pending_referral(1, 2)
+    await storage.save_pending_referral(3, 1)
+    await storage.save_pending_referral(5, 4)
+    await storage.remove_pending_referral(5)
+
+    result = {}
+    result["add_referral"] = [
+        await storage.add_referral(1, 2),
+        await storage.add_referral(1, 3),
+        await storage.add_referral(1, 2),  # повтор
+        await storage.add_referral(4, 4),  # сам себя
+        await storage.add_referral(4, 5),
+    ]
+    result["subscriptions"] = [
+        await storage.add_subscription(2, "4_ton", "TON", 4.0),
+        await storage.add_subscription(3, "25_stars", "STARS", 25.0, "STARS"),
+        await storage.add_subscription(3, "10_ton", "TON", 10.0),
+    ]
+    await storage.add_referral_earnings(4, 5, 0.5, "5_ton", "TON")
+    await storage.add_referral_earnings(4, 5, 0.0, "5_ton", "TON")
+    for number, (subscription_type, username) in enumerate(
+            [("4_ton", "bob"), ("25_stars", "carol"), ("4_ton", "x")]):
+        await storage.save_confirmation_log({
+            "admin_id": 100, "subscription_type": subscription_type,
+            "username": username, "link_id": f"l{number}"
+        })
+
+    result["users_count"] = await storage.get_all_users_count()
+    result["all_users"] = without_clock(await storage.get_all_users(limit=10))
+    result["segments"] = {
+        segment: without_clock([user async for user in storage.iter_users(batch_size=2, filter=segment)])
+        for segment in USER_SEGMENTS
+    }
+    result["resolve"] = [await storage.resolve_username(name)
+                         for name in ("BOBBY", "bob", "@Carol", "nobody")]
+    result["by_username"] = without_clock([await storage.get_user_by_username("Carol")])
+    result["subscribers"] = await storage.get_subscribers()
+    result["pending"] = [await storage.get_pending_referrer(user_id) for user_id in (2, 3, 5)]
+    result["per_user"] = {
+        user_id: (
+            await storage.get_user_referrals_count(user_id),
+            await storage.get_user_referral_earnings(user_id),
+            await storage.get_user_referral_stats(user_id),
+            await storage.get_user_referral_stats_by_type(user_id, "4_ton"),
+            await storage.get_user_referral_stats_by_type(user_id, "10_ton"),
+        )
+        for user_id in (1, 2, 3, 4, 5)
+    }
+    result["admin_by_type"] = [await storage.get_admin_referral_stats_by_type(code)
+                               for code in ("4_ton", "10_ton", "5_ton", "25_stars")]
+    result["referral_stats"] = await storage.get_referral_stats()
+    result["overview"] = await storage.get_referral_overview()
+    result["totals"] = (await storage.get_total_referrals_count(),
+                        await storage.get_total_commission_earned())
+    result["access"] = [await storage.check_subscription_access(user_id, 4, "4_ton")
+                        for user_id in (1, 2, 3)]
+    result["logs"] = [{key: value for key, value in log.items() if key != "timestamp"}
+                      for log in await storage.get_recent_confirmation_logs(10)]
+    result["confirmation_stats"] = await storage.get_confirmation_stats()
+    # id и created_at у бэкендов свои (AUTOINCREMENT, часы базы) - сравниваются данные
+    result["tables"] = {}
+    for table, (_, columns) in EXPORT_TABLES.items():
+        keep = [index for index, column in enumerate(columns) if column not in ("id", "created_at")]
+        result["tables"][table] = [tuple(row[index] for index in keep)
+                                   async for batch in storage.iter_table(table, 2) for row in batch]
+    return result
+
+
+def test_sqlite_and_memory_backends_agree(tmp_path):
+    async def scenario():
+        manager = AsyncDatabaseManager(db_path=str(tmp_path / "bot.db"), query_cache=QueryCache())
+        memory = InMemoryStorage()
+        await manager.initialize()
+        await memory.initialize()
+        try:
+            await wait_backfills(manager)
+            sqlite_result = await run_sequence(manager)
+            memory_result = await run_sequence(memory)
+            for key in sqlite_result:
+                assert sqlite_result[key] == memory_result[key], key
+
+            assert sqlite_result["totals"] == (3, 1.9)
+            assert sqlite_result["resolve"][:3] == [2, None, 3]
+            # Комиссии по рефералу сопоставляются по id приглашенного пользователя
+            stats = {user_id: sqlite_result["per_user"][user_id][2] for user_id in (2, 3, 4, 5)}
+            assert "Всего рефералов: 1\n💰 Заработано TON: 0.40\n💎 TON рефералов: 1\n⭐ Stars рефералов: 0" in stats[2]
+            assert "Заработано TON: 1.00\n💎 TON рефералов: 1" in stats[3]
+            assert "Заработано TON: 0.50" in stats[5]
+            assert stats[4] == "У вас пока нет рефералов."
+
+            # Счетчики и предагрегаты на триггерах совпадают с прямым подсчетом
+            async with manager.read_only() as tx:
+                counters = dict(await tx.fetchall("SELECT name, value FROM counters"))
+                assert counters["users"] == (await tx.fetchone("SELECT COUNT(*) FROM users"))[0]
+                assert counters["referrals"] == (await tx.fetchone("SELECT COUNT(*) FROM referrals"))[0]
+                commission = (await tx.fetchone("""
+                    SELECT COALESCE(SUM(e.commission_amount), 0) FROM referral_earnings e
+                    JOIN payment_methods pm ON pm.id = e.payment_method_id WHERE pm.code = 'TON'
+                """))[0]
+                assert counters["commission_ton"] == commission
+
+                rollup = await tx.fetchall("""
+                    SELECT referrer_id, subscription_type_id, payment_method_id,
+                           referral_count, commission_sum
+                    FROM referral_rollup WHERE referral_count > 0 OR commission_sum != 0
+                    ORDER BY 1, 2, 3
+                """)
+                direct = await tx.fetchall("""
+                    SELECT referrer_id, subscription_type_id, payment_method_id,
+                           COUNT(DISTINCT referred_id), SUM(commission_amount)
+                    FROM referral_earnings
+                    GROUP BY referrer_id, subscription_type_id, payment_method_id
+                    ORDER BY 1, 2, 3
+                """)
+                assert [tuple(row) for row in rollup] == [tuple(row) for row in direct]
+
+                daily = await tx.fetchall("""
+                    SELECT day, subscription_type_id, count FROM confirmation_daily
+                    WHERE count > 0 ORDER BY 1, 2
+                """)
+                direct = await tx.fetchall("""
+                    SELECT DATE(created_ts, 'unixepoch'), subscription_type_id, COUNT(*)
+                    FROM confirmation_logs GROUP BY 1, 2 ORDER BY 1, 2
+                """)
+                assert [tuple(row) for row in daily] == [tuple(row) for row in direct]
+        finally:
+            await manager.close()
+            await memory.close()
+
+    asyncio.run(scenario())